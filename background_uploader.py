@@ -0,0 +1,166 @@
+import os
+import gzip
+import queue
+import threading
+import time
+
+
+def put_bytes_in_bucket(handler, working_date, data, file_name_to_save, bucket_name, content_type, content_encoding=None):
+    '''
+    saves raw bytes (a gzipped page, a js asset) with the handler's save_bytes_in_bucket(). AWSHandler has no such
+    method, on S3 use a storage_backends.S3Storage: it puts the bytes with its one client, which the upload
+    threads share.
+
+    ----------
+    parameters:
+    data: bytes
+        the content of the file
+    content_type: str
+        e.g. 'text/html' or 'application/javascript'
+    content_encoding: str or None
+        'gzip' if data is gzip compressed, so browsers decompress it
+    '''
+    _check_saves_bytes(handler)
+    return handler.save_bytes_in_bucket(working_date=working_date, data=data, file_name_to_save=file_name_to_save, bucket_name=bucket_name, content_type=content_type, content_encoding=content_encoding)
+
+
+def _check_saves_bytes(handler):
+    if not hasattr(handler, 'save_bytes_in_bucket'):
+        raise TypeError(f'{type(handler).__name__} can not save bytes, use a storage_backends.S3Storage to upload to S3')
+
+
+def upload_name(bucket_name, working_date, file_name_to_save):
+    '''
+    the name an upload is reported by in BackgroundUploader.close()'s summary
+    '''
+    return f'{bucket_name}/{working_date}/{file_name_to_save}'
+
+
+class LocalDirectoryHandler:
+    '''
+    In-process stand-in for AWSHandler that saves the files under a local directory instead of S3,
+    as {root_dir}/{bucket_name}/{working_date}/{file_name_to_save}. Used to run and test uploads offline.
+
+    ----------
+    parameters:
+    root_dir: str
+        directory that plays the role of S3
+    '''
+    def __init__(self, root_dir):
+        self.root_dir = root_dir
+
+    def _path(self, working_date, file_name_to_save, bucket_name):
+        path = os.path.join(self.root_dir, bucket_name, working_date, file_name_to_save)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+    def save_html_file_in_bucket(self, working_date, html_string, file_name_to_save, bucket_name):
+        with open(self._path(working_date, file_name_to_save, bucket_name), 'w') as f:
+            f.write(html_string)
+
+    def save_file_in_bucket(self, working_date, df_to_save, file_name_to_save, bucket_name):
+        df_to_save.to_csv(self._path(working_date, file_name_to_save, bucket_name), index=False)
+
+    def save_bytes_in_bucket(self, working_date, data, file_name_to_save, bucket_name, content_type, content_encoding=None):
+        # a local file has no content encoding, so a gzipped page is saved decompressed for a browser to open it
+        if content_encoding == 'gzip':
+            data = gzip.decompress(data)
+        with open(self._path(working_date, file_name_to_save, bucket_name), 'wb') as f:
+            f.write(data)
+
+
+class BackgroundUploader:
+    '''
+    Uploads files in the background with a pool of threads that share one handler (and so one pooled client).
+    It has the same save methods as AWSHandler (plus save_bytes_in_bucket, see put_bytes_in_bucket()),
+    so it can be passed anywhere an aws_handler is expected: the call is queued and returns right away. When max_pending uploads are waiting the call blocks
+    until a thread frees a slot, so rendering can't run far ahead of the uploads.
+    Every upload is tried up to retries+1 times. close() waits for everything and returns a summary.
+
+    ----------
+    parameters:
+    handler: storage object, AWSHandler or LocalDirectoryHandler object
+        does the actual uploads, its client must be safe to share between threads (boto3 clients are).
+        to upload bytes it needs save_bytes_in_bucket(), see put_bytes_in_bucket()
+    workers: int
+        number of upload threads
+    max_pending: int
+        size of the upload queue
+    retries: int
+        how many times to retry a failed upload
+    retry_wait: float
+        seconds to wait before the first retry, doubled on every retry
+    '''
+    def __init__(self, handler, workers=8, max_pending=32, retries=3, retry_wait=0.5):
+        self.handler = handler
+        self.retries = retries
+        self.retry_wait = retry_wait
+        self.pending = queue.Queue(maxsize=max_pending)
+        self.lock = threading.Lock()
+        self.uploaded = 0
+        self.uploaded_bytes = 0
+        self.failed = []
+        self.started = time.perf_counter()
+        self.threads = [threading.Thread(target=self._work, daemon=True) for _ in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def save_html_file_in_bucket(self, working_date, html_string, file_name_to_save, bucket_name):
+        self.pending.put((self.handler.save_html_file_in_bucket, dict(working_date=working_date, html_string=html_string, file_name_to_save=file_name_to_save, bucket_name=bucket_name)))
+
+    def save_file_in_bucket(self, working_date, df_to_save, file_name_to_save, bucket_name):
+        self.pending.put((self.handler.save_file_in_bucket, dict(working_date=working_date, df_to_save=df_to_save, file_name_to_save=file_name_to_save, bucket_name=bucket_name)))
+
+    def save_bytes_in_bucket(self, working_date, data, file_name_to_save, bucket_name, content_type, content_encoding=None):
+        # checked here, in the caller's thread, rather than failing every upload with its retries
+        _check_saves_bytes(self.handler)
+        kwargs = dict(working_date=working_date, data=data, file_name_to_save=file_name_to_save, bucket_name=bucket_name, content_type=content_type, content_encoding=content_encoding)
+        self.pending.put((self.handler.save_bytes_in_bucket, kwargs))
+
+    def _work(self):
+        while True:
+            task = self.pending.get()
+            if task is None:
+                self.pending.task_done()
+                return
+            save, kwargs = task
+            name = upload_name(kwargs['bucket_name'], kwargs['working_date'], kwargs['file_name_to_save'])
+            for attempt in range(self.retries + 1):
+                try:
+                    save(**kwargs)
+                except Exception as e:
+                    print(f'upload of {name} failed (attempt {attempt + 1}): {e}')
+                    if attempt == self.retries:
+                        with self.lock:
+                            self.failed.append(name)
+                    else:
+                        time.sleep(self.retry_wait * 2**attempt)
+                    continue
+                with self.lock:
+                    self.uploaded += 1
+                    if 'html_string' in kwargs:
+                        self.uploaded_bytes += len(kwargs['html_string'].encode())
+                    elif 'data' in kwargs:
+                        self.uploaded_bytes += len(kwargs['data'])
+                break
+            self.pending.task_done()
+
+    def close(self):
+        '''
+        waits for all queued uploads to finish, stops the threads and returns a summary:
+        {'uploaded': int, 'uploaded_bytes': int, 'failed': [names], 'seconds': float}
+        '''
+        for _ in self.threads:
+            self.pending.put(None)
+        for thread in self.threads:
+            thread.join()
+        summary = {
+            'uploaded': self.uploaded,
+            'uploaded_bytes': self.uploaded_bytes,
+            'failed': list(self.failed),
+            'seconds': time.perf_counter() - self.started,
+        }
+        print(f"uploaded {summary['uploaded']} files in {summary['seconds']:0.2f}s, {len(summary['failed'])} failed")
+        for name in summary['failed']:
+            print(f'failed upload: {name}')
+        return summary
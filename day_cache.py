@@ -0,0 +1,135 @@
+import os
+import numpy as np
+import pandas as pd
+
+
+# bump this when the columns or dtypes of the cached quotes change, old entries are then ignored
+QUOTES_SCHEMA_VERSION = 3
+# the array of a categorical column's categories is saved as {column}{CATEGORIES_SUFFIX}, the column's array holds its codes
+CATEGORIES_SUFFIX = '__categories'
+# an object column is saved as strings, with the mask of its missing values as {column}{MISSING_SUFFIX} if it has any
+MISSING_SUFFIX = '__missing'
+
+
+def _cached_column(cached, col, keep):
+    # the rows keep of a column of an opened npz
+    if col + CATEGORIES_SUFFIX in cached.files:
+        return pd.Categorical.from_codes(cached[col][keep], categories=cached[col + CATEGORIES_SUFFIX].astype(object))
+    if col + MISSING_SUFFIX in cached.files:
+        values = cached[col][keep].astype(object)
+        values[cached[col + MISSING_SUFFIX][keep]] = np.nan
+        return values
+    return cached[col][keep]
+
+
+class DayCache:
+    '''
+    A local on-disk cache of each day's cleaned quotes, stored as uncompressed npz (one array per column,
+    a categorical as its codes and its categories) so a warm rerun never has to download or parse the
+    merged_raw_data csv.
+
+    Entries are keyed by the date and QUOTES_SCHEMA_VERSION. When the cache grows past max_bytes,
+    the least recently used days are deleted. The last use of an entry is its file's modification time,
+    so the order survives between runs.
+
+    ----------
+    parameters:
+    cache_dir: str
+        directory where the days are saved
+    max_bytes: int
+        size limit of the cache directory
+    '''
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def path(self, date):
+        '''
+        path of the cached file of a date {DD-MM-YYYY}
+        '''
+        return os.path.join(self.cache_dir, f'{date}.v{QUOTES_SCHEMA_VERSION}.npz')
+
+    def get(self, date, time_range=None):
+        '''
+        returns the cached quotes of the date, or None if they are not cached. with time_range, (start, end)
+        bbp_timestamp in ms with the end excluded, only the quotes in it: the others are dropped from the
+        arrays, before a dataframe is made
+        '''
+        path = self.path(date)
+        if not os.path.exists(path):
+            return None
+        try:
+            with np.load(path, allow_pickle=False) as cached:
+                columns = list(cached['__columns__'])
+                keep = slice(None)
+                if time_range is not None:
+                    timestamps = cached['bbp_timestamp']
+                    keep = (timestamps >= time_range[0]) & (timestamps < time_range[1])
+                file = pd.DataFrame({col: _cached_column(cached, col, keep) for col in columns})
+        except Exception as e:
+            print(e)
+            print(f'failed to read cached {date}')
+            return None
+        for col in columns:
+            if file[col].dtype.kind == 'U':
+                file[col] = file[col].astype(object)
+        # mark as recently used
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        print(f'read {date} from cache')
+        return file
+
+    def put(self, date, file):
+        '''
+        saves the quotes of the date and evicts the least recently used days if the cache is too big
+        '''
+        path = self.path(date)
+        arrays = {}
+        for col in file.columns:
+            if isinstance(file[col].dtype, pd.CategoricalDtype):
+                arrays[col] = file[col].cat.codes.to_numpy()
+                arrays[col + CATEGORIES_SUFFIX] = file[col].cat.categories.to_numpy(dtype=str)
+            elif file[col].dtype == object:
+                arrays[col] = file[col].to_numpy(dtype=str)
+                # as a string a missing value would come back as 'nan'
+                missing = file[col].isna().to_numpy()
+                if missing.any():
+                    arrays[col + MISSING_SUFFIX] = missing
+            else:
+                arrays[col] = file[col].to_numpy()
+        arrays['__columns__'] = np.array(list(file.columns), dtype=str)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, path)
+        self.evict(keep=path)
+
+    def evict(self, keep=None):
+        '''
+        deletes the least recently used days until the cache is under max_bytes. the entry at keep is never deleted
+        '''
+        # other processes may use the same cache directory, so entries can disappear while we look at them
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.npz'):
+                entry_path = os.path.join(self.cache_dir, name)
+                try:
+                    stat = os.stat(entry_path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry_path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry_path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if entry_path == keep:
+                continue
+            try:
+                os.remove(entry_path)
+                print(f'evicted {entry_path} from cache')
+            except FileNotFoundError:
+                pass
+            total -= size
@@ -0,0 +1,338 @@
+import sys
+from collections.abc import MutableMapping
+import numpy as np
+import pandas as pd
+
+
+# the keys of a delta record from delta_finder(), in their order
+DELTA_COLUMNS = ["dif_name", "dif_value", "offer_bbp_timestamp", "bid_bbp_timestamp", "offer_original_timestamp",
+                 "bid_original_timestamp", "offer_rate", "bid_rate", "dif_bbp_timestamp", "id", "direction_research"]
+TIMESTAMP_COLUMNS = ["offer_bbp_timestamp", "bid_bbp_timestamp", "offer_original_timestamp", "bid_original_timestamp", "dif_bbp_timestamp"]
+FLOAT_COLUMNS = ["dif_value", "offer_rate", "bid_rate"]
+CATEGORY_COLUMNS = ["dif_name", "direction_research"]
+
+# marks a row that has no value in an extra column, like a delta dict without the key
+_MISSING = object()
+
+
+def _timestamp_array(values):
+    '''
+    int64 if every timestamp is a whole number, float64 otherwise so nothing is lost
+    '''
+    values = np.asarray(values)
+    if values.dtype.kind in 'iu':
+        return values.astype(np.int64, copy=False)
+    values = values.astype(np.float64, copy=False)
+    if np.all(np.isfinite(values)) and np.all(values == np.floor(values)):
+        return values.astype(np.int64)
+    return values
+
+
+def _is_whole(value):
+    '''
+    if value fits an int64 timestamp column without losing anything
+    '''
+    if isinstance(value, (int, np.integer)):
+        return True
+    value = float(value)
+    return bool(np.isfinite(value) and value == np.floor(value))
+
+
+class DeltaRecord(MutableMapping):
+    '''
+    A view of one row of a DeltaTable that behaves like the delta dict of delta_finder(): reading, setting
+    and updating keys reads and writes the table. It is pickled as a plain dict.
+    '''
+    __slots__ = ('table', 'row')
+
+    def __init__(self, table, row):
+        self.table = table
+        self.row = row
+
+    def __getitem__(self, key):
+        return self.table._get(self.row, key)
+
+    def __setitem__(self, key, value):
+        self.table._set(self.row, key, value)
+
+    def __delitem__(self, key):
+        self.table._delete(self.row, key)
+
+    def __iter__(self):
+        return iter(self.table._keys(self.row))
+
+    def __len__(self):
+        return len(self.table._keys(self.row))
+
+    def __repr__(self):
+        return repr(dict(self))
+
+    def __reduce__(self):
+        return (dict, (dict(self),))
+
+
+class DeltaTable:
+    '''
+    The day's deltas in columns instead of a list of dicts: float64 values and rates, int64 timestamps and
+    categorical dif_name (id is the same column) and direction_research. Keys added later, like position_id,
+    failed_position_id and group, are kept as extra object columns where a row may have no value.
+
+    Indexing and iterating give DeltaRecord views, so code written for the dict list (the sync functions,
+    DifMatchIndex, the plots) works unchanged. to_dataframe() builds the same frame as pd.DataFrame(dif_list)
+    without copying the typed columns.
+
+    ----------
+    parameters:
+    columns: dict
+        {column: array} of every column in DELTA_COLUMNS except id
+    '''
+    def __init__(self, columns):
+        self.columns = {}
+        n = len(columns["dif_name"])
+        for col in DELTA_COLUMNS:
+            if col == "id":
+                continue
+            values = columns[col]
+            if len(values) != n:
+                raise ValueError(f'column {col} has {len(values)} rows, expected {n}')
+            if col in CATEGORY_COLUMNS:
+                self.columns[col] = values if isinstance(values, pd.Categorical) else pd.Categorical(values)
+            elif col in TIMESTAMP_COLUMNS:
+                self.columns[col] = _timestamp_array(values)
+            else:
+                self.columns[col] = np.asarray(values, dtype=np.float64)
+        self.n = n
+        # {column: object array}, _MISSING where the row has no value
+        self.extra = {}
+        # {column: int64 array} when each row got the column, -1 where it has none. a dict keeps its keys in
+        # insertion order, this keeps the same order for every row
+        self.extra_order = {}
+        self.next_order = 0
+
+    @classmethod
+    def from_records(cls, dif_list):
+        '''
+        builds a table from a list of delta dicts, keys that are not in DELTA_COLUMNS become extra columns
+        '''
+        columns = {col: [dif[col] for dif in dif_list] for col in DELTA_COLUMNS if col != "id"}
+        table = cls(columns)
+        for row, dif in enumerate(dif_list):
+            for key, value in dif.items():
+                if key not in DELTA_COLUMNS:
+                    table._set(row, key, value)
+        return table
+
+    @classmethod
+    def concat(cls, tables):
+        '''
+        one table with the rows of all the tables, in order
+        '''
+        tables = list(tables)
+        if len(tables) == 0:
+            return cls({col: [] for col in DELTA_COLUMNS if col != "id"})
+        columns = {}
+        for col in DELTA_COLUMNS:
+            if col == "id":
+                continue
+            if col in CATEGORY_COLUMNS:
+                columns[col] = pd.api.types.union_categoricals([table.columns[col] for table in tables])
+            else:
+                columns[col] = np.concatenate([table.columns[col] for table in tables])
+        result = cls(columns)
+        # the rows of a later table got their extra columns after the rows of the earlier tables
+        offsets = np.cumsum([0] + [table.next_order for table in tables])
+        for col in dict.fromkeys(col for table in tables for col in table.extra):
+            values, order = [], []
+            for table, offset in zip(tables, offsets):
+                if col in table.extra:
+                    values.append(table.extra[col])
+                    order.append(np.where(table.extra_order[col] >= 0, table.extra_order[col] + offset, -1))
+                else:
+                    values.append(np.full(table.n, _MISSING, dtype=object))
+                    order.append(np.full(table.n, -1, dtype=np.int64))
+            result.extra[col] = np.concatenate(values)
+            result.extra_order[col] = np.concatenate(order)
+        result.next_order = int(offsets[-1])
+        return result
+
+    def take(self, rows):
+        '''
+        a new table with the rows (a boolean mask or indices), in order
+        '''
+        rows = np.asarray(rows)
+        rows = np.flatnonzero(rows) if rows.dtype == bool else rows.astype(np.int64)
+        result = type(self)({col: values[rows] for col, values in self.columns.items()})
+        for col in self.extra:
+            result.extra[col] = self.extra[col][rows]
+            result.extra_order[col] = self.extra_order[col][rows]
+        result.next_order = self.next_order
+        return result
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, row):
+        if row < 0:
+            row += self.n
+        if not 0 <= row < self.n:
+            raise IndexError('delta table index out of range')
+        return DeltaRecord(self, row)
+
+    def __iter__(self):
+        for row in range(self.n):
+            yield DeltaRecord(self, row)
+
+    def _get(self, row, key):
+        if key == "id":
+            key = "dif_name"
+        if key in self.columns:
+            value = self.columns[key][row]
+            return value.item() if isinstance(value, np.generic) else value
+        if key in self.extra:
+            value = self.extra[key][row]
+            if value is not _MISSING:
+                return value
+        raise KeyError(key)
+
+    def _set(self, row, key, value):
+        if key == "id":
+            raise KeyError('id is dif_name, set dif_name instead')
+        if key in CATEGORY_COLUMNS:
+            column = self.columns[key]
+            if value not in column.categories:
+                column = column.add_categories([value])
+                self.columns[key] = column
+            column[row] = value
+            return
+        if key in self.columns:
+            column = self.columns[key]
+            if column.dtype.kind == 'i' and not _is_whole(value):
+                # numpy would truncate it, like _timestamp_array() the column becomes float64 instead
+                column = column.astype(np.float64)
+                self.columns[key] = column
+            column[row] = value
+            return
+        self._add_extra(key)
+        if self.extra_order[key][row] < 0:
+            self.extra_order[key][row] = self.next_order
+            self.next_order += 1
+        self.extra[key][row] = value
+
+    def _add_extra(self, key):
+        if key not in self.extra:
+            self.extra[key] = np.full(self.n, _MISSING, dtype=object)
+            self.extra_order[key] = np.full(self.n, -1, dtype=np.int64)
+
+    def _delete(self, row, key):
+        if key not in self.extra or self.extra_order[key][row] < 0:
+            raise KeyError(key)
+        self.extra[key][row] = _MISSING
+        self.extra_order[key][row] = -1
+
+    def _keys(self, row):
+        extra = [key for key in self.extra if self.extra_order[key][row] >= 0]
+        extra.sort(key=lambda key: self.extra_order[key][row])
+        return DELTA_COLUMNS + extra
+
+    def set_rows(self, key, rows, value):
+        '''
+        sets an extra column on the rows (a boolean mask or indices) at once, the same as setting the key
+        on each of their dicts in row order
+        '''
+        if key in self.columns or key == "id":
+            raise KeyError(f'{key} is not an extra column')
+        self._add_extra(key)
+        rows = np.asarray(rows)
+        rows = np.flatnonzero(rows) if rows.dtype == bool else rows.astype(np.int64)
+        new_rows = rows[self.extra_order[key][rows] < 0]
+        self.extra_order[key][new_rows] = self.next_order + np.arange(len(new_rows))
+        self.next_order += len(new_rows)
+        self.extra[key][rows] = value
+
+    def has(self, key):
+        '''
+        boolean mask of the rows that have key
+        '''
+        if key in self.columns or key == "id":
+            return np.ones(self.n, dtype=bool)
+        if key not in self.extra:
+            return np.zeros(self.n, dtype=bool)
+        return self.extra_order[key] >= 0
+
+    def values(self, key):
+        '''
+        the column as an array, for an extra column an object array with None where a row has no value
+        '''
+        if key == "id":
+            key = "dif_name"
+        if key in self.columns:
+            return np.asarray(self.columns[key])
+        values = self.extra[key].copy()
+        values[self.extra_order[key] < 0] = None
+        return values
+
+    def extra_columns_order(self):
+        '''
+        the extra columns in the order pd.DataFrame(dif_list) puts them: going over the rows in order, each
+        row's keys in the order it got them
+        '''
+        if len(self.extra) == 0:
+            return []
+        names = list(self.extra)
+        order = np.stack([self.extra_order[key] for key in names], axis=1)
+        # every row's columns by the order it got them, -1 for the columns it doesn't have
+        ranked = np.argsort(np.where(order >= 0, order, np.iinfo(np.int64).max), axis=1, kind='stable')
+        present = np.take_along_axis(order >= 0, ranked, axis=1)
+        signature = np.where(present, ranked, -1)
+        # the union only changes at the first row of every signature
+        _, first_rows = np.unique(signature, axis=0, return_index=True)
+        columns = []
+        for row in np.sort(first_rows):
+            for name_index in signature[row]:
+                if name_index >= 0 and names[name_index] not in columns:
+                    columns.append(names[name_index])
+        return columns
+
+    def to_dataframe(self):
+        '''
+        the table as a DataFrame with the columns of pd.DataFrame(dif_list). The typed columns are not copied,
+        the extra columns get NaN where a row has no value
+        '''
+        data = {col: self.columns["dif_name" if col == "id" else col] for col in DELTA_COLUMNS}
+        for col in self.extra_columns_order():
+            values = self.extra[col].copy()
+            values[self.extra_order[col] < 0] = np.nan
+            data[col] = values
+        # copy=False keeps every array as its own block instead of consolidating (copying) them
+        return pd.DataFrame(data, index=pd.RangeIndex(self.n), copy=False)
+
+    @property
+    def nbytes(self):
+        '''
+        memory of the table in bytes, the strings of the categories and of the extra columns included
+        '''
+        total = 0
+        for col, values in self.columns.items():
+            if col in CATEGORY_COLUMNS:
+                total += values.codes.nbytes + sum(sys.getsizeof(name) for name in values.categories)
+            else:
+                total += values.nbytes
+        for col, values in self.extra.items():
+            total += values.nbytes + self.extra_order[col].nbytes
+            total += sum(sys.getsizeof(value) for value in {id(value): value for value in values if value is not _MISSING}.values())
+        return total
+
+
+def dif_list_nbytes(dif_list):
+    '''
+    memory of a list of delta dicts in bytes: the list, the dicts and their values, every object counted once
+    '''
+    seen = set()
+    total = sys.getsizeof(dif_list)
+    for dif in dif_list:
+        total += sys.getsizeof(dif)
+        for value in dif.values():
+            if id(value) not in seen:
+                seen.add(id(value))
+                total += sys.getsizeof(value)
+    return total
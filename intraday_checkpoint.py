@@ -0,0 +1,110 @@
+import os
+import json
+
+
+def _to_json(value):
+    # the book and the difs hold numpy numbers
+    return value.item()
+
+
+class IntradayCheckpoint:
+    '''
+    Saves how far an incremental run got on a date, so the next run on the same date only searches the
+    quotes that arrived since for deltas, and only renders the positions that were not graphed yet.
+    Every run still reads, cleans, flattens and merges all the day's quotes so far, and syncs and writes the
+    csv of all the day's difs: only the delta search and the rendering are incremental.
+
+    The state of a date, as load() returns it and save() takes it:
+    {
+        'groups': {group: {'brokers_book': dict, 'last_bbp_timestamp': int, 'dif_list': [difs]}},
+        'graphed_position_ids': [ids],
+    }
+    brokers_book is the book of delta_finder() after the last processed quote of the group, and dif_list
+    holds the group's difs as found, before they are synced with positions.
+
+    The difs are not kept in the checkpoint json, which is rewritten by every run, but appended to a json
+    lines file of the date: a run writes only the difs it found. The json keeps the books, the timestamps,
+    how many difs every group has and how long the difs file was, so difs appended by a run that failed
+    before saving its checkpoint are dropped.
+
+    ----------
+    parameters:
+    checkpoint_dir: str
+        directory where the checkpoints are saved
+    '''
+    def __init__(self, checkpoint_dir):
+        self.checkpoint_dir = checkpoint_dir
+        os.makedirs(checkpoint_dir, exist_ok=True)
+
+    def path(self, date):
+        '''
+        path of the checkpoint of a date {DD-MM-YYYY}
+        '''
+        return os.path.join(self.checkpoint_dir, f'{date}.checkpoint.json')
+
+    def difs_path(self, date):
+        '''
+        path of the difs of a date {DD-MM-YYYY}, one {'group': group, 'dif': dif} per line
+        '''
+        return os.path.join(self.checkpoint_dir, f'{date}.difs.jsonl')
+
+    def _load_index(self, date):
+        path = self.path(date)
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return json.load(f)
+
+    def load(self, date):
+        '''
+        returns the saved state of the date, or None if the date has no checkpoint
+        '''
+        index = self._load_index(date)
+        if index is None:
+            return None
+        dif_lists = {key: [] for key in index['groups']}
+        if index['difs_bytes'] > 0:
+            with open(self.difs_path(date), 'rb') as f:
+                lines = f.read(index['difs_bytes']).splitlines()
+            for line in lines:
+                record = json.loads(line)
+                dif_lists[record['group']].append(record['dif'])
+        state = {'groups': {}, 'graphed_position_ids': index['graphed_position_ids']}
+        for key, group_index in index['groups'].items():
+            state['groups'][key] = {
+                'brokers_book': group_index['brokers_book'],
+                'last_bbp_timestamp': group_index['last_bbp_timestamp'],
+                'dif_list': dif_lists[key],
+            }
+        print(f'loaded checkpoint of {date}')
+        return state
+
+    def save(self, date, state):
+        '''
+        saves the state of the date: appends the difs found since the saved checkpoint to the difs file, then
+        replaces the checkpoint json only once the new one is written
+        '''
+        previous = self._load_index(date)
+        difs_bytes = 0 if previous is None else previous['difs_bytes']
+        saved_counts = {} if previous is None else {key: group_index['dif_count'] for key, group_index in previous['groups'].items()}
+        with open(self.difs_path(date), 'ab') as f:
+            # drops what a failed run appended after the saved checkpoint
+            f.truncate(difs_bytes)
+            f.seek(difs_bytes)
+            for key, group_state in state['groups'].items():
+                for dif in group_state['dif_list'][saved_counts.get(key, 0):]:
+                    f.write((json.dumps({'group': key, 'dif': dif}, default=_to_json) + '\n').encode())
+            difs_bytes = f.tell()
+
+        index = {
+            'groups': {key: {'brokers_book': group_state['brokers_book'], 'last_bbp_timestamp': group_state['last_bbp_timestamp'], 'dif_count': len(group_state['dif_list'])}
+                       for key, group_state in state['groups'].items()},
+            'graphed_position_ids': state['graphed_position_ids'],
+            'difs_bytes': difs_bytes,
+        }
+        path = self.path(date)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(index, f, default=_to_json)
+        os.replace(tmp_path, path)
+        print(f'saved checkpoint of {date}')
@@ -0,0 +1,447 @@
+import io
+import os
+import sys
+import copy
+import json
+import time
+import argparse
+import resource
+import platform
+import tracemalloc
+from contextlib import redirect_stdout
+from datetime import datetime, timezone
+import numpy as np
+import pandas as pd
+from position_grapher import (BROKER_GROUPS, clean_file, filter_time_range, time_range_ms, create_flat_broker_dict, merge_broker_dict, find_deltas,
+                              sync_positions_and_difs, sync_signal_no_position_and_dif_list, sync_positions_and_difs_indexed,
+                              sync_signal_no_position_and_dif_list_indexed, DifMatchIndex, BookWindowIndex, render_position_html,
+                              create_delta_csv, normalize_broker_name, from_datetime)
+from delta_table import DeltaTable, dif_list_nbytes
+from quote_schema import QUOTE_CSV_OPTIONS, category_mask
+
+
+# named sizes of the synthetic market: hours of quotes from start_hour, and how many brokers of BROKER_GROUPS quote
+BENCHMARK_SIZES = {
+    '1h-3': {'hours': 1, 'brokers': 3},
+    '4h-10': {'hours': 4, 'brokers': 10},
+    'day-25': {'hours': 11, 'brokers': 25},
+}
+
+# the stages of create_delta_graphs_and_csv(), in the order they run
+BENCHMARK_STAGES = ['read_csv', 'filter_hours', 'clean_file', 'create_flat_broker_dict', 'merge_broker_dict', 'find_deltas',
+                    'sync_signal_no_position', 'sync_positions', 'position_plots', 'create_delta_csv']
+
+# the settings of delta_info_graphs_main() that change what the stages do
+BENCHMARK_CONFIG = {
+    'start_hour': 7,
+    'end_hour': 18,
+    'dif_threashold': -0.00001,
+    'ran_dif_ceiling': -0.0001,
+    'time_before_dif': 0.5,
+    'time_after_dif': 2,
+    'dif_engine': 'vectorized',
+    'merge_mode': 'aligned',
+    'sync_engine': 'indexed',
+    'delta_table': True,
+    'max_trace_points': 2000,
+    'render_mode': 'auto',
+    'rendered_positions': 10,
+}
+
+# the trading day of the synthetic quotes
+BENCHMARK_DATE = datetime(2022, 9, 12, tzinfo=timezone.utc)
+
+# the mid price moves on a grid of this many ms
+MID_STEP_MS = 100
+
+
+def benchmark_broker_groups(broker_count, broker_groups=BROKER_GROUPS):
+    '''
+    the first broker_count brokers of broker_groups, group after group in order, so the small sizes still have
+    whole groups (3 brokers is the NY group). groups left without brokers are dropped
+    '''
+    groups = {}
+    left = broker_count
+    for key, brokers in broker_groups.items():
+        if left <= 0:
+            break
+        groups[key] = list(brokers[:left])
+        left -= len(groups[key])
+    if left > 0:
+        raise ValueError(f'broker_groups has only {broker_count - left} brokers, {broker_count} requested')
+    return groups
+
+
+def generate_quotes(broker_groups, hours, seed, start_hour=7, updates_per_second=1.0, levels=3, undefined_share=0.005, day=BENCHMARK_DATE):
+    '''
+    a synthetic merged_raw_data for the brokers of broker_groups, the same seed always gives the same quotes.
+
+    All brokers quote one mid price that moves in small steps and now and then jumps a few pips. Every broker
+    sees the mid with its own latency and quotes around it with its own spread, at random times. A broker that
+    hasn't quoted since a jump still shows the old price, so the jumps make deltas between brokers, like the
+    real market does.
+
+    Every update of a broker is a bid and an offer row for each level, with the same bbp_timestamp. A share
+    of the rates is missing, they are NaN here and 'undefined' in the csv (see quotes_csv()).
+
+    ----------
+    parameters:
+    hours: float
+        length of the quotes, from start_hour
+    seed: int
+        seed of the generator
+    updates_per_second: float
+        average updates per second of every broker
+    levels: int
+        depth of every update, level 0 is the best price
+    undefined_share: float
+        share of the rows with an 'undefined' rate
+    '''
+    rng = np.random.default_rng(seed)
+    brokers = [broker_name for key in broker_groups for broker_name in broker_groups[key]]
+    start_ms = int(day.timestamp() * 1000) + start_hour * 3600000
+    span_ms = int(hours * 3600000)
+
+    steps = span_ms // MID_STEP_MS + 1
+    moves = rng.normal(0, 2e-6, steps)
+    jumps = rng.random(steps) < 0.002
+    moves[jumps] += rng.choice([-1, 1], jumps.sum()) * rng.uniform(2e-5, 6e-5, jumps.sum())
+    mid = 1.0 + np.cumsum(moves)
+
+    broker_columns = []
+    for broker_name in brokers:
+        updates = rng.poisson(updates_per_second * span_ms / 1000)
+        bbp_timestamp = np.sort(start_ms + rng.integers(0, span_ms, updates))
+        latency = rng.integers(0, 300)
+        half_spread = rng.uniform(0.5e-5, 1.5e-5)
+        seen_mid = mid[np.clip((bbp_timestamp - latency - start_ms) // MID_STEP_MS, 0, steps - 1)]
+        seen_mid = seen_mid + rng.normal(0, 3e-6, updates)
+        original_timestamp = bbp_timestamp - latency - rng.integers(0, 50, updates)
+        for level in range(levels):
+            # a deeper level is a worse price for a bigger size
+            size = rng.choice([1e6, 2e6, 3e6, 5e6], updates) * (level + 1)
+            for quote_type, sign in [('bid', -1), ('offer', 1)]:
+                broker_columns.append({
+                    'broker_name': np.full(updates, broker_name, dtype=object),
+                    'type': np.full(updates, quote_type, dtype=object),
+                    'rate': np.round(seen_mid + sign * (half_spread + level * 1e-5), 5),
+                    'size': size,
+                    'bbp_timestamp': bbp_timestamp,
+                    'original_timestamp': original_timestamp,
+                    'level': np.full(updates, level),
+                })
+
+    columns = {col: np.concatenate([broker[col] for broker in broker_columns]) for col in broker_columns[0]}
+    # merged_raw_data is in bbp_timestamp order, the rows of an update stay together
+    order = np.argsort(columns['bbp_timestamp'], kind='stable')
+    file = pd.DataFrame({col: values[order] for col, values in columns.items()})
+    file.insert(0, 'timestamp', file['bbp_timestamp'] + rng.integers(0, 5, len(file)))
+    file.loc[rng.random(len(file)) < undefined_share, 'rate'] = np.nan
+    return file
+
+
+def quotes_csv(file):
+    '''
+    the quotes of generate_quotes() as the bytes of merged_raw_data.csv, missing rates written as 'undefined'
+    '''
+    return file.to_csv(index=False, na_rep='undefined').encode()
+
+
+def generate_position_docs(dif_list, seed, positions=20, failed_signals=20, mismatch_share=0.1):
+    '''
+    positions and failed signals like the ones in mongo, each made from a random dif of dif_list so the sync
+    functions find it. A mismatch_share of them is moved 1 ms off their dif, like a position that has no dif.
+
+    positions have broker_pairs with the rate collector names and failed signals with the mongo names, see
+    normalize_broker_name(). returns (position_list, signal_no_position)
+    '''
+    rng = np.random.default_rng(seed)
+    # a position is a buy or a sell, difs without a direction never match one
+    candidates = [dif for dif in dif_list if dif['direction_research'] != 'none']
+    picks = rng.choice(len(candidates), min(positions + failed_signals, len(candidates)), replace=False) if candidates else []
+
+    def to_datetime(ts):
+        return pd.to_datetime(ts, unit='ms').to_pydatetime()
+
+    position_list = []
+    signal_no_position = []
+    for doc_index, pick in enumerate(picks):
+        dif = candidates[pick]
+        offer_broker, bid_broker = dif['dif_name'].split('-')
+        ts = int(dif['dif_bbp_timestamp'])
+        if rng.random() < mismatch_share:
+            ts += 1
+        if doc_index < positions:
+            enter_price = dif['offer_rate'] if dif['direction_research'] == 'buy' else dif['bid_rate']
+            exit_price = dif['bid_rate'] if dif['direction_research'] == 'buy' else dif['offer_rate']
+            revenue_pips = round((exit_price - enter_price) * (1 if dif['direction_research'] == 'buy' else -1), 7)
+            position_list.append({
+                '_id': f'{seed:08x}{doc_index:016x}',
+                'dif_bbp_timestamp': ts,
+                'dif_ids': [],
+                'direction': dif['direction_research'],
+                'broker_pairs': [[offer_broker, bid_broker]],
+                'enter_broker': offer_broker if dif['direction_research'] == 'buy' else bid_broker,
+                'exit_broker': bid_broker if dif['direction_research'] == 'buy' else offer_broker,
+                'initiating_broker': bid_broker if dif['direction_research'] == 'buy' else offer_broker,
+                'enter_order_request_timestamp': to_datetime(ts + 5),
+                'enter_order_time': to_datetime(ts + int(rng.integers(20, 200))),
+                'exit_order_request_timestamp': to_datetime(ts + int(rng.integers(1000, 30000))),
+                'exit_order_time': to_datetime(ts + int(rng.integers(30000, 60000))),
+                'enter_order_requested_price': enter_price,
+                'enter_order_executed_price': enter_price,
+                'exit_order_requested_price': exit_price,
+                'exit_order_executed_price': round(exit_price + float(rng.choice([-1e-5, 0, 1e-5])), 5),
+                'enter_order_executed_size': 1e6,
+                'signal_difs': [{'brokers': [offer_broker, bid_broker], 'size': 1e6, 'initiating_broker': bid_broker, 'bbp_timestamp': ts}],
+                'revenue_pips': revenue_pips,
+                'revenue': round(revenue_pips * 1e6, 2),
+                'internal_latency': int(rng.integers(1, 10)),
+                'enter_trade_id': f'enter-{doc_index}',
+                'exit_trade_id': f'exit-{doc_index}',
+            })
+        else:
+            signal_no_position.append({
+                '_id': f'{seed:08x}{doc_index:016x}',
+                'dif_bbp_timestamp': ts,
+                'dif_ids': [],
+                'datetime': to_datetime(ts),
+                'broker_pairs': [[normalize_broker_name(offer_broker), normalize_broker_name(bid_broker)]],
+            })
+    return position_list, signal_no_position
+
+
+class BenchmarkHandler:
+    '''
+    an aws_handler that keeps only the size of every file, a csv is still written (to memory) so its cost is measured
+    '''
+    def __init__(self):
+        self.saved_bytes = 0
+
+    def save_html_file_in_bucket(self, working_date, html_string, file_name_to_save, bucket_name):
+        self.saved_bytes += len(html_string.encode())
+
+    def save_file_in_bucket(self, working_date, df_to_save, file_name_to_save, bucket_name):
+        self.saved_bytes += len(df_to_save.to_csv(index=False).encode())
+
+
+def _run_stage(stages, name, trace_memory, func, *args, **kwargs):
+    '''
+    runs func and adds its seconds, or with trace_memory its peak of newly allocated bytes, to stages[name]
+    '''
+    if trace_memory:
+        tracemalloc.reset_peak()
+        start_bytes = tracemalloc.get_traced_memory()[0]
+    tic = time.perf_counter()
+    result = func(*args, **kwargs)
+    seconds = time.perf_counter() - tic
+    stage = stages.setdefault(name, {})
+    if trace_memory:
+        stage['peak_bytes'] = tracemalloc.get_traced_memory()[1] - start_bytes
+    else:
+        stage['seconds'] = seconds
+    return result
+
+
+def _run_pipeline(csv_bytes, broker_groups, position_list, signal_no_position, config, stages, trace_memory):
+    '''
+    one run of the stages of create_delta_graphs_and_csv() on the synthetic day, their stats are added to stages.
+    returns the counts of quotes, difs and matched docs
+    '''
+    position_list = copy.deepcopy(position_list)
+    signal_no_position = copy.deepcopy(signal_no_position)
+    working_date = from_datetime(BENCHMARK_DATE)
+
+    file = _run_stage(stages, 'read_csv', trace_memory, pd.read_csv, io.BytesIO(csv_bytes), **QUOTE_CSV_OPTIONS)
+    time_range = time_range_ms(working_date, config['start_hour'], config['end_hour'])
+    file = _run_stage(stages, 'filter_hours', trace_memory, filter_time_range, file, time_range)
+    file = _run_stage(stages, 'clean_file', trace_memory, clean_file, file)
+    brokers = np.asarray(file.broker_name.unique())
+    brokers_dict = _run_stage(stages, 'create_flat_broker_dict', trace_memory, create_flat_broker_dict, file=file, brokers=brokers)
+    merged = _run_stage(stages, 'merge_broker_dict', trace_memory, merge_broker_dict, brokers_dict, mode=config['merge_mode'])
+
+    def find_all_deltas():
+        group_dif_lists = []
+        for key in broker_groups.keys():
+            broker_filtered_df = file[category_mask(file['broker_name'], broker_groups[key])]
+            group_dif_lists.append(find_deltas(broker_groups[key], broker_filtered_df, config['dif_threashold'], engine=config['dif_engine'], as_table=config['delta_table']))
+        if config['delta_table']:
+            return DeltaTable.concat(group_dif_lists)
+        return [dif for group_dif_list in group_dif_lists for dif in group_dif_list]
+    dif_list = _run_stage(stages, 'find_deltas', trace_memory, find_all_deltas)
+
+    if config['sync_engine'] == 'indexed':
+        def sync_failed():
+            dif_index = DifMatchIndex(dif_list, broker_groups['NY'])
+            sync_signal_no_position_and_dif_list_indexed(signal_no_position, dif_list, broker_groups=broker_groups, dif_index=dif_index)
+            return dif_index
+        dif_index = _run_stage(stages, 'sync_signal_no_position', trace_memory, sync_failed)
+        _run_stage(stages, 'sync_positions', trace_memory, sync_positions_and_difs_indexed, position_list, dif_list, config['time_before_dif'], config['time_after_dif'], broker_groups=broker_groups, dif_index=dif_index)
+    else:
+        _run_stage(stages, 'sync_signal_no_position', trace_memory, sync_signal_no_position_and_dif_list, signal_no_position, dif_list, broker_groups=broker_groups)
+        _run_stage(stages, 'sync_positions', trace_memory, sync_positions_and_difs, position_list, dif_list, config['time_before_dif'], config['time_after_dif'], broker_groups=broker_groups)
+
+    positions_with_difs = [pos for pos in position_list if len(pos['dif_ids']) > 0][:config['rendered_positions']]
+    def render_positions():
+        window_index = BookWindowIndex(brokers_dict, merged)
+        # the pages reference a shared plotly.js, like html_output='shared_js'
+        return [render_position_html(pos, brokers, brokers_dict, merged, broker_groups, config['time_before_dif'], config['time_after_dif'], False,
+                                     window_index=window_index, max_trace_points=config['max_trace_points'], include_plotlyjs='../assets/plotly.min.js',
+                                     render_mode=config['render_mode']) for pos in positions_with_difs]
+    _run_stage(stages, 'position_plots', trace_memory, render_positions)
+
+    handler = BenchmarkHandler()
+    _run_stage(stages, 'create_delta_csv', trace_memory, create_delta_csv, dif_list=dif_list, working_date=working_date, aws_handler=handler, broker_groups=broker_groups, ran_dif_ceiling=config['ran_dif_ceiling'])
+
+    # memory of the synced difs both ways, whichever the pipeline kept them in
+    if config['delta_table']:
+        dif_table_bytes = dif_list.nbytes
+        dif_list_bytes = dif_list_nbytes([dict(dif) for dif in dif_list])
+    else:
+        dif_table_bytes = DeltaTable.from_records(dif_list).nbytes
+        dif_list_bytes = dif_list_nbytes(dif_list)
+
+    counts = {
+        'quotes': len(file),
+        # memory of the cleaned quotes, strings included
+        'quote_bytes': int(file.memory_usage(deep=True).sum()),
+        'difs': len(dif_list),
+        'dif_table_bytes': dif_table_bytes,
+        'dif_list_bytes': dif_list_bytes,
+        'positions_with_difs': sum(len(pos['dif_ids']) > 0 for pos in position_list),
+        'failed_signals_with_difs': sum(len(failed_position['dif_ids']) > 0 for failed_position in signal_no_position),
+        'rendered_positions': len(positions_with_difs),
+        'csv_bytes': handler.saved_bytes,
+    }
+    return counts
+
+
+def run_benchmark(size, seed=0, measure_memory=True, updates_per_second=1.0, levels=3, positions=20, failed_signals=20, **config):
+    '''
+    generates the synthetic day of a size of BENCHMARK_SIZES with the seed, runs every stage on it and returns
+    {'size', 'seed', 'config', 'counts', 'stages': {stage: {'seconds', 'peak_bytes'}}, 'max_rss_bytes'}
+
+    The stages run once to time them and, with measure_memory, a second time under tracemalloc to measure the
+    peak memory each one allocates (tracemalloc slows the code down, so the times come from the first run).
+    The prints of the stages are silenced.
+
+    ----------
+    parameters:
+    size: str
+        a key of BENCHMARK_SIZES
+    updates_per_second, levels:
+        see generate_quotes()
+    positions, failed_signals:
+        see generate_position_docs()
+    config:
+        overrides BENCHMARK_CONFIG, e.g. dif_engine='rows' or sync_engine='scan'
+    '''
+    if size not in BENCHMARK_SIZES:
+        raise ValueError(f'unknown benchmark size {size}, choose one of {list(BENCHMARK_SIZES)}')
+    unknown = set(config) - set(BENCHMARK_CONFIG)
+    if unknown:
+        raise ValueError(f'unknown benchmark settings {sorted(unknown)}')
+    config = {**BENCHMARK_CONFIG, **config}
+    broker_groups = benchmark_broker_groups(BENCHMARK_SIZES[size]['brokers'])
+
+    tic = time.perf_counter()
+    quotes = generate_quotes(broker_groups, BENCHMARK_SIZES[size]['hours'], seed, start_hour=config['start_hour'], updates_per_second=updates_per_second, levels=levels)
+    csv_bytes = quotes_csv(quotes)
+    # the docs are made from the difs of the rows the pipeline keeps, found once with the vectorized engine
+    file = clean_file(quotes.dropna(subset=['rate']))
+    dif_list = []
+    for key in broker_groups.keys():
+        dif_list += find_deltas(broker_groups[key], file[file['broker_name'].isin(broker_groups[key])], config['dif_threashold'], engine='vectorized')
+    position_list, signal_no_position = generate_position_docs(dif_list, seed, positions=positions, failed_signals=failed_signals)
+    del quotes, file, dif_list
+    print(f'generated {size} (seed {seed}): {len(csv_bytes) / 1024**2:0.1f} MB of quotes in {time.perf_counter() - tic:0.2f}s')
+
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        stages = {}
+        counts = _run_pipeline(csv_bytes, broker_groups, position_list, signal_no_position, config, stages, trace_memory=False)
+        if measure_memory:
+            tracemalloc.start()
+            try:
+                _run_pipeline(csv_bytes, broker_groups, position_list, signal_no_position, config, stages, trace_memory=True)
+            finally:
+                tracemalloc.stop()
+
+    for name in stages:
+        print(f"{size} {name}: {stages[name]['seconds']:0.4f}s" + (f", peak {stages[name]['peak_bytes'] / 1024**2:0.1f} MB" if measure_memory else ''))
+    print(f"{size} {counts['difs']} difs: {counts['dif_table_bytes'] / 1024**2:0.2f} MB as a DeltaTable, {counts['dif_list_bytes'] / 1024**2:0.2f} MB as dicts")
+    return {
+        'size': size,
+        'seed': seed,
+        'hours': BENCHMARK_SIZES[size]['hours'],
+        'broker_groups': broker_groups,
+        'updates_per_second': updates_per_second,
+        'levels': levels,
+        'config': config,
+        'counts': counts,
+        'stages': stages,
+        # ru_maxrss is in KB on linux, it is the peak of the whole process so far
+        'max_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+    }
+
+
+def run_benchmarks(sizes, output_path, seed=0, **kwargs):
+    '''
+    runs run_benchmark() for every size and saves the results, with the versions they ran with, as json at output_path
+    '''
+    results = {
+        'created': datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'numpy': np.__version__,
+        'results': [run_benchmark(size, seed=seed, **kwargs) for size in sizes],
+    }
+    with open(output_path, 'w') as f:
+        json.dump(results, f, indent=2, default=lambda value: value.item())
+    print(f'saved benchmark results to {output_path}')
+    return results
+
+
+def compare_benchmarks(before_path, after_path):
+    '''
+    prints the seconds and peak memory of every stage of two saved runs, side by side, for the sizes (and seeds)
+    both ran. returns {(size, seed): {stage: after seconds / before seconds}}
+    '''
+    with open(before_path) as f:
+        before = {(result['size'], result['seed']): result for result in json.load(f)['results']}
+    with open(after_path) as f:
+        after = {(result['size'], result['seed']): result for result in json.load(f)['results']}
+    ratios = {}
+    for key in before:
+        if key not in after:
+            continue
+        ratios[key] = {}
+        print(f'{key[0]} (seed {key[1]})')
+        for name in BENCHMARK_STAGES:
+            old, new = before[key]['stages'].get(name), after[key]['stages'].get(name)
+            if old is None or new is None:
+                continue
+            ratios[key][name] = new['seconds'] / old['seconds'] if old['seconds'] > 0 else float('nan')
+            line = f"  {name:<24} {old['seconds']:>9.4f}s -> {new['seconds']:>9.4f}s ({ratios[key][name]:0.2f}x)"
+            if 'peak_bytes' in old and 'peak_bytes' in new:
+                line += f"  {old['peak_bytes'] / 1024**2:>8.1f} MB -> {new['peak_bytes'] / 1024**2:>8.1f} MB"
+            print(line)
+        for name in ['dif_table_bytes', 'dif_list_bytes']:
+            old, new = before[key]['counts'].get(name), after[key]['counts'].get(name)
+            if old is not None and new is not None:
+                print(f"  {name:<24} {old / 1024**2:>8.2f} MB -> {new / 1024**2:>8.2f} MB")
+    return ratios
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='times every stage of position_grapher on a seeded synthetic market')
+    parser.add_argument('--sizes', nargs='+', default=['1h-3'], choices=list(BENCHMARK_SIZES))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=f'pipeline_benchmark_{datetime.now().strftime("%Y%m%d_%H%M%S")}.json')
+    parser.add_argument('--updates-per-second', type=float, default=1.0)
+    parser.add_argument('--no-memory', action='store_true', help='skip the tracemalloc run')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'), help='compare two saved runs instead of running')
+    args = parser.parse_args()
+    if args.compare:
+        compare_benchmarks(*args.compare)
+        sys.exit(0)
+    run_benchmarks(args.sizes, args.output, seed=args.seed, measure_memory=not args.no_memory, updates_per_second=args.updates_per_second)
@@ -5,25 +5,85 @@ import plotly.graph_objs as G
 from plotly.subplots import make_subplots
 import plotly
 import common_utils.mongo_utils as mongo_utils
-import boto3
 import os
 import io
 import time
-from common_utils.aws_tools import AWSHandler
+import calendar
+import json
+import gzip
+import html
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 from common_utils.constant import  MERGED_RAW_DATA_FILE_NAME, AWS_S3_BUCKET_NAME
 from research_utils.dif_finder import delta_finder
-
+from day_cache import DayCache
+from background_uploader import BackgroundUploader, put_bytes_in_bucket, upload_name
+from intraday_checkpoint import IntradayCheckpoint
+from streaming_delta_finder import StreamingDeltaFinder, iter_quotes, new_broker_book
+from delta_table import DeltaTable
+from stage_metrics import StageMetrics, measure_stage, measure_iter
+from storage_backends import S3Storage, PrefetchingStorage
+from position_sources import MongoPositionSource, PrefetchingPositionSource
+from quote_schema import QUOTE_CSV_OPTIONS, MISSING_RATE, apply_quote_schema, concat_quotes, category_codes, category_mask
+
+
+# the columns of merged_raw_data that are used by the later stages
+QUOTE_COLUMNS = ["timestamp", "broker_name", "type", "rate", "size", "bbp_timestamp", "original_timestamp", "level"]
+# rows per chunk when streaming merged_raw_data from S3
+QUOTES_CHUNK_SIZE = 500000
+# an hour of bbp_timestamp, which is in ms
+HOUR_MS = 3600000
+# the brokers of the rate collector, by the group their deltas are searched in
+BROKER_GROUPS={
+    'NY':['BROKER_NY_A', 'BROKER_NY_B', 'BROKER_NY_C'],
+    'LONDON':[f'BROKER_LONDON{i+1}' for i in range(21) if i != 13]
+    ,'OTHER':['PARIS', 'BERLIN', 'BARCELONA']
+}
 
 def clean_file(file):
-    file = file[file['rate'] != 'undefined']
-    file = file.astype({'rate':'float'})
+    '''
+    drops the quotes without a rate and gives the rest the types of QUOTE_SCHEMA. read with QUOTE_CSV_OPTIONS
+    the missing rates are already NaN, otherwise they are the string MISSING_RATE
+    '''
+    if file['rate'].dtype == object:
+        file = file[file['rate'] != MISSING_RATE]
+        file = file.astype({'rate':'float'})
+    file = file[file['rate'].notna()]
 
-    return file
+    return apply_quote_schema(file)
+
+def filter_hours(file, start_hour, end_hour):
+    '''
+    keeps only the quotes with a bbp_timestamp between start_hour (included) and end_hour (excluded), UTC,
+    of any day. see filter_time_range() for the hours of one date
+    '''
+    # the hour of a ms timestamp, without making datetimes of the column
+    hours = (file["bbp_timestamp"].to_numpy() // HOUR_MS) % 24
+    return file.loc[(hours >= start_hour) & (hours < end_hour)]
+
+def time_range_ms(working_date, start_hour, end_hour):
+    '''
+    returns (start, end), the bbp_timestamp bounds in ms of the hours start_hour (included) to end_hour (excluded)
+    of the date {DD-MM-YYYY}, UTC. worked out once per date, the quotes are then filtered by comparing integers
+    '''
+    day_ms = calendar.timegm(datetime.strptime(working_date, '%d-%m-%Y').timetuple()) * 1000
+    return day_ms + start_hour * HOUR_MS, day_ms + end_hour * HOUR_MS
+
+def filter_time_range(file, time_range):
+    '''
+    keeps only the quotes with a bbp_timestamp in time_range, (start, end) in ms with the end excluded.
+    None keeps them all
+    '''
+    if time_range is None:
+        return file
+    timestamps = file["bbp_timestamp"].to_numpy()
+    return file.loc[(timestamps >= time_range[0]) & (timestamps < time_range[1])]
 
 def create_flat_broker_dict(file,brokers):
     '''
     This function will take a file and return a dictionary that contains a flat df-
     for each broker, where a row contains its current bid, offer and price. 
+    All brokers are built in one pass: the level 0 bids and offers are matched in a single merge
+    on broker_name and bbp_timestamp, padded per broker and only then split into the dict.
 
     parameters:
     file: pandas dataframe
@@ -38,44 +98,37 @@ def create_flat_broker_dict(file,brokers):
     keep_columns = ["timestamp", "broker_name", "type", "rate", "size", "bbp_timestamp", "level"]
     file = file[keep_columns] 
 
-    file.sort_values(by=["bbp_timestamp"], inplace=True)
-
-    #create a datetime column
-    '''file['datetime'] = pd.to_datetime(file.bbp_timestamp, unit='ms')'''
+    file = file.sort_values(by=["bbp_timestamp"])
 
     # TODO: merge on BBP timestamp, add datetime later
 
-    '''file = file.loc[(file["datetime"].dt.hour >= start_hour) & (file["datetime"].dt.hour < end_hour)]'''
+    #create offers & bids df of level 0 of all selected brokers, leave bbp ts, merge on that
+    book = file.loc[(file['level'].to_numpy() == 0) & category_mask(file['broker_name'], brokers)]
+    offers = book.loc[category_mask(book['type'], ['offer']), ['broker_name', 'rate', 'size', 'bbp_timestamp']]
+    bids = book.loc[category_mask(book['type'], ['bid']), ['broker_name', 'rate', 'size', 'bbp_timestamp']]
 
-    for broker in brokers:
-        #create offers & bids df of level 0 of selected broker, leave bbp ts, merge on that
-        offers = file.loc[(file['broker_name'] == broker) & (file['level'] == 0 ) & (file['type'] == 'offer')]
-        bids = file.loc[(file['broker_name'] == broker) & (file['level'] == 0 ) & (file['type'] == 'bid')]
+    merged_book = pd.merge(bids, offers, on=['broker_name', 'bbp_timestamp'], suffixes=('_bid', '_offer'))
+    pad_columns = ['rate_bid', 'size_bid', 'rate_offer', 'size_offer']
+    merged_book[pad_columns] = merged_book.groupby('broker_name', sort=False, observed=True)[pad_columns].ffill()
 
-        offers = offers.drop(columns = [ 'type','level','timestamp','broker_name'])
-        bids = bids.drop(columns = ['type','level','timestamp','broker_name'])
-        
-        offers = offers.rename(columns={'rate': f'{broker}_offer'})
-        offers = offers.rename(columns={'size': f'{broker}_offer_size'})
-
-        bids = bids.rename(columns={'rate': f'{broker}_bid'})
-        bids = bids.rename(columns={'size': f'{broker}_bid_size'})
-
-        merged_book = pd.merge(bids, offers,on=['bbp_timestamp'],suffixes=('_bid','_offer'))
-        #merged_book.drop(columns=['broker_name_y'],inplace=True)
-        #merged_book['broker_name'] = broker
-        merged_book[f'{broker}_offer'].fillna(method='pad',inplace=True)
-        merged_book[f'{broker}_bid'].fillna(method='pad',inplace=True)
-        merged_book[f'{broker}_offer_size'].fillna(method='pad',inplace=True)
-        merged_book[f'{broker}_bid_size'].fillna(method='pad',inplace=True)
-
-        merged_book['datetime'] = pd.to_datetime(merged_book.bbp_timestamp, unit='ms')
-        merged_book =merged_book.set_index('datetime')
+    merged_book['datetime'] = pd.to_datetime(merged_book.bbp_timestamp, unit='ms')
+    merged_book = merged_book.set_index('datetime')
+
+    broker_books = dict(tuple(merged_book.groupby('broker_name', sort=False, observed=True)))
+    for broker in brokers:
+        broker_book = broker_books.get(broker, merged_book.iloc[:0])
+        broker_book = broker_book[['rate_bid', 'size_bid', 'bbp_timestamp', 'rate_offer', 'size_offer']]
+        broker_book = broker_book.rename(columns={
+            'rate_bid': f'{broker}_bid',
+            'size_bid': f'{broker}_bid_size',
+            'rate_offer': f'{broker}_offer',
+            'size_offer': f'{broker}_offer_size',
+        })
         #merged_book['price'] = (merged_book['offer'] + merged_book['bid']) / 2
-        df_dict[broker] = merged_book
+        df_dict[broker] = broker_book
     return df_dict
 
-def merge_broker_dict(broker_dict):
+def merge_broker_dict(broker_dict, mode='chained', best_prices=False):
     '''
     This function will take the broker dict from create_flat_broker_dict() and 
     make one unified flat df out of it, and add best offer and best bid columns
@@ -84,13 +137,22 @@ def merge_broker_dict(broker_dict):
     parameters:
     broker_dict: dict
         dict from create_flat_broker_dict(), containing a flat dataframe for each broker
+    mode: str
+        'chained' merges the brokers one by one with outer merges.
+        'aligned' builds the union timeline of all bbp_timestamps at once, see merge_broker_dict_aligned()
+    best_prices: bool
+        if to add best_offer, best_offer_broker, best_bid and best_bid_broker columns ('aligned' mode only)
     '''
+    if mode == 'aligned':
+        return merge_broker_dict_aligned(broker_dict, best_prices=best_prices)
+    if mode != 'chained':
+        raise ValueError(f'unknown merge mode {mode}, choose chained or aligned')
+
     brokers = list(broker_dict.keys())
     cols = ['bbp_timestamp']
     bid_cols = []
     offer_cols = []
     for broker in brokers:
-        print(f'{brokers.index(broker)} / {len(brokers)}')
         cols+=[f'{broker}_bid',f'{broker}_offer',f'{broker}_bid_size',f'{broker}_offer_size']
         bid_cols.append(f'{broker}_bid')
         offer_cols.append(f'{broker}_offer')
@@ -115,7 +177,56 @@ def merge_broker_dict(broker_dict):
         out_df.pad(axis=0,inplace=True)
     return out_df
 
-def delta_finder(delta_brokers, raw_df, delta_threshold):
+def merge_broker_dict_aligned(broker_dict, best_prices=False):
+    '''
+    Same wide book as merge_broker_dict(), built without chained merges: the union of all bbp_timestamps is
+    computed once, every broker's columns are placed on it and the whole frame is padded once.
+    There is one row per bbp_timestamp, holding the book after the last quote of that timestamp
+    (the chained outer merges repeat a timestamp for every combination of quotes that share it).
+
+    ----------
+    parameters:
+    broker_dict: dict
+        dict from create_flat_broker_dict(), containing a flat dataframe for each broker
+    best_prices: bool
+        if to add best_offer, best_offer_broker, best_bid and best_bid_broker columns
+    '''
+    brokers = list(broker_dict.keys())
+    cols = []
+    for broker in brokers:
+        cols+=[f'{broker}_bid',f'{broker}_offer',f'{broker}_bid_size',f'{broker}_offer_size']
+
+    timeline = np.unique(np.concatenate([broker_dict[broker]['bbp_timestamp'].to_numpy() for broker in brokers]))
+    values = np.full((len(timeline), len(cols)), np.nan)
+    for i, broker in enumerate(brokers):
+        broker_df = broker_dict[broker]
+        broker_ts = broker_df['bbp_timestamp'].to_numpy()
+        # keep the last quote of each bbp_timestamp
+        last = np.ones(len(broker_ts), dtype=bool)
+        last[:-1] = broker_ts[1:] != broker_ts[:-1]
+        rows = np.searchsorted(timeline, broker_ts[last])
+        values[rows, 4*i:4*i+4] = broker_df[cols[4*i:4*i+4]].to_numpy(dtype=float)[last]
+
+    out_df = pd.DataFrame(values, columns=cols)
+    out_df.ffill(inplace=True)
+    out_df.insert(0, 'bbp_timestamp', timeline)
+
+    if best_prices:
+        offers = out_df[[f'{broker}_offer' for broker in brokers]].to_numpy()
+        bids = out_df[[f'{broker}_bid' for broker in brokers]].to_numpy()
+        has_offer = ~np.isnan(offers).all(axis=1)
+        has_bid = ~np.isnan(bids).all(axis=1)
+        best_offer_index = np.argmin(np.where(np.isnan(offers), np.inf, offers), axis=1)
+        best_bid_index = np.argmax(np.where(np.isnan(bids), -np.inf, bids), axis=1)
+        broker_names = np.array(brokers, dtype=object)
+
+        out_df['best_offer'] = np.where(has_offer, offers[np.arange(len(out_df)), best_offer_index], np.nan)
+        out_df['best_offer_broker'] = np.where(has_offer, broker_names[best_offer_index], None)
+        out_df['best_bid'] = np.where(has_bid, bids[np.arange(len(out_df)), best_bid_index], np.nan)
+        out_df['best_bid_broker'] = np.where(has_bid, broker_names[best_bid_index], None)
+    return out_df
+
+def delta_finder(delta_brokers, raw_df, delta_threshold, brokers_book=None):
     """
     Find delta opportunities in the raw dataframe based on the delta threshold and the delta brokers
 
@@ -126,31 +237,26 @@ def delta_finder(delta_brokers, raw_df, delta_threshold):
         the data frame of merged_raw_data
     delta_brokers: array
         the list of relevant brokers
+    brokers_book: dict or None
+        the book to start from, e.g. the book of an earlier run on the quotes before raw_df.
+        it is updated in place, so after the call it holds the book at the last quote
     """
 
     print('starting to find difs')
-    brokers_book = {}
+    if brokers_book is None:
+        brokers_book = {}
     delta_list = []
     delta_id_counter = 0
 
     # initilize the book
     for broker_name in delta_brokers:
-        brokers_book[broker_name] = {}
-        brokers_book[broker_name]["bid"] = 0
-        brokers_book[broker_name]["bid_size"] = 0
-
-        brokers_book[broker_name]["offer"] = 0
-        brokers_book[broker_name]["offer_size"] = 0
-
-        brokers_book[broker_name]["bbp_timestamp"] = 0
-        brokers_book[broker_name]["original_timestamp"] = 0
-
-        brokers_book[broker_name]["offer_bbp_timestamp_last_change"] = 0
-        brokers_book[broker_name]["bid_bbp_timestamp_last_change"] = 0
+        if broker_name not in brokers_book:
+            brokers_book[broker_name] = new_broker_book()
 
    # keep row where the broker_name is in delta_brokers and lewvel 0 only
-    main_df = raw_df[(raw_df["level"] == 0) & (
-        raw_df["broker_name"].isin(delta_brokers))]
+    main_df = raw_df[(raw_df["level"].to_numpy() == 0) & category_mask(raw_df["broker_name"], delta_brokers)]
+    # iterrows() turns every row into python values, strings are cheaper to hand out than categoricals
+    main_df = main_df.astype({col: object for col in ["broker_name", "type"] if isinstance(main_df[col].dtype, pd.CategoricalDtype)})
     
     for bbp_timestamp, group in main_df.groupby("bbp_timestamp"):
        # loop over each row in the group
@@ -262,7 +368,639 @@ def delta_finder(delta_brokers, raw_df, delta_threshold):
                                 print(e)
     return delta_list
 
-def position_plots(difs, position, brokers,brokers_dict,merged,broker_groups, time_before_dif,time_after_dif,graph_other_brokers = True):
+def _group_end_lookup(position_groups, query_groups):
+    '''
+    for every query group returns the index of the last position whose group is <= the query group,
+    or -1 if there is none. position_groups must be sorted.
+    '''
+    return np.searchsorted(position_groups, query_groups, side='right') - 1
+
+def delta_finder_vectorized(delta_brokers, raw_df, delta_threshold, brokers_book=None, as_table=False):
+    """
+    Same as delta_finder(), but computed on whole numpy arrays instead of iterrows().
+    The book state of every broker at the end of each bbp_timestamp group is found with binary search,
+    and the offer-bid comparisons are done for all quotes against one other broker at a time.
+    Returns exactly the same dif_list records, in the same order, and updates brokers_book the same way.
+
+    parameters:
+    delta_threashold: float
+        any delta between offer and bid lower than this value is considered dif
+    raw_df: pandas dataframe
+        the data frame of merged_raw_data
+    delta_brokers: array
+        the list of relevant brokers
+    brokers_book: dict or None
+        the book to start from, updated in place, see delta_finder()
+    as_table: bool
+        if to return the deltas as a DeltaTable, built from the arrays without a dict per delta
+    """
+
+    print('starting to find difs')
+    delta_list = DeltaTable.from_records([]) if as_table else []
+    if brokers_book is not None:
+        for broker_name in delta_brokers:
+            if broker_name not in brokers_book:
+                brokers_book[broker_name] = new_broker_book()
+
+    # keep row where the broker_name is in delta_brokers, level 0 and a bid/offer only
+    main_df = raw_df[(raw_df["level"].to_numpy() == 0) & category_mask(raw_df["broker_name"], delta_brokers)
+                     & category_mask(raw_df["type"], ["bid", "offer"]) & raw_df["bbp_timestamp"].notna().to_numpy()]
+    # a stable sort keeps the rows of each bbp_timestamp in their original order, like groupby does
+    main_df = main_df.sort_values(by="bbp_timestamp", kind="mergesort")
+    if len(main_df) == 0:
+        return delta_list
+
+    broker_codes = {broker_name: code for code, broker_name in enumerate(dict.fromkeys(delta_brokers))}
+    code = category_codes(main_df["broker_name"], broker_codes)
+    is_offer = category_mask(main_df["type"], ["offer"])
+    bbp_ts = main_df["bbp_timestamp"].to_numpy()
+    original_ts = main_df["original_timestamp"].to_numpy()
+    rate = main_df["rate"].to_numpy(dtype=float)
+    size = main_df["size"].to_numpy(dtype=float)
+
+    # group id of every row, one group per bbp_timestamp
+    group = np.concatenate(([0], np.cumsum(bbp_ts[1:] != bbp_ts[:-1])))
+
+    # a starting book is added as a bid and an offer row per broker, in a group before all quotes.
+    # these rows only set the state, they never create deltas themselves
+    seed_rows = []
+    if brokers_book is not None:
+        for broker_name, broker_code in broker_codes.items():
+            broker_book = brokers_book[broker_name]
+            if broker_book["bbp_timestamp"] == 0:
+                continue
+            for side, side_is_offer in [("bid", False), ("offer", True)]:
+                seed_rows.append((broker_code, side_is_offer, broker_book["bbp_timestamp"], broker_book["original_timestamp"],
+                                  broker_book[side], broker_book[f"{side}_size"], broker_book[f"{side}_bbp_timestamp_last_change"]))
+    n_seeds = len(seed_rows)
+    seed_last_change = None
+    if n_seeds > 0:
+        seed_code, seed_is_offer, seed_bbp, seed_original, seed_rate, seed_size, seed_last_change = zip(*seed_rows)
+        code = np.concatenate((np.array(seed_code, dtype=np.int64), code))
+        is_offer = np.concatenate((np.array(seed_is_offer, dtype=bool), is_offer))
+        bbp_ts = np.concatenate((np.array(seed_bbp, dtype=bbp_ts.dtype), bbp_ts))
+        original_ts = np.concatenate((np.array(seed_original, dtype=original_ts.dtype), original_ts))
+        rate = np.concatenate((np.array(seed_rate, dtype=float), rate))
+        size = np.concatenate((np.array(seed_size, dtype=float), size))
+        group = np.concatenate((np.full(n_seeds, -1), group))
+    is_seed = np.arange(len(code)) < n_seeds
+    n = len(code)
+
+    # last change of the rate/size, per broker and side. a quote is a change if its rate or size
+    # differ from the previous quote of the same broker and side (the book starts at 0)
+    side_key = code * 2 + is_offer
+    order = np.lexsort((np.arange(n), side_key))
+    first = np.concatenate(([True], side_key[order][1:] != side_key[order][:-1]))
+    rate_sorted = rate[order]
+    size_sorted = size[order]
+    prev_rate = np.concatenate(([0.0], rate_sorted[:-1]))
+    prev_size = np.concatenate(([0.0], size_sorted[:-1]))
+    prev_rate[first] = 0
+    prev_size[first] = 0
+    changed = ~((rate_sorted == prev_rate) & (size_sorted == prev_size))
+    last_change_sorted = np.where(changed, bbp_ts[order], 0)
+    if n_seeds > 0:
+        # the seed rows come first in their broker/side and carry the last change of the starting book
+        seed_sorted = order < n_seeds
+        last_change_sorted[seed_sorted] = np.array(seed_last_change, dtype=last_change_sorted.dtype)[order[seed_sorted]]
+    # forward fill the last change inside each broker/side, starting from 0
+    fill_from = np.where(changed | first, np.arange(n), 0)
+    np.maximum.accumulate(fill_from, out=fill_from)
+    last_change = np.empty(n, dtype=last_change_sorted.dtype)
+    last_change[order] = last_change_sorted[fill_from]
+
+    positions = {}
+    for broker_name, broker_code in broker_codes.items():
+        broker_rows = code == broker_code
+        positions[broker_name] = {
+            "any": np.flatnonzero(broker_rows),
+            "bid": np.flatnonzero(broker_rows & ~is_offer),
+            "offer": np.flatnonzero(broker_rows & is_offer),
+        }
+
+    # the state of the quoting broker itself at the end of the group of each quote
+    own_rate = np.empty(n)
+    own_original_ts = np.empty(n, dtype=original_ts.dtype)
+    for broker_name in broker_codes:
+        for side in ["bid", "offer"]:
+            rows = positions[broker_name][side]
+            own_rate[rows] = rate[rows][_group_end_lookup(group[rows], group[rows])]
+        rows = positions[broker_name]["any"]
+        own_original_ts[rows] = original_ts[rows][_group_end_lookup(group[rows], group[rows])]
+
+    # the book after the last quote, like delta_finder() leaves it
+    if brokers_book is not None:
+        for broker_name in broker_codes:
+            broker_rows = positions[broker_name]["any"]
+            if len(broker_rows) == 0:
+                continue
+            broker_book = brokers_book[broker_name]
+            broker_book["bbp_timestamp"] = bbp_ts[broker_rows[-1]]
+            broker_book["original_timestamp"] = original_ts[broker_rows[-1]]
+            for side in ["bid", "offer"]:
+                side_rows = positions[broker_name][side]
+                if len(side_rows) == 0:
+                    continue
+                broker_book[side] = rate[side_rows[-1]]
+                broker_book[f"{side}_size"] = size[side_rows[-1]]
+                broker_book[f"{side}_bbp_timestamp_last_change"] = last_change[side_rows[-1]]
+
+    found_rows, found_other, found_name, found_value = [], [], [], []
+    found_offer_bbp, found_bid_bbp, found_offer_original, found_bid_original = [], [], [], []
+    found_offer_rate, found_bid_rate, found_direction = [], [], []
+
+    quote_names = np.array(list(broker_codes), dtype=object)[code]
+    for other_index, other_broker_name in enumerate(delta_brokers):
+        other = positions[other_broker_name]
+        other_code = broker_codes[other_broker_name]
+        for quote_side, other_side in [("bid", "offer"), ("offer", "bid")]:
+            other_rows = other[other_side]
+            # a broker that never quoted this side stays at 0 in the book and can't create a delta
+            if len(other_rows) == 0:
+                continue
+            rows = np.flatnonzero((code != other_code) & (is_offer == (quote_side == "offer")) & ~is_seed)
+            other_index_in_side = _group_end_lookup(group[other_rows], group[rows])
+            has_quote = other_index_in_side >= 0
+            other_row = other_rows[np.maximum(other_index_in_side, 0)]
+            other_rate = np.where(has_quote, rate[other_row], 0.0)
+            other_last_change = np.where(has_quote, last_change[other_row], 0)
+
+            if quote_side == "bid":
+                dif_value = other_rate - own_rate[rows]
+            else:
+                dif_value = own_rate[rows] - other_rate
+            hit = (other_rate != 0) & (bbp_ts[rows] - other_last_change < 40000) & (dif_value <= delta_threshold)
+            rows = rows[hit]
+            if len(rows) == 0:
+                continue
+            other_any = other["any"]
+            other_any_row = other_any[_group_end_lookup(group[other_any], group[rows])]
+            other_bbp = bbp_ts[other_any_row]
+            other_original = original_ts[other_any_row]
+            quote_bbp = bbp_ts[rows]
+            quote_original = own_original_ts[rows]
+
+            if quote_side == "bid":
+                found_name.append([f"{other_broker_name}-{broker_name}" for broker_name in quote_names[rows]])
+                found_offer_bbp.append(other_bbp)
+                found_bid_bbp.append(quote_bbp)
+                found_offer_original.append(other_original)
+                found_bid_original.append(quote_original)
+                found_offer_rate.append(other_rate[hit])
+                found_bid_rate.append(own_rate[rows])
+                found_direction.append(np.where((other_bbp < quote_bbp) & (other_original < quote_original), "buy", "none"))
+            else:
+                found_name.append([f"{broker_name}-{other_broker_name}" for broker_name in quote_names[rows]])
+                found_offer_bbp.append(quote_bbp)
+                found_bid_bbp.append(other_bbp)
+                found_offer_original.append(quote_original)
+                found_bid_original.append(other_original)
+                found_offer_rate.append(own_rate[rows])
+                found_bid_rate.append(other_rate[hit])
+                found_direction.append(np.where((quote_bbp > other_bbp) & (quote_original > other_original), "sell", "none"))
+            found_value.append(dif_value[hit])
+            found_rows.append(rows)
+            found_other.append(np.full(len(rows), other_index))
+
+    if len(found_rows) == 0:
+        return delta_list
+
+    # same order as the row by row loop: by quote, then by the order of the other brokers
+    found_rows = np.concatenate(found_rows)
+    found_order = np.lexsort((np.concatenate(found_other), found_rows))
+    if as_table:
+        return DeltaTable({
+            "dif_name": np.concatenate(found_name)[found_order],
+            "dif_value": np.round(np.concatenate(found_value)[found_order], 7),
+            "offer_bbp_timestamp": np.concatenate(found_offer_bbp)[found_order],
+            "bid_bbp_timestamp": np.concatenate(found_bid_bbp)[found_order],
+            "offer_original_timestamp": np.concatenate(found_offer_original)[found_order],
+            "bid_original_timestamp": np.concatenate(found_bid_original)[found_order],
+            "offer_rate": np.concatenate(found_offer_rate)[found_order],
+            "bid_rate": np.concatenate(found_bid_rate)[found_order],
+            "dif_bbp_timestamp": bbp_ts[found_rows[found_order]],
+            "direction_research": np.concatenate(found_direction)[found_order],
+        })
+    dif_name = np.concatenate(found_name)[found_order].tolist()
+    dif_value = np.round(np.concatenate(found_value)[found_order], 7).tolist()
+    offer_bbp = np.concatenate(found_offer_bbp)[found_order].tolist()
+    bid_bbp = np.concatenate(found_bid_bbp)[found_order].tolist()
+    offer_original = np.concatenate(found_offer_original)[found_order].tolist()
+    bid_original = np.concatenate(found_bid_original)[found_order].tolist()
+    offer_rate = np.concatenate(found_offer_rate)[found_order].tolist()
+    bid_rate = np.concatenate(found_bid_rate)[found_order].tolist()
+    dif_bbp = bbp_ts[found_rows[found_order]].tolist()
+    direction = np.concatenate(found_direction)[found_order].tolist()
+
+    for i in range(len(found_order)):
+        temp = {}
+        temp["dif_name"] = dif_name[i]
+        temp["dif_value"] = dif_value[i]
+
+        temp["offer_bbp_timestamp"] = offer_bbp[i]
+        temp["bid_bbp_timestamp"] = bid_bbp[i]
+
+        temp["offer_original_timestamp"] = offer_original[i]
+        temp["bid_original_timestamp"] = bid_original[i]
+
+        temp["offer_rate"] = offer_rate[i]
+        temp["bid_rate"] = bid_rate[i]
+
+        temp["dif_bbp_timestamp"] = dif_bbp[i]
+        temp["id"] = f'{temp["dif_name"]}'
+        temp["direction_research"] = direction[i]
+        delta_list.append(temp)
+    return delta_list
+
+def find_deltas_incremental(file, broker_groups, delta_threshold, state=None, engine='rows'):
+    '''
+    finds the deltas of every broker group in the quotes after the group's last_bbp_timestamp in state,
+    starting from the group's saved brokers_book, and appends them to the group's saved dif_list.
+    Quotes that arrive late, with a bbp_timestamp at or before the checkpoint, are not searched.
+    Run on the whole day in parts, it finds the same difs as find_deltas() on the whole day at once.
+
+    -----------
+    parameters:
+    file: df
+        the day's quotes so far
+    broker_groups: dict
+        {group: [brokers]}
+    state: dict or None
+        the state from IntradayCheckpoint.load(), None to start from the beginning of the day
+    engine: str
+        one of DELTA_ENGINES
+
+    returns the dif_list of the whole day so far and the new state
+    '''
+    if state is None:
+        state = {'groups': {}, 'graphed_position_ids': []}
+    dif_list = []
+    for key in broker_groups.keys():
+        group_state = state['groups'].setdefault(key, {'brokers_book': {}, 'last_bbp_timestamp': None, 'dif_list': []})
+        filter = category_mask(file['broker_name'], broker_groups[key])
+        if group_state['last_bbp_timestamp'] is not None:
+            filter = filter & (file['bbp_timestamp'] > group_state['last_bbp_timestamp']).to_numpy()
+        broker_filtered_df = file[filter]
+        new_difs = find_deltas(broker_groups[key], broker_filtered_df, delta_threshold, engine=engine, brokers_book=group_state['brokers_book'])
+        print(f'{key}: {len(new_difs)} new difs in {len(broker_filtered_df)} new quotes')
+        if broker_filtered_df['bbp_timestamp'].notna().any():
+            group_state['last_bbp_timestamp'] = broker_filtered_df['bbp_timestamp'].max()
+        group_state['dif_list'] = group_state['dif_list'] + new_difs
+        # syncing adds the position ids to the difs, the saved difs are kept as found
+        dif_list += [dict(dif) for dif in group_state['dif_list']]
+    return dif_list, state
+
+def delta_finder_streaming(delta_brokers, raw_df, delta_threshold, brokers_book=None):
+    '''
+    Same as delta_finder(), but replays the quotes one by one through a StreamingDeltaFinder.
+    Returns exactly the same dif_list records, in the same order, and updates brokers_book the same way.
+    '''
+    print('starting to find difs')
+    finder = StreamingDeltaFinder(delta_brokers, delta_threshold, brokers_book=brokers_book)
+    return list(finder.process(iter_quotes(raw_df)))
+
+DELTA_ENGINES = {
+    'rows': delta_finder,
+    'vectorized': delta_finder_vectorized,
+    'streaming': delta_finder_streaming,
+}
+
+def find_deltas(delta_brokers, raw_df, delta_threshold, engine='rows', brokers_book=None, as_table=False):
+    '''
+    runs the chosen delta engine. all engines return the same dif_list, so they can be checked against each other
+
+    parameters:
+    engine: str
+        one of DELTA_ENGINES: 'rows' (delta_finder), 'vectorized' (delta_finder_vectorized) or 'streaming' (delta_finder_streaming)
+    brokers_book: dict or None
+        the book to start from, updated in place, see delta_finder()
+    as_table: bool
+        if to return a DeltaTable instead of a list of dicts
+    '''
+    if engine not in DELTA_ENGINES:
+        raise ValueError(f'unknown delta engine {engine}, choose one of {list(DELTA_ENGINES.keys())}')
+    if engine == 'vectorized':
+        return delta_finder_vectorized(delta_brokers, raw_df, delta_threshold, brokers_book=brokers_book, as_table=as_table)
+    dif_list = DELTA_ENGINES[engine](delta_brokers, raw_df, delta_threshold, brokers_book=brokers_book)
+    return DeltaTable.from_records(dif_list) if as_table else dif_list
+
+# a time slice of the quotes is searched for deltas after replaying at least this many ms of quotes before it,
+# the staleness horizon of a quote, see find_deltas_parallel()
+DETECTION_WARMUP_MS = 40000
+
+def _delta_quotes(delta_brokers, raw_df):
+    '''
+    the quotes the delta engines use (level 0 bids and offers of delta_brokers), in bbp_timestamp order
+    '''
+    main_df = raw_df[(raw_df["level"].to_numpy() == 0) & category_mask(raw_df["broker_name"], delta_brokers)
+                     & category_mask(raw_df["type"], ["bid", "offer"]) & raw_df["bbp_timestamp"].notna().to_numpy()]
+    return main_df.sort_values(by="bbp_timestamp", kind="mergesort").reset_index(drop=True)
+
+def _slice_with_warmup(main_df, slice_start, slice_end, warmup_ms):
+    '''
+    the quotes of [slice_start, slice_end) with the quotes of the warmup_ms before it, and the last quote
+    of every broker and side before the warmup. Replaying the warmup rebuilds the book at slice_start:
+    a side that did not change since before the warmup is older than the staleness horizon for the whole
+    slice, so it only needs its last rate and size, not the exact time of its last change.
+    '''
+    bbp_ts = main_df["bbp_timestamp"]
+    before_warmup = bbp_ts < slice_start - warmup_ms
+    anchors = main_df[before_warmup].groupby(["broker_name", "type"], sort=False, observed=True).tail(1).index
+    in_slice = ~before_warmup & (bbp_ts < slice_end)
+    in_slice[anchors] = True
+    return main_df[in_slice]
+
+def _find_deltas_in_slice(delta_brokers, slice_df, delta_threshold, engine, slice_start, slice_end, as_table):
+    dif_list = find_deltas(delta_brokers, slice_df, delta_threshold, engine=engine, as_table=as_table)
+    if as_table:
+        dif_bbp = dif_list.values("dif_bbp_timestamp")
+        return dif_list.take((slice_start <= dif_bbp) & (dif_bbp < slice_end))
+    return [dif for dif in dif_list if slice_start <= dif["dif_bbp_timestamp"] < slice_end]
+
+def find_deltas_parallel(file, broker_groups, delta_threshold, processes, engine='vectorized', slice_rows=None, warmup_ms=DETECTION_WARMUP_MS, as_table=False):
+    '''
+    finds the deltas of every broker group in a pool of processes. The groups run at the same time, and a group
+    with more than slice_rows quotes is also split into time slices, each seeded by a warmup, see _slice_with_warmup().
+    Returns exactly the same dif_list as running find_deltas() on every group one after the other.
+
+    -----------
+    parameters:
+    file: df
+        the day's quotes
+    broker_groups: dict
+        {group: [brokers]}
+    processes: int
+        size of the process pool
+    engine: str
+        one of DELTA_ENGINES, used for every slice
+    slice_rows: int or None
+        the number of quotes per slice, None to run every group as one slice
+    warmup_ms: int
+        how many ms of quotes before a slice are replayed, at least DETECTION_WARMUP_MS
+    as_table: bool
+        if to return a DeltaTable instead of a list of dicts
+    '''
+    if warmup_ms < DETECTION_WARMUP_MS:
+        raise ValueError(f'warmup_ms must be at least {DETECTION_WARMUP_MS}, the staleness horizon of a quote')
+    tasks = []
+    for key in broker_groups.keys():
+        main_df = _delta_quotes(broker_groups[key], file)
+        slices = 1
+        if slice_rows is not None and len(main_df) > slice_rows:
+            slices = -(-len(main_df) // slice_rows)
+        # slices start at a bbp_timestamp, so all the quotes of a bbp_timestamp are in the same slice
+        bbp_ts = main_df["bbp_timestamp"].to_numpy()
+        starts = [-np.inf] + [bbp_ts[len(bbp_ts) * i // slices] for i in range(1, slices)] + [np.inf]
+        starts = sorted(set(starts))
+        for slice_start, slice_end in zip(starts[:-1], starts[1:]):
+            tasks.append((broker_groups[key], _slice_with_warmup(main_df, slice_start, slice_end, warmup_ms), delta_threshold, engine, slice_start, slice_end, as_table))
+    print(f'finding deltas in {len(tasks)} slices with {processes} processes')
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = [executor.submit(_find_deltas_in_slice, *task) for task in tasks]
+        # in the order of the groups and of the slices, like a sequential run
+        results = [future.result() for future in futures]
+    if as_table:
+        return DeltaTable.concat(results)
+    return [dif for result in results for dif in result]
+
+# rows per block of a RangeExtremeIndex, a query scans at most the two partial blocks at the ends of its range
+RANGE_BLOCK_ROWS = 1024
+
+class RangeExtremeIndex:
+    '''
+    Answers the max (or min) of an array over any range of positions [start, stop) without scanning the range.
+    The array is cut into blocks of block_rows, and a sparse table over the extremes of the blocks gives the
+    extreme of any run of whole blocks with two lookups: level k holds the extreme of the 2**k blocks from
+    every block. Only the partial blocks at the ends of the range are scanned.
+    NaNs are skipped, like pandas' max() and min(), a range without any other value gives NaN.
+
+    ----------
+    parameters:
+    values: numpy array
+        the values, kept without copying
+    kind: str
+        'max' or 'min'
+    block_rows: int
+        rows per block
+    '''
+    def __init__(self, values, kind, block_rows=RANGE_BLOCK_ROWS):
+        if kind not in ('max', 'min'):
+            raise ValueError(f'unknown extreme {kind}, choose max or min')
+        self.values = values
+        self.block_rows = block_rows
+        # fmax and fmin skip NaNs
+        self.extreme = np.fmax if kind == 'max' else np.fmin
+        level = self.extreme.reduceat(values, np.arange(0, len(values), block_rows)) if len(values) else values[:0]
+        self.levels = [level]
+        width = 1
+        while 2 * width <= len(self.levels[0]):
+            level = self.extreme(level[:-width], level[width:])
+            self.levels.append(level)
+            width *= 2
+
+    def query(self, start, stop):
+        '''
+        the extreme of values[start:stop]
+        '''
+        start, stop = int(start), int(stop)
+        if start >= stop:
+            return np.nan
+        # the whole blocks in the range are [first_block, end_block)
+        first_block = -(-start // self.block_rows)
+        end_block = stop // self.block_rows
+        if first_block >= end_block:
+            return self.extreme.reduce(self.values[start:stop])
+        k = (end_block - first_block).bit_length() - 1
+        result = self.extreme(self.levels[k][first_block], self.levels[k][end_block - 2**k])
+        if start < first_block * self.block_rows:
+            result = self.extreme(result, self.extreme.reduce(self.values[start:first_block * self.block_rows]))
+        if end_block * self.block_rows < stop:
+            result = self.extreme(result, self.extreme.reduce(self.values[end_block * self.block_rows:stop]))
+        return result
+
+class BookWindowIndex:
+    '''
+    Index over the day's brokers_dict and merged, built once per day, that returns the rows with
+    lower <= bbp_timestamp < upper by binary search on the sorted bbp_timestamp instead of masking the whole day.
+    The windows are positional slices (iloc) of the original frames, so no rows are copied.
+    The highest or lowest price of some of merged's columns in a window comes from a RangeExtremeIndex per column,
+    made the first time the column is asked for, see merged_extreme().
+
+    ----------
+    parameters:
+    brokers_dict: dict
+        dict from create_flat_broker_dict(), containing a flat dataframe for each broker
+    merged: df
+        a flat df containing all prices and size for all brokers at a given time
+    '''
+    def __init__(self, brokers_dict, merged):
+        self.brokers_dict = {}
+        self.broker_timestamps = {}
+        for broker_name, broker_df in brokers_dict.items():
+            broker_df = self._sorted(broker_df)
+            self.brokers_dict[broker_name] = broker_df
+            self.broker_timestamps[broker_name] = broker_df['bbp_timestamp'].to_numpy()
+        self.merged = self._sorted(merged)
+        self.merged_timestamps = self.merged['bbp_timestamp'].to_numpy()
+        # (column, 'max' or 'min') -> RangeExtremeIndex
+        self.merged_extremes = {}
+
+    @staticmethod
+    def _sorted(df):
+        if df['bbp_timestamp'].is_monotonic_increasing:
+            return df
+        return df.sort_values(by=['bbp_timestamp'], kind='mergesort')
+
+    @staticmethod
+    def _bounds(timestamps, lower, upper):
+        return np.searchsorted(timestamps, lower, side='left'), np.searchsorted(timestamps, upper, side='left')
+
+    def broker_window(self, broker_name, lower, upper):
+        '''
+        rows of the broker's flat df with lower <= bbp_timestamp < upper
+        '''
+        start, stop = self._bounds(self.broker_timestamps[broker_name], lower, upper)
+        return self.brokers_dict[broker_name].iloc[start:stop]
+
+    def merged_window(self, lower, upper):
+        '''
+        rows of merged with lower <= bbp_timestamp < upper
+        '''
+        start, stop = self._bounds(self.merged_timestamps, lower, upper)
+        return self.merged.iloc[start:stop]
+
+    def merged_extreme(self, columns, lower, upper, kind):
+        '''
+        the max (kind='max') or min (kind='min') of the columns of merged over the rows with
+        lower <= bbp_timestamp < upper, NaNs skipped. NaN if there is no value
+        '''
+        start, stop = self._bounds(self.merged_timestamps, lower, upper)
+        extreme = np.fmax if kind == 'max' else np.fmin
+        result = np.nan
+        for column in columns:
+            range_index = self.merged_extremes.get((column, kind))
+            if range_index is None:
+                range_index = self.merged_extremes[(column, kind)] = RangeExtremeIndex(self.merged[column].to_numpy(dtype=float), kind)
+            result = extreme(result, range_index.query(start, stop))
+        return result
+
+def _to_naive_datetime(value):
+    '''
+    converts a ms timestamp or a datetime to a naive (UTC) pandas Timestamp
+    '''
+    if isinstance(value, (int, float, np.integer, np.floating)):
+        return pd.to_datetime(value, unit='ms')
+    value = pd.to_datetime(value)
+    if value.tzinfo is not None:
+        value = value.tz_convert(None)
+    return value
+
+def _min_max_downsample(y, max_points):
+    '''
+    indices of y to keep so that every one of max_points/4 equal buckets keeps its first, last, min and max point
+    '''
+    bucket_count = max(1, max_points // 4)
+    edges = np.unique(np.linspace(0, len(y), bucket_count + 1).astype(np.int64))
+    y_for_min = np.where(np.isnan(y), np.inf, y)
+    y_for_max = np.where(np.isnan(y), -np.inf, y)
+    keep = [edges[:-1], edges[1:] - 1]
+    keep.append(np.array([start + np.argmin(y_for_min[start:stop]) for start, stop in zip(edges[:-1], edges[1:])], dtype=np.int64))
+    keep.append(np.array([start + np.argmax(y_for_max[start:stop]) for start, stop in zip(edges[:-1], edges[1:])], dtype=np.int64))
+    return np.unique(np.concatenate(keep))
+
+def reduce_trace(x, y, max_points, keep_times=()):
+    '''
+    Reduces the points of a line_shape='hv' trace before it is plotted:
+    1. points that don't change the value are dropped, the step line already stays at that value
+    2. if more than max_points are left, a min/max bucket downsampler keeps the extremes of every bucket
+    The first and last points, and the points around every time in keep_times (the point in effect at that time
+    and the next one), are always kept. returns (x, y, number of removed points)
+
+    ----------
+    parameters:
+    x: DatetimeIndex
+        the times of the trace
+    y: array
+        the values of the trace
+    max_points: int
+        point budget of the trace
+    keep_times: array
+        times whose points must not be removed (enter, exit, signal...)
+    '''
+    y = np.asarray(y, dtype=float)
+    n = len(y)
+    if n <= 2:
+        return x, y, 0
+
+    required = np.zeros(n, dtype=bool)
+    required[0] = True
+    required[-1] = True
+    if len(keep_times) > 0:
+        around = np.searchsorted(x.values, np.array(keep_times, dtype='datetime64[ns]'), side='right')
+        required[around[around > 0] - 1] = True
+        required[around[around < n]] = True
+
+    keep = required.copy()
+    changed = (y[1:] != y[:-1]) & ~(np.isnan(y[1:]) & np.isnan(y[:-1]))
+    keep[1:] |= changed
+
+    kept = np.flatnonzero(keep)
+    if len(kept) > max_points:
+        kept = kept[_min_max_downsample(y[kept], max_points)]
+        keep = required.copy()
+        keep[kept] = True
+
+    return x[keep], y[keep], n - int(keep.sum())
+
+RENDER_MODES = {'svg', 'webgl', 'auto'}
+
+# above this many plotted points a graph gets slow to pan and zoom as svg
+WEBGL_POINTS_THRESHOLD = 20000
+
+def plot_scatter_type(render_mode, window_index, brokers, lower_limit, upper_limit, max_trace_points=None, webgl_threshold=WEBGL_POINTS_THRESHOLD):
+    '''
+    returns the trace class a graph of brokers between lower_limit and upper_limit is drawn with:
+    G.Scatter (svg) or G.Scattergl (WebGL). Both take the same legend groups, colors, line shapes and hover templates.
+
+    ----------
+    parameters:
+    render_mode: str
+        'svg', 'webgl', or 'auto' to use WebGL when the graph has more than webgl_threshold points
+    window_index: BookWindowIndex
+        used to count the points of every broker in the window
+    max_trace_points: int or None
+        the point budget of every trace, if the traces are reduced
+    '''
+    if render_mode not in RENDER_MODES:
+        raise ValueError(f'unknown render mode {render_mode}, choose one of {sorted(RENDER_MODES)}')
+    if render_mode == 'auto':
+        points = 0
+        for broker_name in brokers:
+            broker_points = len(window_index.broker_window(broker_name, lower_limit, upper_limit))
+            if max_trace_points is not None:
+                broker_points = min(broker_points, max_trace_points)
+            # bid, offer and their sizes
+            points += 4*broker_points
+        render_mode = 'webgl' if points > webgl_threshold else 'svg'
+    return G.Scattergl if render_mode == 'webgl' else G.Scatter
+
+def _position_traced_brokers(position, brokers, broker_groups, graph_dif_name, graph_other_brokers):
+    '''
+    the brokers position_plots() draws, with the same conditions as its loop over brokers: a broker is listed
+    once for every group of traces it is drawn in (a NY broker is also drawn with the others)
+    '''
+    traced_brokers = []
+    for broker_name in brokers:
+        if broker_name in [position['enter_broker'],position['exit_broker']] or broker_name in graph_dif_name:
+            traced_brokers.append(broker_name)
+            continue
+        if graph_difs_before_and_after and broker_name in broker_groups['NY']:
+            traced_brokers.append(broker_name)
+        if graph_other_brokers:
+            traced_brokers.append(broker_name)
+    return traced_brokers
+
+def position_plots(difs, position, brokers,brokers_dict,merged,broker_groups, time_before_dif,time_after_dif,graph_other_brokers = True,window_index=None,max_trace_points=None,render_mode='svg',webgl_threshold=WEBGL_POINTS_THRESHOLD):
     '''
     This function takes an dif(dict) and a flat book with colunns of all brokers and index of ts and produces two graphs:
     - one of the bid and offer of each broker 3m before and after the dif
@@ -284,24 +1022,54 @@ def position_plots(difs, position, brokers,brokers_dict,merged,broker_groups, ti
         how many mins before and after the dif should show on the graph
     graph_other_brokers: bool
         if to graph all other brokers that are not participating nor in delta
+    window_index: BookWindowIndex
+        index of brokers_dict and merged built once per day, built here if not given
+    max_trace_points: int or None
+        if given, every broker trace is reduced with reduce_trace() to at most this many points
+    render_mode: str
+        'svg', 'webgl' or 'auto', see plot_scatter_type()
+    webgl_threshold: int
+        'auto' only, the number of plotted points above which WebGL traces are used
     
     '''
+    if window_index is None:
+        window_index = BookWindowIndex(brokers_dict, merged)
     def hex_to_rgba(h, alpha):
         '''
         converts color value in hex format to rgba format with alpha transparency
         '''
         return tuple([int(h.lstrip('#')[i:i+2], 16) for i in (0, 2, 4)] + [alpha])
+
+    # the points at these times are kept when the traces are reduced. an open position has no exit times yet
+    keep_times = []
+    if max_trace_points is not None:
+        times = [position.get(key) for key in ['enter_order_request_timestamp','enter_order_time','exit_order_request_timestamp','exit_order_time','dif_bbp_timestamp']]
+        times += [signal_dif.get('bbp_timestamp') for signal_dif in position['signal_difs']]
+        keep_times = [_to_naive_datetime(value) for value in times if value is not None and not pd.isna(value)]
+    points_count = {'total': 0, 'removed': 0}
+    def trace_points(broker_df_timeframe, col_name):
+        '''
+        x and y of a broker's trace, reduced with reduce_trace() if max_trace_points is given
+        '''
+        if max_trace_points is None:
+            return dict(x=broker_df_timeframe.index, y=broker_df_timeframe[col_name])
+        x, y, removed = reduce_trace(broker_df_timeframe.index, broker_df_timeframe[col_name], max_trace_points, keep_times)
+        points_count['total'] += len(broker_df_timeframe)
+        points_count['removed'] += removed
+        return dict(x=x, y=y)
     dif_bbp_timestamp = position['dif_bbp_timestamp']
     
     lower_limit = dif_bbp_timestamp - 60000*time_before_dif
     upper_limit = dif_bbp_timestamp + 60000*time_after_dif
 
-
     graph_dif_name = ''
     for broker in position['dif_ids']:
         graph_dif_name+=broker
         if position['dif_ids'].index(broker) != len(position['dif_ids'])-1:
             graph_dif_name+='/'
+
+    traced_brokers = _position_traced_brokers(position, brokers, broker_groups, graph_dif_name, graph_other_brokers)
+    Scatter = plot_scatter_type(render_mode, window_index, traced_brokers, lower_limit, upper_limit, max_trace_points=max_trace_points, webgl_threshold=webgl_threshold)
     
     offer_columns = []
     bid_columns = []
@@ -326,12 +1094,9 @@ def position_plots(difs, position, brokers,brokers_dict,merged,broker_groups, ti
                 offer_columns.append(col)
 
 
-    merged_timeframe = merged.loc[(merged.bbp_timestamp >= lower_limit) & (merged.bbp_timestamp < upper_limit)]
-    merged_timeframe = merged_timeframe.drop_duplicates()
-    
-    #print(len(merged_timeframe))
-    max_offer = merged_timeframe[offer_columns].max().max()
-    min_bid = merged_timeframe[bid_columns].min().min()
+    # the height of the marker lines
+    max_offer = window_index.merged_extreme(offer_columns, lower_limit, upper_limit, 'max')
+    min_bid = window_index.merged_extreme(bid_columns, lower_limit, upper_limit, 'min')
 
 
     # color list from which the colors of the lines will be generated
@@ -361,14 +1126,14 @@ def position_plots(difs, position, brokers,brokers_dict,merged,broker_groups, ti
             bid_col_name = broker_name + "_bid"
             offer_col_name = broker_name + "_offer"
             
-            broker_df_timeframe = brokers_dict[broker_name].loc[(brokers_dict[broker_name].bbp_timestamp >= lower_limit) & (brokers_dict[broker_name].bbp_timestamp < upper_limit)]
+            broker_df_timeframe = window_index.broker_window(broker_name, lower_limit, upper_limit)
 
 
-            price_plot.add_trace(G.Scatter(legendgroup='participating broker',legendgrouptitle_text='participating broker',x=broker_df_timeframe.index, y=broker_df_timeframe[bid_col_name], name=bid_col_name,line_shape='hv', line=dict(width=1, color=colors_list[color_index_to_use], dash="dash")), row=1, col=1)
-            price_plot.add_trace(G.Scatter(legendgroup='participating broker',x=broker_df_timeframe.index, y=broker_df_timeframe[offer_col_name], name=offer_col_name ,line_shape='hv', line=dict(width=1, color=colors_list[color_index_to_use])), row=1, col=1)
+            price_plot.add_trace(Scatter(legendgroup='participating broker',legendgrouptitle_text='participating broker',**trace_points(broker_df_timeframe, bid_col_name), name=bid_col_name,line_shape='hv', line=dict(width=1, color=colors_list[color_index_to_use], dash="dash")), row=1, col=1)
+            price_plot.add_trace(Scatter(legendgroup='participating broker',**trace_points(broker_df_timeframe, offer_col_name), name=offer_col_name ,line_shape='hv', line=dict(width=1, color=colors_list[color_index_to_use])), row=1, col=1)
 
-            size_plot.add_trace(G.Scatter(legendgroup='participating broker',legendgrouptitle_text='participating broker',x=broker_df_timeframe.index, y=broker_df_timeframe[f'{bid_col_name}_size'], name=f'{bid_col_name}_size',line_shape='hv', line=dict(width=1, color=colors_list[color_index_to_use], dash="dash")), row=1, col=1)
-            size_plot.add_trace(G.Scatter(legendgroup='participating broker',x=broker_df_timeframe.index, y=broker_df_timeframe[f'{offer_col_name}_size'], name=f'{offer_col_name}_size' ,line_shape='hv', line=dict(width=1, color=colors_list[color_index_to_use])), row=1, col=1)
+            size_plot.add_trace(Scatter(legendgroup='participating broker',legendgrouptitle_text='participating broker',**trace_points(broker_df_timeframe, f'{bid_col_name}_size'), name=f'{bid_col_name}_size',line_shape='hv', line=dict(width=1, color=colors_list[color_index_to_use], dash="dash")), row=1, col=1)
+            size_plot.add_trace(Scatter(legendgroup='participating broker',**trace_points(broker_df_timeframe, f'{offer_col_name}_size'), name=f'{offer_col_name}_size' ,line_shape='hv', line=dict(width=1, color=colors_list[color_index_to_use])), row=1, col=1)
             color_index_to_use+=1 #manual
 
 
@@ -380,48 +1145,48 @@ def position_plots(difs, position, brokers,brokers_dict,merged,broker_groups, ti
                     bid_col_name = broker_name + "_bid"
                     offer_col_name = broker_name + "_offer"
                     
-                    broker_df_timeframe = brokers_dict[broker_name].loc[(brokers_dict[broker_name].bbp_timestamp >= lower_limit) & (brokers_dict[broker_name].bbp_timestamp < upper_limit)]
+                    broker_df_timeframe = window_index.broker_window(broker_name, lower_limit, upper_limit)
 
 
-                    price_plot.add_trace(G.Scatter(legendgroup='NY',legendgrouptitle_text='NY',x=broker_df_timeframe.index, y=broker_df_timeframe[bid_col_name], name=bid_col_name,line_shape='hv', line=dict(width=1, color=colors_list[color_index_to_use], dash="dash")), row=1, col=1)
-                    price_plot.add_trace(G.Scatter(legendgroup='NY',x=broker_df_timeframe.index, y=broker_df_timeframe[offer_col_name], name=offer_col_name ,line_shape='hv', line=dict(width=1, color=colors_list[color_index_to_use])), row=1, col=1)
+                    price_plot.add_trace(Scatter(legendgroup='NY',legendgrouptitle_text='NY',**trace_points(broker_df_timeframe, bid_col_name), name=bid_col_name,line_shape='hv', line=dict(width=1, color=colors_list[color_index_to_use], dash="dash")), row=1, col=1)
+                    price_plot.add_trace(Scatter(legendgroup='NY',**trace_points(broker_df_timeframe, offer_col_name), name=offer_col_name ,line_shape='hv', line=dict(width=1, color=colors_list[color_index_to_use])), row=1, col=1)
 
-                    size_plot.add_trace(G.Scatter(legendgroup='NY',legendgrouptitle_text='NY',x=broker_df_timeframe.index, y=broker_df_timeframe[f'{bid_col_name}_size'], name=f'{bid_col_name}_size',line_shape='hv', line=dict(width=1, color=colors_list[color_index_to_use], dash="dash")), row=1, col=1)
-                    size_plot.add_trace(G.Scatter(legendgroup='NY',x=broker_df_timeframe.index, y=broker_df_timeframe[f'{offer_col_name}_size'], name=f'{offer_col_name}_size' ,line_shape='hv', line=dict(width=1, color=colors_list[color_index_to_use])), row=1, col=1)
+                    size_plot.add_trace(Scatter(legendgroup='NY',legendgrouptitle_text='NY',**trace_points(broker_df_timeframe, f'{bid_col_name}_size'), name=f'{bid_col_name}_size',line_shape='hv', line=dict(width=1, color=colors_list[color_index_to_use], dash="dash")), row=1, col=1)
+                    size_plot.add_trace(Scatter(legendgroup='NY',**trace_points(broker_df_timeframe, f'{offer_col_name}_size'), name=f'{offer_col_name}_size' ,line_shape='hv', line=dict(width=1, color=colors_list[color_index_to_use])), row=1, col=1)
                     color_index_to_use+=1 #manual
             if graph_other_brokers:
                 # print('pusht',broker_name)
                 bid_col_name = broker_name + "_bid"
                 offer_col_name = broker_name + "_offer"
                 
-                broker_df_timeframe = brokers_dict[broker_name].loc[(brokers_dict[broker_name].bbp_timestamp >= lower_limit) & (brokers_dict[broker_name].bbp_timestamp < upper_limit)]
+                broker_df_timeframe = window_index.broker_window(broker_name, lower_limit, upper_limit)
 
 
-                price_plot.add_trace(G.Scatter(legendgroup='not in delta',legendgrouptitle_text='not in delta',x=broker_df_timeframe.index, y=broker_df_timeframe[bid_col_name], name=bid_col_name,line_shape='hv', line=dict(width=1, color=colors_list[color_index_to_use], dash="dash")), row=1, col=1)
-                price_plot.add_trace(G.Scatter(legendgroup='not in delta',x=broker_df_timeframe.index, y=broker_df_timeframe[offer_col_name], name=offer_col_name ,line_shape='hv', line=dict(width=1, color=colors_list[color_index_to_use])), row=1, col=1)
+                price_plot.add_trace(Scatter(legendgroup='not in delta',legendgrouptitle_text='not in delta',**trace_points(broker_df_timeframe, bid_col_name), name=bid_col_name,line_shape='hv', line=dict(width=1, color=colors_list[color_index_to_use], dash="dash")), row=1, col=1)
+                price_plot.add_trace(Scatter(legendgroup='not in delta',**trace_points(broker_df_timeframe, offer_col_name), name=offer_col_name ,line_shape='hv', line=dict(width=1, color=colors_list[color_index_to_use])), row=1, col=1)
 
-                size_plot.add_trace(G.Scatter(legendgroup='not in delta',legendgrouptitle_text='not in delta',x=broker_df_timeframe.index, y=broker_df_timeframe[f'{bid_col_name}_size'], name=f'{bid_col_name}_size',line_shape='hv', line=dict(width=1, color=colors_list[color_index_to_use], dash="dash")), row=1, col=1)
-                size_plot.add_trace(G.Scatter(legendgroup='not in delta',x=broker_df_timeframe.index, y=broker_df_timeframe[f'{offer_col_name}_size'], name=f'{offer_col_name}_size' ,line_shape='hv', line=dict(width=1, color=colors_list[color_index_to_use])), row=1, col=1)
+                size_plot.add_trace(Scatter(legendgroup='not in delta',legendgrouptitle_text='not in delta',**trace_points(broker_df_timeframe, f'{bid_col_name}_size'), name=f'{bid_col_name}_size',line_shape='hv', line=dict(width=1, color=colors_list[color_index_to_use], dash="dash")), row=1, col=1)
+                size_plot.add_trace(Scatter(legendgroup='not in delta',**trace_points(broker_df_timeframe, f'{offer_col_name}_size'), name=f'{offer_col_name}_size' ,line_shape='hv', line=dict(width=1, color=colors_list[color_index_to_use])), row=1, col=1)
                 color_index_to_use+=1 #manual
         else:
             # print('dif', broker_name)
             bid_col_name = broker_name + "_bid"
             offer_col_name = broker_name + "_offer"
-            broker_df_timeframe = brokers_dict[broker_name].loc[(brokers_dict[broker_name].bbp_timestamp >= lower_limit) & (brokers_dict[broker_name].bbp_timestamp < upper_limit)]
+            broker_df_timeframe = window_index.broker_window(broker_name, lower_limit, upper_limit)
 
 
-            price_plot.add_trace(G.Scatter(legendgroup='in delta',legendgrouptitle_text='in delta',x=broker_df_timeframe.index, y=broker_df_timeframe[bid_col_name], name=bid_col_name,line_shape='hv', line=dict(width=1, color=colors_list[color_index_to_use], dash="dash")), row=1, col=1)
-            price_plot.add_trace(G.Scatter(legendgroup='in delta',x=broker_df_timeframe.index, y=broker_df_timeframe[offer_col_name], name=offer_col_name ,line_shape='hv', line=dict(width=1, color=colors_list[color_index_to_use])), row=1, col=1)
+            price_plot.add_trace(Scatter(legendgroup='in delta',legendgrouptitle_text='in delta',**trace_points(broker_df_timeframe, bid_col_name), name=bid_col_name,line_shape='hv', line=dict(width=1, color=colors_list[color_index_to_use], dash="dash")), row=1, col=1)
+            price_plot.add_trace(Scatter(legendgroup='in delta',**trace_points(broker_df_timeframe, offer_col_name), name=offer_col_name ,line_shape='hv', line=dict(width=1, color=colors_list[color_index_to_use])), row=1, col=1)
 
-            size_plot.add_trace(G.Scatter(legendgroup='in delta',legendgrouptitle_text='in delta',x=broker_df_timeframe.index, y=broker_df_timeframe[f'{bid_col_name}_size'], name=f'{bid_col_name}_size',line_shape='hv', line=dict(width=1, color=colors_list[color_index_to_use], dash="dash")), row=1, col=1)
-            size_plot.add_trace(G.Scatter(legendgroup='in delta',x=broker_df_timeframe.index, y=broker_df_timeframe[f'{offer_col_name}_size'], name=f'{offer_col_name}_size' ,line_shape='hv', line=dict(width=1, color=colors_list[color_index_to_use])), row=1, col=1)
+            size_plot.add_trace(Scatter(legendgroup='in delta',legendgrouptitle_text='in delta',**trace_points(broker_df_timeframe, f'{bid_col_name}_size'), name=f'{bid_col_name}_size',line_shape='hv', line=dict(width=1, color=colors_list[color_index_to_use], dash="dash")), row=1, col=1)
+            size_plot.add_trace(Scatter(legendgroup='in delta',**trace_points(broker_df_timeframe, f'{offer_col_name}_size'), name=f'{offer_col_name}_size' ,line_shape='hv', line=dict(width=1, color=colors_list[color_index_to_use])), row=1, col=1)
             color_index_to_use+=1 #manual
     
     # adding the vertical line to mark the dif
     dif_datetime= pd.to_datetime(dif_bbp_timestamp,unit='ms')
     dif_nickname = 'delta'
-    # size_plot.add_trace(G.Scatter(legendgroup='signal',legendgrouptitle_text='signal',x=[dif_datetime]*2, y=[min_bid,max_offer], name=f'{dif_nickname}' ,line_shape='hv', line=dict(width=2, color='black', dash="dash")), row=1, col=1)
-    # price_plot.add_trace(G.Scatter(legendgroup='signal',legendgrouptitle_text='signal',x=[dif_datetime]*2, y=[min_bid,max_offer], name=f'{dif_nickname}' ,line_shape='hv', line=dict(width=2, color='black', dash="dash")), row=1, col=1)
+    # size_plot.add_trace(Scatter(legendgroup='signal',legendgrouptitle_text='signal',x=[dif_datetime]*2, y=[min_bid,max_offer], name=f'{dif_nickname}' ,line_shape='hv', line=dict(width=2, color='black', dash="dash")), row=1, col=1)
+    # price_plot.add_trace(Scatter(legendgroup='signal',legendgrouptitle_text='signal',x=[dif_datetime]*2, y=[min_bid,max_offer], name=f'{dif_nickname}' ,line_shape='hv', line=dict(width=2, color='black', dash="dash")), row=1, col=1)
     
 
     
@@ -433,40 +1198,40 @@ def position_plots(difs, position, brokers,brokers_dict,merged,broker_groups, ti
 
 
 
-    size_plot.add_trace(G.Scatter(legendgroup='position',legendgrouptitle_text='position',x=[position['enter_order_request_timestamp']]*2, y=[min_bid,max_offer], name=enter_request_text ,line_shape='hv', line=dict(width=2, color=enter_and_exit_colors[0], dash="dash")), row=1, col=1)
-    size_plot.add_trace(G.Scatter(legendgroup='position',legendgrouptitle_text='position',x=[position['enter_order_time']]*2, y=[min_bid,max_offer], name=enter_execute_text ,line_shape='hv', line=dict(width=2, color=enter_and_exit_colors[1], dash="dash")), row=1, col=1)
+    size_plot.add_trace(Scatter(legendgroup='position',legendgrouptitle_text='position',x=[position['enter_order_request_timestamp']]*2, y=[min_bid,max_offer], name=enter_request_text ,line_shape='hv', line=dict(width=2, color=enter_and_exit_colors[0], dash="dash")), row=1, col=1)
+    size_plot.add_trace(Scatter(legendgroup='position',legendgrouptitle_text='position',x=[position['enter_order_time']]*2, y=[min_bid,max_offer], name=enter_execute_text ,line_shape='hv', line=dict(width=2, color=enter_and_exit_colors[1], dash="dash")), row=1, col=1)
 
-    size_plot.add_trace(G.Scatter(legendgroup='position',legendgrouptitle_text='position',x=[position['exit_order_request_timestamp']]*2, y=[min_bid,max_offer], name=exit_request_text ,line_shape='hv', line=dict(width=2, color=enter_and_exit_colors[2], dash="dash")), row=1, col=1)
-    size_plot.add_trace(G.Scatter(legendgroup='position',legendgrouptitle_text='position',x=[position['exit_order_time']]*2, y=[min_bid,max_offer], name=exit_execute_text ,line_shape='hv', line=dict(width=2, color=enter_and_exit_colors[3], dash="dash")), row=1, col=1)
+    size_plot.add_trace(Scatter(legendgroup='position',legendgrouptitle_text='position',x=[position['exit_order_request_timestamp']]*2, y=[min_bid,max_offer], name=exit_request_text ,line_shape='hv', line=dict(width=2, color=enter_and_exit_colors[2], dash="dash")), row=1, col=1)
+    size_plot.add_trace(Scatter(legendgroup='position',legendgrouptitle_text='position',x=[position['exit_order_time']]*2, y=[min_bid,max_offer], name=exit_execute_text ,line_shape='hv', line=dict(width=2, color=enter_and_exit_colors[3], dash="dash")), row=1, col=1)
 
 
-    price_plot.add_trace(G.Scatter(legendgroup='position',legendgrouptitle_text='position',x=[position['enter_order_request_timestamp']]*2, y=[min_bid,max_offer], name=enter_request_text ,line_shape='hv', line=dict(width=2, color=enter_and_exit_colors[0], dash="dash")), row=1, col=1)
-    price_plot.add_trace(G.Scatter(legendgroup='position',legendgrouptitle_text='position',x=[position['enter_order_time']]*2, y=[min_bid,max_offer], name=enter_execute_text ,line_shape='hv', line=dict(width=2, color=enter_and_exit_colors[1], dash="dash")), row=1, col=1)
+    price_plot.add_trace(Scatter(legendgroup='position',legendgrouptitle_text='position',x=[position['enter_order_request_timestamp']]*2, y=[min_bid,max_offer], name=enter_request_text ,line_shape='hv', line=dict(width=2, color=enter_and_exit_colors[0], dash="dash")), row=1, col=1)
+    price_plot.add_trace(Scatter(legendgroup='position',legendgrouptitle_text='position',x=[position['enter_order_time']]*2, y=[min_bid,max_offer], name=enter_execute_text ,line_shape='hv', line=dict(width=2, color=enter_and_exit_colors[1], dash="dash")), row=1, col=1)
 
-    price_plot.add_trace(G.Scatter(legendgroup='position',legendgrouptitle_text='position',x=[position['exit_order_request_timestamp']]*2, y=[min_bid,max_offer], name=exit_request_text ,line_shape='hv', line=dict(width=2, color=enter_and_exit_colors[2], dash="dash")), row=1, col=1)
-    price_plot.add_trace(G.Scatter(legendgroup='position',legendgrouptitle_text='position',x=[position['exit_order_time']]*2, y=[min_bid,max_offer], name=exit_execute_text ,line_shape='hv', line=dict(width=2, color=enter_and_exit_colors[3], dash="dash")), row=1, col=1)
+    price_plot.add_trace(Scatter(legendgroup='position',legendgrouptitle_text='position',x=[position['exit_order_request_timestamp']]*2, y=[min_bid,max_offer], name=exit_request_text ,line_shape='hv', line=dict(width=2, color=enter_and_exit_colors[2], dash="dash")), row=1, col=1)
+    price_plot.add_trace(Scatter(legendgroup='position',legendgrouptitle_text='position',x=[position['exit_order_time']]*2, y=[min_bid,max_offer], name=exit_execute_text ,line_shape='hv', line=dict(width=2, color=enter_and_exit_colors[3], dash="dash")), row=1, col=1)
     
     #Add points to enterance and exit
 
-    size_plot.add_trace(G.Scatter(legendgroup='price_dots',legendgrouptitle_text='position',x=[position['enter_order_request_timestamp']], y=[position['enter_order_requested_price']], name=f'{enter_request_text}' ,line_shape='hv', line=dict(width=3, color=enter_and_exit_colors[0], dash="dash")), row=1, col=1)
-    size_plot.add_trace(G.Scatter(legendgroup='price_dots',legendgrouptitle_text='position',x=[position['enter_order_time']], y=[position['enter_order_executed_price']], name=f'{enter_request_text}' ,line_shape='hv', line=dict(width=3, color=enter_and_exit_colors[1], dash="dash")), row=1, col=1)
+    size_plot.add_trace(Scatter(legendgroup='price_dots',legendgrouptitle_text='position',x=[position['enter_order_request_timestamp']], y=[position['enter_order_requested_price']], name=f'{enter_request_text}' ,line_shape='hv', line=dict(width=3, color=enter_and_exit_colors[0], dash="dash")), row=1, col=1)
+    size_plot.add_trace(Scatter(legendgroup='price_dots',legendgrouptitle_text='position',x=[position['enter_order_time']], y=[position['enter_order_executed_price']], name=f'{enter_request_text}' ,line_shape='hv', line=dict(width=3, color=enter_and_exit_colors[1], dash="dash")), row=1, col=1)
 
-    size_plot.add_trace(G.Scatter(legendgroup='price_dots',legendgrouptitle_text='position',x=[position['exit_order_request_timestamp']], y=[position['exit_order_requested_price']], name=f'{exit_request_text}' ,line_shape='hv', line=dict(width=3, color=enter_and_exit_colors[0], dash="dash")), row=1, col=1)
-    size_plot.add_trace(G.Scatter(legendgroup='price_dots',legendgrouptitle_text='position',x=[position['exit_order_time']], y=[position['exit_order_executed_price']], name=f'{exit_execute_text}' ,line_shape='hv', line=dict(width=3, color=enter_and_exit_colors[1], dash="dash")), row=1, col=1)
+    size_plot.add_trace(Scatter(legendgroup='price_dots',legendgrouptitle_text='position',x=[position['exit_order_request_timestamp']], y=[position['exit_order_requested_price']], name=f'{exit_request_text}' ,line_shape='hv', line=dict(width=3, color=enter_and_exit_colors[0], dash="dash")), row=1, col=1)
+    size_plot.add_trace(Scatter(legendgroup='price_dots',legendgrouptitle_text='position',x=[position['exit_order_time']], y=[position['exit_order_executed_price']], name=f'{exit_execute_text}' ,line_shape='hv', line=dict(width=3, color=enter_and_exit_colors[1], dash="dash")), row=1, col=1)
 
 
-    price_plot.add_trace(G.Scatter(legendgroup='price_dots',legendgrouptitle_text='price_dots',x=[position['enter_order_request_timestamp']], y=[position['enter_order_requested_price']], name=f'{enter_request_text}' ,line_shape='hv', line=dict(width=3, color=enter_and_exit_colors[0], dash="dash")), row=1, col=1)
-    price_plot.add_trace(G.Scatter(legendgroup='price_dots',legendgrouptitle_text='price_dots',x=[position['enter_order_time']], y=[position['enter_order_executed_price']], name=f'{enter_execute_text}' ,line_shape='hv', line=dict(width=3, color=enter_and_exit_colors[1], dash="dash")), row=1, col=1)
+    price_plot.add_trace(Scatter(legendgroup='price_dots',legendgrouptitle_text='price_dots',x=[position['enter_order_request_timestamp']], y=[position['enter_order_requested_price']], name=f'{enter_request_text}' ,line_shape='hv', line=dict(width=3, color=enter_and_exit_colors[0], dash="dash")), row=1, col=1)
+    price_plot.add_trace(Scatter(legendgroup='price_dots',legendgrouptitle_text='price_dots',x=[position['enter_order_time']], y=[position['enter_order_executed_price']], name=f'{enter_execute_text}' ,line_shape='hv', line=dict(width=3, color=enter_and_exit_colors[1], dash="dash")), row=1, col=1)
 
-    price_plot.add_trace(G.Scatter(legendgroup='price_dots',legendgrouptitle_text='price_dots',x=[position['exit_order_request_timestamp']], y=[position['exit_order_requested_price']], name=f'{exit_request_text}', line=dict(width=3, color=enter_and_exit_colors[0], dash="dash")), row=1, col=1)
-    price_plot.add_trace(G.Scatter(legendgroup='price_dots',legendgrouptitle_text='price_dots',x=[position['exit_order_time']], y=[position['exit_order_executed_price']], name=f'{exit_execute_text}' , line=dict(width=3, color=enter_and_exit_colors[1], dash="dash")), row=1, col=1)
+    price_plot.add_trace(Scatter(legendgroup='price_dots',legendgrouptitle_text='price_dots',x=[position['exit_order_request_timestamp']], y=[position['exit_order_requested_price']], name=f'{exit_request_text}', line=dict(width=3, color=enter_and_exit_colors[0], dash="dash")), row=1, col=1)
+    price_plot.add_trace(Scatter(legendgroup='price_dots',legendgrouptitle_text='price_dots',x=[position['exit_order_time']], y=[position['exit_order_executed_price']], name=f'{exit_execute_text}' , line=dict(width=3, color=enter_and_exit_colors[1], dash="dash")), row=1, col=1)
     
 
     # From comment1 retreive info about the difs that caused the signal
 
     for signal_dif in position['signal_difs']:
         dif_nickname = f"{signal_dif['brokers'][0]}/{signal_dif['brokers'][1]}, {signal_dif['size']}, init: {signal_dif['initiating_broker']}"
-        price_plot.add_trace(G.Scatter(legendgroup='signal',legendgrouptitle_text='signal',x=[pd.to_datetime(signal_dif['bbp_timestamp'],unit='ms')]*2, y=[min_bid,max_offer], name=f'{dif_nickname}' ,line_shape='hv', line=dict(width=2, color='black', dash="dash")), row=1, col=1)
+        price_plot.add_trace(Scatter(legendgroup='signal',legendgrouptitle_text='signal',x=[pd.to_datetime(signal_dif['bbp_timestamp'],unit='ms')]*2, y=[min_bid,max_offer], name=f'{dif_nickname}' ,line_shape='hv', line=dict(width=2, color='black', dash="dash")), row=1, col=1)
 
 
 
@@ -479,11 +1244,11 @@ def position_plots(difs, position, brokers,brokers_dict,merged,broker_groups, ti
         for before_dif in position['difs_before']:
             dif_text = f"{before_dif['dif_name']} | {before_dif['direction_research']} | {before_dif['dif_value']}"
             dif_datetime = pd.to_datetime(before_dif['dif_bbp_timestamp'],unit='ms')
-            price_plot.add_trace(G.Scatter(legendgroup='NY Difs',visible = 'legendonly',legendgrouptitle_text='NY Difs',x=[dif_datetime]*2, y=[min_bid,max_offer], name=f'{dif_text}' ,line_shape='hv', line=dict(width=1, color=before_after_color, dash="dash")), row=1, col=1)
+            price_plot.add_trace(Scatter(legendgroup='NY Difs',visible = 'legendonly',legendgrouptitle_text='NY Difs',x=[dif_datetime]*2, y=[min_bid,max_offer], name=f'{dif_text}' ,line_shape='hv', line=dict(width=1, color=before_after_color, dash="dash")), row=1, col=1)
         for after_dif in position['difs_after']:
             dif_text = f"{after_dif['dif_name']} | {after_dif['direction_research']} | {after_dif['dif_value']}"
             dif_datetime = pd.to_datetime(after_dif['dif_bbp_timestamp'],unit='ms')
-            price_plot.add_trace(G.Scatter(legendgroup='NY Difs',visible = 'legendonly',legendgrouptitle_text='NY Difs',x=[dif_datetime]*2, y=[min_bid,max_offer], name=f'{dif_text}' ,line_shape='hv', line=dict(width=1, color=before_after_color, dash="dash")), row=1, col=1)
+            price_plot.add_trace(Scatter(legendgroup='NY Difs',visible = 'legendonly',legendgrouptitle_text='NY Difs',x=[dif_datetime]*2, y=[min_bid,max_offer], name=f'{dif_text}' ,line_shape='hv', line=dict(width=1, color=before_after_color, dash="dash")), row=1, col=1)
         
     
 
@@ -520,10 +1285,12 @@ def position_plots(difs, position, brokers,brokers_dict,merged,broker_groups, ti
                     y=1.0,
                     bordercolor='black',
                     borderwidth=1)
+    if max_trace_points is not None:
+        print(f"reduced traces: removed {points_count['removed']} of {points_count['total']} points")
     # print(type(price_plot))
     return price_plot,size_plot
 
-def delta_plots(dif, brokers,brokers_dict,merged, time_buffer=0.5,graph_other_brokers = True):
+def delta_plots(dif, brokers,brokers_dict,merged, time_buffer=0.5,graph_other_brokers = True,window_index=None,max_trace_points=None,render_mode='svg',webgl_threshold=WEBGL_POINTS_THRESHOLD):
     '''
 
     -----------
@@ -540,14 +1307,42 @@ def delta_plots(dif, brokers,brokers_dict,merged, time_buffer=0.5,graph_other_br
         how many mins before and after the dif should show on the graph
     graph_other_brokers: bool
         if to graph all other brokers that are not participating nor in delta
+    window_index: BookWindowIndex
+        index of brokers_dict and merged built once per day, built here if not given
+    max_trace_points: int or None
+        if given, every broker trace is reduced with reduce_trace() to at most this many points
+    render_mode: str
+        'svg', 'webgl' or 'auto', see plot_scatter_type()
+    webgl_threshold: int
+        'auto' only, the number of plotted points above which WebGL traces are used
     
     '''
+    if window_index is None:
+        window_index = BookWindowIndex(brokers_dict, merged)
 
     dif_bbp_timestamp = dif['dif_bbp_timestamp']
     
     lower_limit = dif_bbp_timestamp - 60000*time_buffer
     upper_limit = dif_bbp_timestamp + 60000*time_buffer
 
+    # the points at the dif are kept when the traces are reduced
+    keep_times = [_to_naive_datetime(dif_bbp_timestamp)]
+    points_count = {'total': 0, 'removed': 0}
+    def trace_points(broker_df_timeframe, col_name):
+        '''
+        x and y of a broker's trace, reduced with reduce_trace() if max_trace_points is given
+        '''
+        if max_trace_points is None:
+            return dict(x=broker_df_timeframe.index, y=broker_df_timeframe[col_name])
+        x, y, removed = reduce_trace(broker_df_timeframe.index, broker_df_timeframe[col_name], max_trace_points, keep_times)
+        points_count['total'] += len(broker_df_timeframe)
+        points_count['removed'] += removed
+        return dict(x=x, y=y)
+
+    # the brokers in the delta, and the others if they are drawn
+    traced_brokers = [broker_name for broker_name in brokers if graph_other_brokers or broker_name in dif['dif_name']]
+    Scatter = plot_scatter_type(render_mode, window_index, traced_brokers, lower_limit, upper_limit, max_trace_points=max_trace_points, webgl_threshold=webgl_threshold)
+
     bbp_datetime = pd.to_datetime(dif_bbp_timestamp)
 
     offer_columns = []
@@ -559,11 +1354,9 @@ def delta_plots(dif, brokers,brokers_dict,merged, time_buffer=0.5,graph_other_br
             offer_columns.append(col)
 
 
-    merged_timeframe = merged.loc[(merged.bbp_timestamp >= lower_limit) & (merged.bbp_timestamp < upper_limit)]
-    merged_timeframe = merged_timeframe.drop_duplicates()
-    
-    max_offer = merged_timeframe[offer_columns].max().max()
-    min_bid = merged_timeframe[bid_columns].min().min()
+    # the height of the marker lines
+    max_offer = window_index.merged_extreme(offer_columns, lower_limit, upper_limit, 'max')
+    min_bid = window_index.merged_extreme(bid_columns, lower_limit, upper_limit, 'min')
 
 
     # color list from which the colors of the lines will be generated
@@ -599,34 +1392,34 @@ def delta_plots(dif, brokers,brokers_dict,merged, time_buffer=0.5,graph_other_br
                 bid_col_name = broker_name + "_bid"
                 offer_col_name = broker_name + "_offer"
                 
-                broker_df_timeframe = brokers_dict[broker_name].loc[(brokers_dict[broker_name].bbp_timestamp >= lower_limit) & (brokers_dict[broker_name].bbp_timestamp < upper_limit)]
+                broker_df_timeframe = window_index.broker_window(broker_name, lower_limit, upper_limit)
 
 
-                price_plot.add_trace(G.Scatter(legendgroup='not in delta',legendgrouptitle_text='not in delta',x=broker_df_timeframe.index, y=broker_df_timeframe[bid_col_name], name=bid_col_name,line_shape='hv', line=dict(width=1, color=colors_list[color_index_to_use], dash="dash")), row=1, col=1)
-                price_plot.add_trace(G.Scatter(legendgroup='not in delta',x=broker_df_timeframe.index, y=broker_df_timeframe[offer_col_name], name=offer_col_name ,line_shape='hv', line=dict(width=1, color=colors_list[color_index_to_use])), row=1, col=1)
+                price_plot.add_trace(Scatter(legendgroup='not in delta',legendgrouptitle_text='not in delta',**trace_points(broker_df_timeframe, bid_col_name), name=bid_col_name,line_shape='hv', line=dict(width=1, color=colors_list[color_index_to_use], dash="dash")), row=1, col=1)
+                price_plot.add_trace(Scatter(legendgroup='not in delta',**trace_points(broker_df_timeframe, offer_col_name), name=offer_col_name ,line_shape='hv', line=dict(width=1, color=colors_list[color_index_to_use])), row=1, col=1)
 
-                size_plot.add_trace(G.Scatter(legendgroup='not in delta',legendgrouptitle_text='not in delta',x=broker_df_timeframe.index, y=broker_df_timeframe[f'{bid_col_name}_size'], name=f'{bid_col_name}_size',line_shape='hv', line=dict(width=1, color=colors_list[color_index_to_use], dash="dash")), row=1, col=1)
-                size_plot.add_trace(G.Scatter(legendgroup='not in delta',x=broker_df_timeframe.index, y=broker_df_timeframe[f'{offer_col_name}_size'], name=f'{offer_col_name}_size' ,line_shape='hv', line=dict(width=1, color=colors_list[color_index_to_use])), row=1, col=1)
+                size_plot.add_trace(Scatter(legendgroup='not in delta',legendgrouptitle_text='not in delta',**trace_points(broker_df_timeframe, f'{bid_col_name}_size'), name=f'{bid_col_name}_size',line_shape='hv', line=dict(width=1, color=colors_list[color_index_to_use], dash="dash")), row=1, col=1)
+                size_plot.add_trace(Scatter(legendgroup='not in delta',**trace_points(broker_df_timeframe, f'{offer_col_name}_size'), name=f'{offer_col_name}_size' ,line_shape='hv', line=dict(width=1, color=colors_list[color_index_to_use])), row=1, col=1)
                 color_index_to_use+=1 #manual
         else:
             #print('dif', broker_name)
             bid_col_name = broker_name + "_bid"
             offer_col_name = broker_name + "_offer"
-            broker_df_timeframe = brokers_dict[broker_name].loc[(brokers_dict[broker_name].bbp_timestamp >= lower_limit) & (brokers_dict[broker_name].bbp_timestamp < upper_limit)]
+            broker_df_timeframe = window_index.broker_window(broker_name, lower_limit, upper_limit)
 
 
-            price_plot.add_trace(G.Scatter(legendgroup='in delta',legendgrouptitle_text='in delta',x=broker_df_timeframe.index, y=broker_df_timeframe[bid_col_name], name=bid_col_name,line_shape='hv', line=dict(width=1, color=colors_list[color_index_to_use], dash="dash")), row=1, col=1)
-            price_plot.add_trace(G.Scatter(legendgroup='in delta',x=broker_df_timeframe.index, y=broker_df_timeframe[offer_col_name], name=offer_col_name ,line_shape='hv', line=dict(width=1, color=colors_list[color_index_to_use])), row=1, col=1)
+            price_plot.add_trace(Scatter(legendgroup='in delta',legendgrouptitle_text='in delta',**trace_points(broker_df_timeframe, bid_col_name), name=bid_col_name,line_shape='hv', line=dict(width=1, color=colors_list[color_index_to_use], dash="dash")), row=1, col=1)
+            price_plot.add_trace(Scatter(legendgroup='in delta',**trace_points(broker_df_timeframe, offer_col_name), name=offer_col_name ,line_shape='hv', line=dict(width=1, color=colors_list[color_index_to_use])), row=1, col=1)
 
-            size_plot.add_trace(G.Scatter(legendgroup='in delta',legendgrouptitle_text='in delta',x=broker_df_timeframe.index, y=broker_df_timeframe[f'{bid_col_name}_size'], name=f'{bid_col_name}_size',line_shape='hv', line=dict(width=1, color=colors_list[color_index_to_use], dash="dash")), row=1, col=1)
-            size_plot.add_trace(G.Scatter(legendgroup='in delta',x=broker_df_timeframe.index, y=broker_df_timeframe[f'{offer_col_name}_size'], name=f'{offer_col_name}_size' ,line_shape='hv', line=dict(width=1, color=colors_list[color_index_to_use])), row=1, col=1)
+            size_plot.add_trace(Scatter(legendgroup='in delta',legendgrouptitle_text='in delta',**trace_points(broker_df_timeframe, f'{bid_col_name}_size'), name=f'{bid_col_name}_size',line_shape='hv', line=dict(width=1, color=colors_list[color_index_to_use], dash="dash")), row=1, col=1)
+            size_plot.add_trace(Scatter(legendgroup='in delta',**trace_points(broker_df_timeframe, f'{offer_col_name}_size'), name=f'{offer_col_name}_size' ,line_shape='hv', line=dict(width=1, color=colors_list[color_index_to_use])), row=1, col=1)
             color_index_to_use+=1 #manual
     
     # adding the vertical line to mark the dif
     dif_datetime= pd.to_datetime(dif_bbp_timestamp,unit='ms')
     dif_nickname = dif['dif_name']
-    size_plot.add_trace(G.Scatter(legendgroup='delta',legendgrouptitle_text='delta',x=[dif_datetime]*2, y=[min_bid,max_offer], name=f'{dif_nickname}' ,line_shape='hv', line=dict(width=2, color='black', dash="dash")), row=1, col=1)
-    price_plot.add_trace(G.Scatter(legendgroup='delta',legendgrouptitle_text='delta',x=[dif_datetime]*2, y=[min_bid,max_offer], name=f'{dif_nickname}' ,line_shape='hv', line=dict(width=2, color='black', dash="dash")), row=1, col=1)
+    size_plot.add_trace(Scatter(legendgroup='delta',legendgrouptitle_text='delta',x=[dif_datetime]*2, y=[min_bid,max_offer], name=f'{dif_nickname}' ,line_shape='hv', line=dict(width=2, color='black', dash="dash")), row=1, col=1)
+    price_plot.add_trace(Scatter(legendgroup='delta',legendgrouptitle_text='delta',x=[dif_datetime]*2, y=[min_bid,max_offer], name=f'{dif_nickname}' ,line_shape='hv', line=dict(width=2, color='black', dash="dash")), row=1, col=1)
     
 
     
@@ -635,6 +1428,8 @@ def delta_plots(dif, brokers,brokers_dict,merged, time_buffer=0.5,graph_other_br
         "Time: %{x}",
         "Rate: %{y}",
     ]))
+    if max_trace_points is not None:
+        print(f"reduced traces: removed {points_count['removed']} of {points_count['total']} points")
     return price_plot,size_plot
 
 def sync_positions_and_difs(position_list, dif_list,time_before_dif,time_after_dif,broker_groups):
@@ -820,7 +1615,337 @@ def sync_signal_no_position_and_dif_list(signal_no_position,dif_list,broker_grou
             #print(f"Dif and failed position match not found. time is: {failed_position['datetime']}")
     print('done syncing failed positions')
 
-def sync_interesting_deltas(dif_list,broker_groups,position_list,merged, failed_position_list,brokers,brokers_dict,working_date,aws_handler,raw_positions,raw_signal_no_position,time_before_dif,time_after_dif,graph_other_brokers):
+def normalize_broker_name(broker_name):
+    '''
+    converts a broker name from the rate collector to the name used in mongo:
+    BROKER_LONDON1 -> LONDON1, BROKER_NY_A -> NY_A
+    '''
+    if 'LONDON' in broker_name:
+        broker_name = broker_name.split('_')[1]
+    if 'NY' in broker_name:
+        broker_name = broker_name.replace('BROKER_','')
+    return broker_name
+
+def broker_pair_key(brokers, normalize_names=False):
+    '''
+    canonical key of a broker pair, the same for [a, b] and [b, a]
+
+    ----------
+    parameters:
+    brokers: array
+        the brokers of the pair, e.g. dif_name.split('-') or an item of broker_pairs
+    normalize_names: bool
+        if to apply normalize_broker_name() to every broker first
+    '''
+    if normalize_names:
+        brokers = [normalize_broker_name(broker_name) for broker_name in brokers]
+    return tuple(sorted(brokers))
+
+class DifMatchIndex:
+    '''
+    Index over the day's dif_list for matching positions and failed signals to difs without scanning the
+    whole list for every position. Lookups return indices into dif_list, in dif_list order.
+
+    - by_timestamp / by_int_timestamp: hash index on dif_bbp_timestamp (as is / as int)
+    - a sorted int timestamp array for lookups with a tolerance window
+    - a sorted timestamp array of the difs whose first broker is in NY, for difs_before and difs_after
+
+    ----------
+    parameters:
+    dif_list: dict
+        dictionary containing all of the day's deltas
+    ny_brokers: array
+        the NY broker group, broker_groups['NY']
+    '''
+    def __init__(self, dif_list, ny_brokers):
+        self.by_timestamp = {}
+        self.by_int_timestamp = {}
+        if isinstance(dif_list, DeltaTable):
+            # read the columns instead of a record per dif
+            timestamps = dif_list.values('dif_bbp_timestamp').tolist()
+            names = dif_list.columns['dif_name']
+            ny_names = np.array([name.split('-')[0] in ny_brokers for name in names.categories], dtype=bool)
+            in_ny = ny_names[names.codes] if len(ny_names) > 0 else np.zeros(len(dif_list), dtype=bool)
+        else:
+            timestamps = [dif['dif_bbp_timestamp'] for dif in dif_list]
+            in_ny = [dif['dif_name'].split('-')[0] in ny_brokers for dif in dif_list]
+        ny_indices = []
+        for i, ts in enumerate(timestamps):
+            self.by_timestamp.setdefault(ts, []).append(i)
+            self.by_int_timestamp.setdefault(int(ts), []).append(i)
+            if in_ny[i]:
+                ny_indices.append(i)
+
+        int_timestamps = np.array([int(ts) for ts in timestamps], dtype=np.int64)
+        self.int_order = np.argsort(int_timestamps, kind='mergesort')
+        self.sorted_int_timestamps = int_timestamps[self.int_order]
+
+        ny_indices = np.array(ny_indices, dtype=np.int64)
+        ny_timestamps = np.array([timestamps[i] for i in ny_indices], dtype=float)
+        ny_order = np.argsort(ny_timestamps, kind='mergesort')
+        self.ny_indices = ny_indices[ny_order]
+        self.sorted_ny_timestamps = ny_timestamps[ny_order]
+
+    def at(self, ts):
+        '''
+        difs with dif_bbp_timestamp == ts
+        '''
+        if ts != ts:
+            return []
+        return self.by_timestamp.get(ts, [])
+
+    def at_int(self, ts, tolerance_ms=None):
+        '''
+        difs with int(dif_bbp_timestamp) == int(ts), or within tolerance_ms of it if a tolerance is given
+        '''
+        if not tolerance_ms:
+            return self.by_int_timestamp.get(int(ts), [])
+        start = np.searchsorted(self.sorted_int_timestamps, int(ts) - tolerance_ms, side='left')
+        stop = np.searchsorted(self.sorted_int_timestamps, int(ts) + tolerance_ms, side='right')
+        return np.sort(self.int_order[start:stop]).tolist()
+
+    def ny_between(self, lower, upper):
+        '''
+        difs whose first broker is in NY with lower < dif_bbp_timestamp < upper
+        '''
+        start = np.searchsorted(self.sorted_ny_timestamps, lower, side='right')
+        stop = np.searchsorted(self.sorted_ny_timestamps, upper, side='left')
+        return np.sort(self.ny_indices[start:stop]).tolist()
+
+def sync_positions_and_difs_indexed(position_list, dif_list,time_before_dif,time_after_dif,broker_groups,tolerance_ms=None,dif_index=None):
+    '''
+    Same as sync_positions_and_difs(), with the difs looked up in a DifMatchIndex instead of
+    comparing every position to every dif. The matches and mismatches are the same.
+
+    -----------
+    parameters:
+    dif_list: dict
+        dictionary containing all of the day's deltas
+    position_list: array
+        list of positions retreived from mongo
+    tolerance_ms: int or None
+        if given, difs up to this many ms away from the position's dif_bbp_timestamp are matched too
+    dif_index: DifMatchIndex
+        index of dif_list, built here if not given
+    '''
+    print('syncing positions')
+    if dif_index is None:
+        dif_index = DifMatchIndex(dif_list, broker_groups['NY'])
+    mismatches = []
+    for pos in position_list:
+        ts = pos['dif_bbp_timestamp']
+        dif_found = False
+        dif_found_ts_based = False
+        dif_found_ts_broker_based = False
+        position_pairs = {broker_pair_key(pair) for pair in pos['broker_pairs']}
+
+        for i in dif_index.at_int(ts, tolerance_ms):
+            dif = dif_list[i]
+            dif_found_ts_based = True
+            dif_brokers = dif['dif_name'].split('-')
+            if broker_pair_key(dif_brokers) in position_pairs:
+                dif_found_ts_broker_based = True
+                if dif['direction_research'] == pos['direction']:
+                    dif_found = True
+                    dif.update({'position_id':str(pos['_id'])})
+                    pos['dif_ids'] = pos['dif_ids'] + [dif['id']]
+                    print(f"Dif and position match found: {pos['_id']}")
+                else:
+                    print('direction mistmatch')
+                    print(f'reaserch {dif["direction_research"]} vs {pos["direction"]}')
+            else:
+                print('broker mistmatch')
+                print(f'{[dif_brokers[1],dif_brokers[0]]} not found in {pos["broker_pairs"]}')
+
+        # difs between lower and upper limit go to the before and after lists
+        lower_limit = ts - 60000*time_before_dif
+        upper_limit = ts + 60000*time_after_dif
+        pos['difs_before'] = [dif_list[i] for i in dif_index.ny_between(lower_limit, ts)]
+        pos['difs_after'] = [dif_list[i] for i in dif_index.ny_between(ts, upper_limit)]
+
+        if dif_found:
+            pass
+        elif dif_found_ts_broker_based:
+            print(f"Dif and Position direction mismatch. id is: {pos['_id']}. time is: {pos['enter_order_request_timestamp']}")
+            mismatches.append(f"Dif and Position direction mismatch. id is: {pos['_id']}. time is: {pos['enter_order_request_timestamp']}")
+        elif dif_found_ts_based:
+            print(f"Dif and Position broker mismatch. id is: {pos['_id']}. time is: {pos['enter_order_request_timestamp']}")
+            mismatches.append(f"Dif and Position broker mismatch. id is: {pos['_id']}. time is: {pos['enter_order_request_timestamp']}")
+        else:
+            print(f"Dif and Position timestamp mismatch. id is: {pos['_id']}. ts is: {pos['dif_bbp_timestamp']}. {pos['broker_pairs']}")
+            for i in dif_index.at(pos['dif_bbp_timestamp']):
+                print('found, this is bad!1')
+            mismatches.append(pos['dif_bbp_timestamp'])
+
+    # difs that didn't match any position
+    if len(position_list) > 0:
+        for dif in dif_list:
+            dif.setdefault('position_id', str(-1))
+
+    print('----- MISMATCHES: ------')
+    for m in mismatches:
+        print(m)
+        if not isinstance(m, str):
+            for i in dif_index.at(m):
+                print('found, this is bad!')
+
+    print('------ analysis: -------')
+    counter = 0
+    for pos in position_list:
+        if len(pos['dif_ids']) > 0:
+            counter+=1
+    print(f"{counter} / {len(position_list)} have dif ids")
+    counter = 0
+    for pos in position_list:
+        counter += len(dif_index.at_int(pos['dif_bbp_timestamp']))
+    print(f'counter {counter}')
+    print('done syncing positions')
+
+def sync_signal_no_position_and_dif_list_indexed(signal_no_position,dif_list,broker_groups,tolerance_ms=None,dif_index=None):
+    '''
+    Same as sync_signal_no_position_and_dif_list(), with the difs looked up in a DifMatchIndex instead of
+    comparing every failed position to every dif. The matches are the same.
+
+    -----------
+    parameters:
+    dif_list: dict
+        dictionary containing all of the day's deltas
+    signal_no_position: array
+        list of failed positions retreived from mongo
+    tolerance_ms: int or None
+        if given, difs up to this many ms away from the failed position's dif_bbp_timestamp are matched too
+    dif_index: DifMatchIndex
+        index of dif_list, built here if not given
+    '''
+    print('syncing failed positions')
+    if dif_index is None:
+        dif_index = DifMatchIndex(dif_list, broker_groups['NY'])
+    for failed_position in signal_no_position:
+        ts = failed_position['dif_bbp_timestamp']
+        failed_position_pairs = {broker_pair_key(pair) for pair in failed_position['broker_pairs']}
+        if tolerance_ms:
+            dif_indices = dif_index.at_int(ts, tolerance_ms)
+        else:
+            dif_indices = dif_index.at(ts)
+        for i in dif_indices:
+            dif = dif_list[i]
+            if broker_pair_key(dif['dif_name'].split('-'), normalize_names=True) in failed_position_pairs:
+                print(f"Dif and failed position match found: {dif['id']}, {failed_position['broker_pairs']}, {dif['dif_name']}")
+                dif.update({'failed_position_id':str(failed_position['_id'])})
+                failed_position['dif_ids'] = failed_position['dif_ids'] + [dif['id']]
+
+    # difs that didn't match any failed position
+    if len(signal_no_position) > 0:
+        for dif in dif_list:
+            dif.setdefault('failed_position_id', str(-1))
+    print('done syncing failed positions')
+
+# the day's book data of a render worker process, set once per worker by _init_render_worker()
+_render_worker_state = {}
+
+def _init_render_worker(brokers, brokers_dict, merged, broker_groups, time_before_dif, time_after_dif, graph_other_brokers, max_trace_points, include_plotlyjs, render_mode):
+    _render_worker_state['brokers'] = brokers
+    _render_worker_state['brokers_dict'] = brokers_dict
+    _render_worker_state['merged'] = merged
+    _render_worker_state['broker_groups'] = broker_groups
+    _render_worker_state['time_before_dif'] = time_before_dif
+    _render_worker_state['time_after_dif'] = time_after_dif
+    _render_worker_state['graph_other_brokers'] = graph_other_brokers
+    _render_worker_state['max_trace_points'] = max_trace_points
+    _render_worker_state['include_plotlyjs'] = include_plotlyjs
+    _render_worker_state['render_mode'] = render_mode
+    _render_worker_state['window_index'] = BookWindowIndex(brokers_dict, merged)
+
+def render_position_html(pos, brokers, brokers_dict, merged, broker_groups, time_before_dif, time_after_dif, graph_other_brokers, window_index=None, max_trace_points=None, include_plotlyjs=True, render_mode='svg'):
+    '''
+    builds the position's price plot with position_plots() and returns it as an html string.
+    include_plotlyjs goes to plotly.io.to_html(): True embeds plotly.js in the page, a path to a .js file references it.
+    render_mode is 'svg', 'webgl' or 'auto', see plot_scatter_type()
+    '''
+    price_plot,size_plot = position_plots(difs=pos['dif_ids'],broker_groups=broker_groups,merged=merged,position = pos,brokers=brokers,time_after_dif=time_after_dif,time_before_dif=time_before_dif,graph_other_brokers=graph_other_brokers,brokers_dict=brokers_dict,window_index=window_index,max_trace_points=max_trace_points,render_mode=render_mode)
+    return plotly.io.to_html(price_plot, include_plotlyjs=include_plotlyjs)
+
+def _render_position_in_worker(pos):
+    return render_position_html(pos, **_render_worker_state)
+
+def _print_render_failure(pos, e):
+    print(f"failed to render position {pos['_id']}")
+    print(e)
+
+def render_positions_serial(position_list, brokers, brokers_dict, merged, broker_groups, time_before_dif, time_after_dif, graph_other_brokers, max_trace_points=None, include_plotlyjs=True, render_mode='svg'):
+    '''
+    renders the positions' html one after the other and yields (pos, html_string), like render_positions_parallel().
+    A position that fails to render is printed and yielded with html_string None, the rest of the batch continues.
+    '''
+    window_index = BookWindowIndex(brokers_dict, merged)
+    for pos in position_list:
+        try:
+            html_string = render_position_html(pos, brokers, brokers_dict, merged, broker_groups, time_before_dif, time_after_dif, graph_other_brokers, window_index=window_index, max_trace_points=max_trace_points, include_plotlyjs=include_plotlyjs, render_mode=render_mode)
+        except Exception as e:
+            _print_render_failure(pos, e)
+            html_string = None
+        yield pos, html_string
+
+def render_positions_parallel(position_list, brokers, brokers_dict, merged, broker_groups, time_before_dif, time_after_dif, graph_other_brokers, render_processes, max_trace_points=None, include_plotlyjs=True, render_mode='svg'):
+    '''
+    renders the positions' html in a pool of render_processes processes and yields (pos, html_string) as they finish.
+    The book data is sent to every worker once, when the worker starts, and not with every position.
+    A position that fails to render is printed and yielded with html_string None, the rest of the batch continues.
+
+    -----------
+    parameters:
+    position_list: array
+        the positions to render, all with dif ids
+    render_processes: int
+        size of the process pool
+    include_plotlyjs: bool or str
+        see render_position_html()
+    render_mode: str
+        see render_position_html()
+    '''
+    with ProcessPoolExecutor(
+            max_workers=render_processes,
+            initializer=_init_render_worker,
+            initargs=(brokers, brokers_dict, merged, broker_groups, time_before_dif, time_after_dif, graph_other_brokers, max_trace_points, include_plotlyjs, render_mode)) as executor:
+        futures = {executor.submit(_render_position_in_worker, pos): pos for pos in position_list}
+        for future in as_completed(futures):
+            pos = futures[future]
+            try:
+                html_string = future.result()
+            except Exception as e:
+                _print_render_failure(pos, e)
+                html_string = None
+            yield pos, html_string
+
+def upload_plotlyjs_asset(aws_handler, working_date, gzip_html=False):
+    '''
+    uploads the plotly.js bundle once for the day, as assets/plotly-{version}.min.js, and returns the path
+    the graphs under positions/ reference it by
+    '''
+    asset_name = f'assets/plotly-{plotly.__version__}.min.js'
+    plotlyjs = plotly.offline.get_plotlyjs().encode()
+    if gzip_html:
+        put_bytes_in_bucket(aws_handler, working_date=f'{working_date}', data=gzip.compress(plotlyjs), file_name_to_save=asset_name, bucket_name=f"delta-info-graphs", content_type='application/javascript', content_encoding='gzip')
+    else:
+        put_bytes_in_bucket(aws_handler, working_date=f'{working_date}', data=plotlyjs, file_name_to_save=asset_name, bucket_name=f"delta-info-graphs", content_type='application/javascript')
+    return f'../{asset_name}'
+
+def create_daily_index_html(position_list, working_date):
+    '''
+    html page of the day with a link to the graph of every position in position_list
+    '''
+    rows = []
+    for pos in position_list:
+        pos_id = html.escape(f'{pos["_id"]}')
+        dif_ids = html.escape(', '.join(f'{dif_id}' for dif_id in pos['dif_ids']))
+        rows.append(f'<tr><td><a href="positions/{pos_id}.html">{pos_id}</a></td><td>{html.escape(str(pos.get("direction", "")))}</td><td>{dif_ids}</td><td>{pos.get("revenue_pips", "")}</td></tr>')
+    return f'''<html><head><meta charset="utf-8"><title>positions {working_date}</title></head><body>
+<h3>positions {working_date}</h3>
+<table><tr><th>position</th><th>direction</th><th>dif ids</th><th>revenue pips</th></tr>
+{chr(10).join(rows)}
+</table></body></html>'''
+
+def sync_interesting_deltas(dif_list,broker_groups,position_list,merged, failed_position_list,brokers,brokers_dict,working_date,aws_handler,raw_positions,raw_signal_no_position,time_before_dif,time_after_dif,graph_other_brokers,render_processes=None,max_trace_points=None,html_output='full',gzip_html=False,daily_index=False,render_mode='svg',graphed_position_ids=None,metrics=None):
     '''
     This cube makes sure every position has a found dif, and if the dif matches by time and by 
     broker to the positions, the position's _id is assigned to the dif
@@ -845,27 +1970,86 @@ def sync_interesting_deltas(dif_list,broker_groups,position_list,merged, failed_
         a flat df containing all prices and size for all brokers at a given time
     aws_handler: AWSHandler object
         object containing tools to retreive and upload files from/to S3
+    render_processes: int or None
+        if more than 1, the graphs are rendered in a pool of this many processes
+    max_trace_points: int or None
+        if given, the broker traces of every graph are reduced to at most this many points, see reduce_trace()
+    html_output: str
+        'full' embeds plotly.js in every graph. 'shared_js' uploads plotly.js once for the day, under assets/,
+        and every graph references it
+    gzip_html: bool
+        if to upload the graphs (and the shared plotly.js) gzip compressed, with Content-Encoding: gzip
+    daily_index: bool
+        if to upload an index.html for the day that links every position graph
+    render_mode: str
+        'svg', 'webgl' or 'auto' (WebGL for graphs with many points), see plot_scatter_type()
+    graphed_position_ids: set or None
+        ids of positions whose graphs were uploaded by an earlier run, they are not rendered again
+    metrics: StageMetrics object or None
+        records the render stage (one call per graph) and the upload stage (one call per file)
+
+    returns the set of ids of all the graphed positions, including graphed_position_ids, and the list of ids of the
+    positions that failed to render. those are not graphed, the next run with a checkpoint renders them again
     '''
     print('started syncing interesting difs')
-    for pos in position_list:
-        if len(pos['dif_ids']) == 0:
-            x=0
-            # try:
-            #     print('position does not have difs',raw_positions[failed_position_list.index(pos)]['comment1'])
-            # except:
-            #     print('failed position does not have difs',pos['_id'])
-        else:
-            price_plot,size_plot = position_plots(difs=pos['dif_ids'],broker_groups=broker_groups,merged=merged,position = pos,brokers=brokers,time_after_dif=time_after_dif,time_before_dif=time_before_dif,graph_other_brokers=graph_other_brokers,brokers_dict=brokers_dict)
-            graph_name = f'{pos["_id"]}'
-            html_string = plotly.io.to_html(price_plot)
+    positions_with_difs = [pos for pos in position_list if len(pos['dif_ids']) > 0]
+    graphed_ids = set() if graphed_position_ids is None else set(graphed_position_ids)
+    positions_to_render = [pos for pos in positions_with_difs if f'{pos["_id"]}' not in graphed_ids]
+
+    if html_output == 'shared_js':
+        with measure_stage(metrics, 'upload', rows_in=1):
+            include_plotlyjs = upload_plotlyjs_asset(aws_handler, working_date, gzip_html=gzip_html)
+    elif html_output == 'full':
+        include_plotlyjs = True
+    else:
+        raise ValueError(f'unknown html output {html_output}, choose full or shared_js')
 
-            aws_handler.save_html_file_in_bucket(working_date=f'{working_date}', html_string=html_string,file_name_to_save=f'positions/{graph_name}.html',bucket_name = f"delta-info-graphs")
+    if render_processes is not None and render_processes > 1:
+        rendered = render_positions_parallel(positions_to_render, brokers, brokers_dict, merged, broker_groups, time_before_dif, time_after_dif, graph_other_brokers, render_processes, max_trace_points=max_trace_points, include_plotlyjs=include_plotlyjs, render_mode=render_mode)
+    else:
+        rendered = render_positions_serial(positions_to_render, brokers, brokers_dict, merged, broker_groups, time_before_dif, time_after_dif, graph_other_brokers, max_trace_points=max_trace_points, include_plotlyjs=include_plotlyjs, render_mode=render_mode)
+
+    failed_ids = []
+    for pos, html_string in measure_iter(metrics, 'render', rendered):
+        graph_name = f'{pos["_id"]}'
+        if html_string is None:
+            failed_ids.append(graph_name)
+            continue
+        with measure_stage(metrics, 'upload', rows_in=1):
+            if gzip_html:
+                put_bytes_in_bucket(aws_handler, working_date=f'{working_date}', data=gzip.compress(html_string.encode()), file_name_to_save=f'positions/{graph_name}.html', bucket_name=f"delta-info-graphs", content_type='text/html', content_encoding='gzip')
+            else:
+                aws_handler.save_html_file_in_bucket(working_date=f'{working_date}', html_string=html_string,file_name_to_save=f'positions/{graph_name}.html',bucket_name = f"delta-info-graphs")
+        graphed_ids.add(graph_name)
+
+    if daily_index:
+        graphed_positions = [pos for pos in positions_with_difs if f'{pos["_id"]}' in graphed_ids]
+        with measure_stage(metrics, 'upload', rows_in=1):
+            aws_handler.save_html_file_in_bucket(working_date=f'{working_date}', html_string=create_daily_index_html(graphed_positions, working_date), file_name_to_save='index.html', bucket_name=f"delta-info-graphs")
+    if failed_ids:
+        print(f'failed to render {len(failed_ids)} positions: {", ".join(failed_ids)}')
+    return graphed_ids, failed_ids
         
 def get_mongo_positions_delta_lists(date):
     position_list,raw_positions = mongo_utils.retreive_position_dicts(date)
     signal_no_position,raw_signal_no_position = mongo_utils.retreive_delta_dict_mongo(date)
     return position_list,signal_no_position,raw_positions,raw_signal_no_position
 
+def fetch_positions(today, position_source=None):
+    '''
+    (position_list, signal_no_position, raw_positions, raw_signal_no_position) of the date, from mongo
+    unless a position source (see position_sources) is given
+    '''
+    if position_source is None:
+        return get_mongo_positions_delta_lists(today)
+    return position_source.load(today)
+
+def _fetch_positions_timed(today, position_source):
+    tic = time.perf_counter()
+    cpu_tic = time.thread_time()
+    positions = fetch_positions(today, position_source)
+    return positions, time.perf_counter() - tic, time.thread_time() - cpu_tic
+
 def text_to_datetime(txt):
     '''
     takes text {DD-MM-YYYY} and converts to datetime
@@ -894,6 +2078,12 @@ def create_delta_csv(dif_list,working_date,aws_handler,broker_groups,ran_dif_cei
     aws_handler: AWSHandler object
         object containing tools to retreive and upload files from/to S3
     '''
+    if isinstance(dif_list, DeltaTable):
+        df = delta_table_csv_frame(dif_list, broker_groups, ran_dif_ceiling)
+        df.sort_values(by='dif_bbp_timestamp', inplace=True)
+        aws_handler.save_file_in_bucket(working_date=f'{working_date}', df_to_save=df,file_name_to_save='delta_summary.csv',bucket_name = f"delta-info-graphs")
+        return
+
     lst = []
     for dif in dif_list:
         if dif['dif_value'] < ran_dif_ceiling:
@@ -914,6 +2104,27 @@ def create_delta_csv(dif_list,working_date,aws_handler,broker_groups,ran_dif_cei
     df.sort_values(by='dif_bbp_timestamp', inplace=True)
     aws_handler.save_file_in_bucket(working_date=f'{working_date}', df_to_save=df,file_name_to_save='delta_summary.csv',bucket_name = f"delta-info-graphs")
 
+def delta_table_csv_frame(delta_table, broker_groups, ran_dif_ceiling):
+    '''
+    create_delta_csv() on whole columns of a DeltaTable: the same ids and groups are set, and the same frame is returned
+    '''
+    below_ceiling = delta_table.values('dif_value') < ran_dif_ceiling
+    has_ids = delta_table.has('failed_position_id') & delta_table.has('position_id')
+    if has_ids.any():
+        delta_table.set_rows('failed_position_id', below_ceiling & has_ids & (delta_table.values('failed_position_id') == -1), 0)
+        delta_table.set_rows('position_id', below_ceiling & has_ids & (delta_table.values('position_id') == -1), 0)
+    # a dif without both ids fails the lookup in create_delta_csv()
+    delta_table.set_rows('failed_position_id', below_ceiling & ~has_ids, -2)
+    delta_table.set_rows('position_id', below_ceiling & ~has_ids, -2)
+
+    names = delta_table.columns['dif_name']
+    first_broker = np.array([name.split('-')[0] for name in names.categories], dtype=object)[names.codes]
+    for key in broker_groups.keys():
+        in_group = np.isin(first_broker, broker_groups[key])
+        if in_group.any():
+            delta_table.set_rows('group', in_group, key)
+    return delta_table.to_dataframe()
+
 def from_datetime(date):
     '''
     takes text datetime and converts to {DD-MM-YYYY}
@@ -932,14 +2143,47 @@ def from_datetime(date):
     s = f'{day}-{month}-{date.year}'
     return s
 
-def read_df_by_full_file_path(bucket_name, full_file_path):
-    s3_client = boto3.client('s3')
-    response = s3_client.get_object(Bucket=bucket_name, Key=full_file_path)
-    status = response.get("ResponseMetadata", {}).get("HTTPStatusCode")
-    df_data = pd.read_csv(response.get("Body"))
+def read_df_by_full_file_path(bucket_name, full_file_path, storage=None, **read_options):
+    '''
+    reads a csv object into a dataframe, from S3 unless another storage (see storage_backends) is given.
+    read_options go to pd.read_csv, e.g. QUOTE_CSV_OPTIONS
+    '''
+    if storage is None:
+        storage = S3Storage()
+    body, status = storage.open_object(bucket_name, full_file_path)
+    df_data = pd.read_csv(body, **read_options)
     return df_data, status
 
-def retreive(date):
+def read_quotes_by_full_file_path(bucket_name, full_file_path, time_range=None, chunksize=QUOTES_CHUNK_SIZE, storage=None):
+    '''
+    streams merged_raw_data from S3 in chunks, reading only QUOTE_COLUMNS, parsed with QUOTE_CSV_OPTIONS.
+    every chunk is filtered to the timeframe and then cleaned before the next one is read, so the whole raw
+    file is never in memory and the quotes out of the timeframe are never cleaned.
+
+    ----------
+    parameters:
+    time_range: tuple or None
+        (start, end) bbp_timestamp in ms of the timeframe, see time_range_ms(). None reads the whole file
+    chunksize: int
+        how many rows to parse at a time
+    storage: storage object or None
+        where to read from, S3 if not given
+    '''
+    if storage is None:
+        storage = S3Storage()
+    body, status = storage.open_object(bucket_name, full_file_path)
+    rows_read = 0
+    chunks = []
+    for chunk in pd.read_csv(body, usecols=QUOTE_COLUMNS, chunksize=chunksize, **QUOTE_CSV_OPTIONS):
+        rows_read += len(chunk)
+        chunk = filter_time_range(chunk, time_range)
+        chunk = clean_file(chunk)
+        chunks.append(chunk)
+    df_data = concat_quotes(chunks)
+    ingest_stats = {'rows_read': rows_read, 'rows_kept': len(df_data)}
+    return df_data, status, ingest_stats
+
+def retreive(date, storage=None):
     '''
     retrieves file from s3
 
@@ -947,20 +2191,134 @@ def retreive(date):
     parameters:
     date: txt
         {DD-MM-YYYY} 
+    storage: storage object or None
+        where to read from, S3 if not given
     '''
 
     #DD-MM-YYYY
     raw_data_file_path = os.path.join(date,MERGED_RAW_DATA_FILE_NAME)
     print(raw_data_file_path)
     try:
-        raw_data, upload_status = read_df_by_full_file_path(AWS_S3_BUCKET_NAME, raw_data_file_path)
+        raw_data, upload_status = read_df_by_full_file_path(AWS_S3_BUCKET_NAME, raw_data_file_path, storage=storage, **QUOTE_CSV_OPTIONS)
         print('retreived file')
         return raw_data
     except Exception as e:
         print(e)
         print('failed to retreive file')
 
-def create_delta_graphs_and_csv(today,start_hour, end_hour,broker_groups,dif_threashold,ran_dif_ceiling,dif_file_exists,dif_file,graph_other_brokers,time_before_dif,time_after_dif):
+def retreive_streaming(date, time_range=None, storage=None):
+    '''
+    retrieves file from s3 with read_quotes_by_full_file_path(), already cleaned and filtered to the timeframe
+
+    ----------
+    parameters:
+    date: txt
+        {DD-MM-YYYY} 
+    time_range: tuple or None
+        (start, end) bbp_timestamp in ms of the timeframe, see time_range_ms(). None for the whole file
+    storage: storage object or None
+        where to read from, S3 if not given
+    '''
+    raw_data_file_path = os.path.join(date,MERGED_RAW_DATA_FILE_NAME)
+    print(raw_data_file_path)
+    try:
+        raw_data, upload_status, ingest_stats = read_quotes_by_full_file_path(AWS_S3_BUCKET_NAME, raw_data_file_path, time_range, storage=storage)
+        print(f"retreived file, read {ingest_stats['rows_read']} rows, kept {ingest_stats['rows_kept']}")
+        return raw_data
+    except Exception as e:
+        print(e)
+        print('failed to retreive file')
+
+def load_day_quotes(working_date, start_hour, end_hour, streaming_ingest=False, day_cache=None, metrics=None, storage=None):
+    '''
+    returns the day's cleaned quotes in the timeframe, see load_quotes_window()
+
+    ----------
+    parameters:
+    working_date: sting
+        stiring of the date {DD-MM-YYYY}
+    start_hour: int
+        start of timeframe
+    end_hour: int
+        end of timeframe
+    '''
+    return load_quotes_window(working_date, time_range_ms(working_date, start_hour, end_hour), streaming_ingest=streaming_ingest, day_cache=day_cache, metrics=metrics, storage=storage)
+
+def load_quotes_window(working_date, time_range, streaming_ingest=False, day_cache=None, metrics=None, storage=None):
+    '''
+    returns the date's cleaned quotes with a bbp_timestamp in time_range, e.g. a few minutes around a position.
+    the local day_cache is checked before S3 is touched, and a day that had to be downloaded is added to it
+    (cleaned, before the timeframe filter). the quotes out of time_range are dropped as they are read: by the
+    cache before a dataframe is made of them, by a streaming read before they are cleaned and otherwise
+    before the day is cleaned (unless it is cached, then the whole day is)
+
+    ----------
+    parameters:
+    working_date: sting
+        stiring of the date {DD-MM-YYYY}
+    time_range: tuple or None
+        (start, end) bbp_timestamp in ms, the end excluded, see time_range_ms(). None for the whole day
+    streaming_ingest: bool
+        if to read merged_raw_data in chunks with only the needed columns
+    day_cache: DayCache object or None
+        local cache of cleaned quotes
+    metrics: StageMetrics object or None
+        records the read_cache, retrieve_s3, clean and hour_filter stages. with streaming_ingest the chunks are
+        filtered and cleaned while reading, and reading from the cache filters too, so that is all
+        retrieve_s3 or read_cache
+    storage: storage object or None
+        where to read merged_raw_data from, S3 if not given
+    '''
+    if day_cache is not None:
+        with measure_stage(metrics, 'read_cache') as stage:
+            file = day_cache.get(working_date, time_range=time_range)
+            stage.rows_out = 0 if file is None else len(file)
+        if file is not None:
+            return file
+
+    if streaming_ingest:
+        with measure_stage(metrics, 'retrieve_s3') as stage:
+            # the cache keeps the whole day, the timeframe is applied after
+            file = retreive_streaming(working_date, None if day_cache is not None else time_range, storage=storage)
+            stage.rows_out = len(file)
+    else:
+        with measure_stage(metrics, 'retrieve_s3') as stage:
+            file = retreive(working_date, storage=storage)
+            stage.rows_out = len(file)
+
+        # print(f'finished reading file ')
+        if day_cache is None:
+            # nothing out of the timeframe is cleaned
+            with measure_stage(metrics, 'hour_filter', rows_in=len(file)) as stage:
+                file = filter_time_range(file, time_range)
+                stage.rows_out = len(file)
+
+        with measure_stage(metrics, 'clean', rows_in=len(file)) as stage:
+            file = clean_file(file)
+            stage.rows_out = len(file)
+    print('finished cleaining file')
+
+    if day_cache is not None:
+        # only the columns used by the later stages are cached
+        day_cache.put(working_date, file[QUOTE_COLUMNS])
+        #for now there is a timeframe!
+        with measure_stage(metrics, 'hour_filter', rows_in=len(file)) as stage:
+            file = filter_time_range(file, time_range)
+            stage.rows_out = len(file)
+    return file
+
+def prefetch_day_quotes(storage, working_date, day_cache=None, checkpoint=None):
+    '''
+    starts downloading the date's merged_raw_data in the background if storage is a PrefetchingStorage and the
+    day will be read from it, not from the day cache (with a checkpoint the cache is not used)
+    '''
+    if not isinstance(storage, PrefetchingStorage):
+        return False
+    if day_cache is not None and checkpoint is None and os.path.exists(day_cache.path(working_date)):
+        return False
+    return storage.prefetch(AWS_S3_BUCKET_NAME, os.path.join(working_date,MERGED_RAW_DATA_FILE_NAME))
+
+def create_delta_graphs_and_csv(today,start_hour, end_hour,broker_groups,dif_threashold,ran_dif_ceiling,dif_file_exists,dif_file,graph_other_brokers,time_before_dif,time_after_dif,dif_engine='rows',streaming_ingest=False,day_cache=None,merge_mode='chained',sync_engine='scan',sync_tolerance_ms=None,render_processes=None,upload_workers=None,aws_handler=None,max_trace_points=None,html_output='full',gzip_html=False,daily_index=False,render_mode='svg',checkpoint=None,detection_processes=None,detection_slice_rows=None,delta_table=False,metrics=None,storage=None,position_source=None,pipelined=False):
     '''
     incorporates all the functions above to create graphs for each dif matching with a position/failed positions and save on S3
     creates csv containing all the info about the day's deltas and save on S3
@@ -972,87 +2330,407 @@ def create_delta_graphs_and_csv(today,start_hour, end_hour,broker_groups,dif_thr
         start of timeframe
     end_hour:
         end of timeframe
+    dif_engine: str
+        which delta engine to use, see DELTA_ENGINES
+    streaming_ingest: bool
+        if to read merged_raw_data in chunks with only the needed columns, cleaning and filtering while reading
+    day_cache: DayCache object or None
+        local cache of cleaned quotes, checked before downloading from S3
+    merge_mode: str
+        how to build the wide book, see merge_broker_dict()
+    sync_engine: str
+        'scan' compares every position to every dif, 'indexed' uses a DifMatchIndex
+    sync_tolerance_ms: int or None
+        'indexed' only, match difs up to this many ms away from the position instead of the exact timestamp
+    render_processes: int or None
+        if more than 1, render the position graphs in a pool of this many processes
+    upload_workers: int or None
+        if given, upload the graphs and csv in the background with a BackgroundUploader of this many threads.
+        the uploads are waited for at the end, and if some of them failed (after their retries) a RuntimeError
+        is raised, like a failed upload raises without upload_workers
+    aws_handler: AWSHandler object or None
+        where to save the graphs and csv. storage if not given, else a new S3Storage (a LocalDirectoryHandler works offline).
+        gzip_html and html_output='shared_js' upload bytes, which an AWSHandler can't, see put_bytes_in_bucket()
+    max_trace_points: int or None
+        if given, reduce every broker trace of the graphs to at most this many points
+    html_output, gzip_html, daily_index:
+        how the graphs are uploaded, see sync_interesting_deltas()
+    render_mode: str
+        'svg', 'webgl' or 'auto', see plot_scatter_type()
+    checkpoint: IntradayCheckpoint object or None
+        if given, run incrementally: only the quotes after the date's checkpoint are searched for deltas,
+        only positions that were not graphed yet are rendered, and the checkpoint is updated at the end with the
+        graphs that were uploaded. the rest of the run (reading, flattening, merging, syncing, the csv) still
+        covers the whole day so far
+    detection_processes: int or None
+        if more than 1, find the deltas of the broker groups (and their time slices) in a pool of this many processes
+    detection_slice_rows: int or None
+        with detection_processes, split a group into time slices of about this many quotes, see find_deltas_parallel()
+    delta_table: bool
+        if to keep the deltas in a DeltaTable (typed columns) instead of a list of dicts
+    metrics: StageMetrics object or None
+        if given, the time, memory and rows of every stage are saved to its metrics file of the date
+    storage: storage object or None
+        where merged_raw_data is read from, S3 if not given (see storage_backends). a PrefetchingStorage starts
+        reading it before the positions are fetched
+    position_source: MongoPositionSource or JsonPositionSource object or None
+        where the positions and failed signals come from, mongo if not given
+    pipelined: bool
+        if to fetch the positions in a background thread while the quotes are read and the book is built and
+        searched, instead of before. they are waited for only when the sync needs them
+
+    returns a summary of the run: {'failed_renders': ids of the positions whose graph failed to render,
+    'uploads': the BackgroundUploader summary with upload_workers, else None}
     '''
-    position_list,signal_no_position,raw_positions,raw_signal_no_position = get_mongo_positions_delta_lists(today)
-
-    print('IMPORTED MONGO')
     working_date = from_datetime(today)
+    if metrics is not None:
+        metrics.begin(working_date)
 
-    # pull the merged raw data file
-    
-    file = retreive(working_date)
-    
-    # print(f'finished reading file ')
+    prefetch_day_quotes(storage, working_date, day_cache=day_cache, checkpoint=checkpoint)
 
-    
-    file = clean_file(file)
-    print('finished cleaining file')
-    #for now there is a timeframe!
-    file = file.loc[(pd.to_datetime(file["bbp_timestamp"],unit='ms').dt.hour >= start_hour) & (pd.to_datetime(file["bbp_timestamp"],unit='ms').dt.hour < end_hour)]
+    positions_executor = None
+    if pipelined:
+        positions_executor = ThreadPoolExecutor(max_workers=1)
+        positions_future = positions_executor.submit(_fetch_positions_timed, today, position_source)
+    else:
+        with measure_stage(metrics, 'fetch_mongo') as stage:
+            position_list,signal_no_position,raw_positions,raw_signal_no_position = fetch_positions(today, position_source)
+            stage.rows_out = len(position_list) + len(signal_no_position)
 
+        print('IMPORTED MONGO')
 
-    #generate brokers list
-    if not graph_other_brokers:
-        brokers = []
-        for key in broker_groups.keys():
-            brokers += broker_groups[key]
-    else:
-        brokers = file.broker_name.unique()
+    try:
+        checkpoint_state = None
+        if checkpoint is not None:
+            checkpoint_state = checkpoint.load(working_date)
+            # the day's file keeps growing during the day, a cached copy of it would be stale
+            day_cache = None
 
-    brokers = file.broker_name.unique()
-    brokers_dict = create_flat_broker_dict(file=file,brokers=brokers)
-    print(f'finished broker_dict ')
+        # pull the merged raw data file
+        file = load_day_quotes(working_date, start_hour, end_hour, streaming_ingest=streaming_ingest, day_cache=day_cache, metrics=metrics, storage=storage)
+
+
+        #generate brokers list
+        if not graph_other_brokers:
+            brokers = []
+            for key in broker_groups.keys():
+                brokers += broker_groups[key]
+        else:
+            brokers = np.asarray(file.broker_name.unique())
+
+        # the names in order of appearance, as strings (unique() of a categorical is a Categorical)
+        brokers = np.asarray(file.broker_name.unique())
+        with measure_stage(metrics, 'flatten', rows_in=len(file)) as stage:
+            brokers_dict = create_flat_broker_dict(file=file,brokers=brokers)
+            stage.rows_out = flat_rows = sum(len(broker_df) for broker_df in brokers_dict.values())
+        print(f'finished broker_dict ')
     
-    merged = merge_broker_dict(brokers_dict)
-    print(f'finished merging dicts ')
+        with measure_stage(metrics, 'merge', rows_in=flat_rows) as stage:
+            merged = merge_broker_dict(brokers_dict, mode=merge_mode)
+            stage.rows_out = len(merged)
+        print(f'finished merging dicts ')
 
     
     
-    dif_list=[]
-
-    tic = time.perf_counter()
-
-    if not dif_file_exists:
+        dif_list=[]
+
+        tic = time.perf_counter()
+
+        with measure_stage(metrics, 'detect', rows_in=len(file)) as stage:
+            if not dif_file_exists and checkpoint is not None:
+                dif_list, checkpoint_state = find_deltas_incremental(file, broker_groups, dif_threashold, checkpoint_state, engine=dif_engine)
+                if delta_table:
+                    dif_list = DeltaTable.from_records(dif_list)
+                toc = time.perf_counter()
+                print(f'finished finding new deltas in {toc - tic:0.4f}')
+            elif not dif_file_exists and detection_processes is not None and detection_processes > 1:
+                dif_list = find_deltas_parallel(file, broker_groups, dif_threashold, detection_processes, engine=dif_engine, slice_rows=detection_slice_rows, as_table=delta_table)
+                toc = time.perf_counter()
+                print(f'finished finding deltas in {toc - tic:0.4f}')
+            elif not dif_file_exists:
         
-        for key in broker_groups.keys():
-            filter = file['broker_name'].isin(broker_groups[key])
-            broker_filtered_df = file[filter]
-            dif_list = dif_list + delta_finder(broker_groups[key], broker_filtered_df, dif_threashold)
-        toc = time.perf_counter()
-        print(f'finished finding deltas in {toc - tic:0.4f}')
-    else:
-        dif_list = dif_file.to_dict('records')
-        print('imported difs')
+                group_dif_lists = []
+                for key in broker_groups.keys():
+                    filter = category_mask(file['broker_name'], broker_groups[key])
+                    broker_filtered_df = file[filter]
+                    group_dif_lists.append(find_deltas(broker_groups[key], broker_filtered_df, dif_threashold, engine=dif_engine, as_table=delta_table))
+                if delta_table:
+                    dif_list = DeltaTable.concat(group_dif_lists)
+                else:
+                    dif_list = [dif for group_dif_list in group_dif_lists for dif in group_dif_list]
+                toc = time.perf_counter()
+                print(f'finished finding deltas in {toc - tic:0.4f}')
+            else:
+                dif_list = dif_file.to_dict('records')
+                print('imported difs')
+            stage.rows_out = len(dif_list)
 
 
 
+        if positions_executor is not None:
+            with measure_stage(metrics, 'wait_mongo'):
+                (position_list,signal_no_position,raw_positions,raw_signal_no_position), seconds, cpu_seconds = positions_future.result()
+            if metrics is not None:
+                # measured in its thread, the peak memory of a thread is not known
+                metrics.add('fetch_mongo', seconds, cpu_seconds, 0.0, 0, rows_out=len(position_list) + len(signal_no_position))
+            print('IMPORTED MONGO')
+    finally:
+        if positions_executor is not None:
+            # also when reading or searching the quotes failed, the fetch thread is waited for and not left behind
+            positions_executor.shutdown()
+
     # sync between failed positions and positions and difs. This will add position_id/failed_position_id field 
     # to difs that match with the positions in mongo
     
-    sync_signal_no_position_and_dif_list(signal_no_position,dif_list,broker_groups=broker_groups)
-    sync_positions_and_difs(position_list,dif_list,time_before_dif,time_after_dif,broker_groups=broker_groups)
-
-    aws_handler = AWSHandler(f"create_daily_delta_info_graphs")
-    #sync and add graphs to interesting deltas
-    sync_interesting_deltas(
-        dif_list,
-        brokers_dict=brokers_dict,
-        merged=merged,
-        failed_position_list=signal_no_position,
-        position_list=position_list,
-        brokers= brokers,
-        working_date=working_date,
-        aws_handler=aws_handler,
-        raw_positions= raw_positions,
-        raw_signal_no_position=raw_signal_no_position,
-        graph_other_brokers=graph_other_brokers,
-        time_before_dif=time_before_dif,
-        time_after_dif=time_after_dif,
-        broker_groups=broker_groups)
-    
-    print(f'synced difs ')
-    
-    create_delta_csv(dif_list=dif_list,working_date=working_date,aws_handler=aws_handler,broker_groups=broker_groups,ran_dif_ceiling=ran_dif_ceiling)
+    with measure_stage(metrics, 'sync', rows_in=len(dif_list)) as stage:
+        if sync_engine == 'indexed':
+            dif_index = DifMatchIndex(dif_list, broker_groups['NY'])
+            sync_signal_no_position_and_dif_list_indexed(signal_no_position,dif_list,broker_groups=broker_groups,tolerance_ms=sync_tolerance_ms,dif_index=dif_index)
+            sync_positions_and_difs_indexed(position_list,dif_list,time_before_dif,time_after_dif,broker_groups=broker_groups,tolerance_ms=sync_tolerance_ms,dif_index=dif_index)
+        else:
+            sync_signal_no_position_and_dif_list(signal_no_position,dif_list,broker_groups=broker_groups)
+            sync_positions_and_difs(position_list,dif_list,time_before_dif,time_after_dif,broker_groups=broker_groups)
+        # positions and failed signals that got a dif
+        stage.rows_out = sum(len(doc['dif_ids']) > 0 for doc in position_list + signal_no_position)
+
+    if aws_handler is None and storage is not None:
+        aws_handler = storage
+    if aws_handler is None:
+        aws_handler = S3Storage()
+    uploader = None
+    if upload_workers is not None and upload_workers > 0:
+        aws_handler = uploader = BackgroundUploader(aws_handler, workers=upload_workers)
+    upload_summary = None
+    try:
+        #sync and add graphs to interesting deltas
+        graphed_position_ids = None
+        if checkpoint_state is not None:
+            graphed_position_ids = set(checkpoint_state['graphed_position_ids'])
+        graphed_position_ids, failed_render_ids = sync_interesting_deltas(
+            dif_list,
+            brokers_dict=brokers_dict,
+            merged=merged,
+            failed_position_list=signal_no_position,
+            position_list=position_list,
+            brokers= brokers,
+            working_date=working_date,
+            aws_handler=aws_handler,
+            raw_positions= raw_positions,
+            raw_signal_no_position=raw_signal_no_position,
+            graph_other_brokers=graph_other_brokers,
+            time_before_dif=time_before_dif,
+            time_after_dif=time_after_dif,
+            broker_groups=broker_groups,
+            render_processes=render_processes,
+            max_trace_points=max_trace_points,
+            html_output=html_output,
+            gzip_html=gzip_html,
+            daily_index=daily_index,
+            render_mode=render_mode,
+            graphed_position_ids=graphed_position_ids,
+            metrics=metrics)
+
+        print(f'synced difs ')
+
+        with measure_stage(metrics, 'csv', rows_in=len(dif_list)):
+            create_delta_csv(dif_list=dif_list,working_date=working_date,aws_handler=aws_handler,broker_groups=broker_groups,ran_dif_ceiling=ran_dif_ceiling)
+    finally:
+        if uploader is not None:
+            # wait until every file landed, also when the run failed, so the queued uploads finish and the threads stop
+            with measure_stage(metrics, 'upload'):
+                upload_summary = uploader.close()
+
+    failed_uploads = [] if upload_summary is None else upload_summary['failed']
+    if failed_uploads:
+        # a graph that didn't land is not graphed, the next run renders it again
+        graphed_position_ids = {graph_name for graph_name in graphed_position_ids
+                                if upload_name('delta-info-graphs', working_date, f'positions/{graph_name}.html') not in failed_uploads}
+
+    if checkpoint is not None and checkpoint_state is not None:
+        # saved only after the uploads, with the graphs that landed
+        checkpoint_state['graphed_position_ids'] = sorted(graphed_position_ids)
+        checkpoint.save(working_date, checkpoint_state)
+
+    if metrics is not None:
+        metrics.save()
+    if failed_uploads:
+        raise RuntimeError(f"{len(failed_uploads)} uploads of {working_date} failed: {', '.join(failed_uploads)}")
+    return {'failed_renders': failed_render_ids, 'uploads': upload_summary}
+
+# estimated peak memory of processing a day, per byte of its merged_raw_data file
+DAY_MEMORY_PER_FILE_BYTE = 6
+# used when the size of the file can't be found
+DEFAULT_DAY_FOOTPRINT_BYTES = 4 * 1024**3
+# estimated memory of every worker process of a date's pools, the interpreter with pandas and plotly loaded
+WORKER_BASE_BYTES = 256 * 1024**2
+# a render worker holds its own copy of the day's book, see _init_render_worker()
+RENDER_WORKER_MEMORY_PER_FILE_BYTE = 2
+# the detection workers together hold about the day's level 0 quotes, in slices
+DETECTION_POOL_MEMORY_PER_FILE_BYTE = 1
+
+def _pool_footprint(processes, per_worker_bytes, shared_bytes=0):
+    # a pool is only made for more than one process
+    if processes is None or processes <= 1:
+        return 0
+    return processes * (WORKER_BASE_BYTES + per_worker_bytes) + shared_bytes
+
+def estimate_day_footprint(date, storage=None, render_processes=None, detection_processes=None):
+    '''
+    estimates the peak memory of running create_delta_graphs_and_csv() on a date from the size of its
+    merged_raw_data file on S3: the date's process, the file itself if storage prefetches it, and the worker
+    processes of its render or detection pool (they don't run at the same time, the bigger one counts)
+
+    ----------
+    parameters:
+    date: txt
+        {DD-MM-YYYY} 
+    storage: storage object or None
+        where merged_raw_data is, S3 if not given
+    render_processes, detection_processes: int or None
+        the pools of the date, see create_delta_graphs_and_csv()
+    '''
+    raw_data_file_path = os.path.join(date,MERGED_RAW_DATA_FILE_NAME)
+    try:
+        if storage is None:
+            storage = S3Storage()
+        size = storage.object_size(AWS_S3_BUCKET_NAME, raw_data_file_path)
+    except Exception as e:
+        print(e)
+        print(f'failed to get the size of {raw_data_file_path}')
+        return DEFAULT_DAY_FOOTPRINT_BYTES + max(_pool_footprint(render_processes, 0), _pool_footprint(detection_processes, 0))
+    footprint = size * DAY_MEMORY_PER_FILE_BYTE
+    if isinstance(storage, PrefetchingStorage) and (storage.max_bytes is None or size <= storage.max_bytes):
+        # a prefetched file is held whole in memory until it is read, also by the streaming ingest
+        footprint += size
+    footprint += max(_pool_footprint(render_processes, size * RENDER_WORKER_MEMORY_PER_FILE_BYTE),
+                     _pool_footprint(detection_processes, 0, size * DETECTION_POOL_MEMORY_PER_FILE_BYTE))
+    return footprint
+
+def divide_cores(kwargs, concurrent_dates, cores=None):
+    '''
+    the arguments of create_delta_graphs_and_csv() for one of concurrent_dates dates running at once: the cores
+    are divided between the dates, so render_processes and detection_processes are cut to the date's share
+
+    ----------
+    parameters:
+    kwargs: dict
+        the arguments of create_delta_graphs_and_csv(), except today
+    concurrent_dates: int
+        how many dates run at once
+    cores: int or None
+        the cores to divide, os.cpu_count() if not given
+    '''
+    cores = cores if cores is not None else (os.cpu_count() or 1)
+    cores_per_date = max(1, cores // max(1, concurrent_dates))
+    date_kwargs = dict(kwargs)
+    for name in ['render_processes', 'detection_processes']:
+        if date_kwargs.get(name) is not None:
+            date_kwargs[name] = min(date_kwargs[name], cores_per_date)
+    return date_kwargs
+
+def _run_date(date, kwargs):
+    tic = time.perf_counter()
+    run_summary = create_delta_graphs_and_csv(text_to_datetime(date), **kwargs)
+    return time.perf_counter() - tic, run_summary
+
+def run_dates_scheduled(dates, memory_budget_bytes, max_processes, summary_path, cores=None, **kwargs):
+    '''
+    runs create_delta_graphs_and_csv() for several dates at once, each date in its own worker process.
+    A date is started only if the estimated footprints (estimate_day_footprint()) of all running dates fit in
+    memory_budget_bytes. A date that is bigger than the whole budget runs alone.
+    The cores are divided between the max_processes dates that can run at once, so the render and detection
+    pools of every date get their share, see divide_cores().
+    The status, timing and failed renders of every date are written to summary_path (json) every time a date finishes.
+
+    ----------
+    parameters:
+    dates: array
+        {DD-MM-YYYY} dates
+    memory_budget_bytes: int
+        memory that all running dates together may use
+    max_processes: int
+        maximum number of dates running at once
+    summary_path: str
+        where to write the run summary
+    cores: int or None
+        the cores divided between the dates, os.cpu_count() if not given
+    kwargs:
+        the arguments of create_delta_graphs_and_csv(), except today
+    '''
+    kwargs = divide_cores(kwargs, min(max_processes, len(dates)), cores=cores)
+    footprints = {date: estimate_day_footprint(date, storage=kwargs.get('storage'), render_processes=kwargs.get('render_processes'), detection_processes=kwargs.get('detection_processes')) for date in dates}
+    summary = {'started': datetime.now().isoformat(), 'memory_budget_bytes': memory_budget_bytes,
+               'render_processes': kwargs.get('render_processes'), 'detection_processes': kwargs.get('detection_processes'), 'dates': {}}
+    for date in dates:
+        summary['dates'][date] = {'status': 'waiting', 'estimated_bytes': footprints[date], 'seconds': None, 'error': None, 'failed_renders': []}
+
+    def write_summary():
+        with open(summary_path, 'w') as f:
+            json.dump(summary, f, indent=2)
+
+    waiting = list(dates)
+    # future -> (date, executor). every date gets its own single process executor, so its memory is freed when it ends
+    running = {}
+    used_bytes = 0
+    while waiting or running:
+        # start every waiting date that fits in the budget, in order
+        for date in list(waiting):
+            if len(running) >= max_processes:
+                break
+            if running and used_bytes + footprints[date] > memory_budget_bytes:
+                continue
+            waiting.remove(date)
+            used_bytes += footprints[date]
+            executor = ProcessPoolExecutor(max_workers=1)
+            running[executor.submit(_run_date, date, kwargs)] = (date, executor)
+            summary['dates'][date]['status'] = 'running'
+            print(f'STARTED: {date}, estimated {footprints[date] / 1024**3:0.2f} GB')
+
+        done, _ = wait(running, return_when=FIRST_COMPLETED)
+        for future in done:
+            date, executor = running.pop(future)
+            executor.shutdown()
+            used_bytes -= footprints[date]
+            try:
+                summary['dates'][date]['seconds'], run_summary = future.result()
+                summary['dates'][date]['failed_renders'] = run_summary['failed_renders']
+                summary['dates'][date]['status'] = 'done'
+                print('FINISHED:', date)
+            except Exception as e:
+                summary['dates'][date]['status'] = 'failed'
+                summary['dates'][date]['error'] = repr(e)
+                print(f'FAILED: {date}, {e}')
+            write_summary()
+    summary['finished'] = datetime.now().isoformat()
+    write_summary()
+    return summary
+
+def run_dates_pipelined(dates, **kwargs):
+    '''
+    runs create_delta_graphs_and_csv() for the dates one after another, and while a date is processed the inputs
+    of the next one are read in the background: its positions always, its merged_raw_data if storage is a
+    PrefetchingStorage and it fits in the storage's budget_bytes. Pass pipelined=True to also fetch each
+    date's positions while its quotes are processed. A date that fails, e.g. because some of its uploads failed,
+    raises and stops the run.
+
+    ----------
+    parameters:
+    dates: array
+        {DD-MM-YYYY} dates
+    kwargs:
+        the arguments of create_delta_graphs_and_csv(), except today
+    '''
+    position_source = kwargs.get('position_source')
+    if not isinstance(position_source, PrefetchingPositionSource):
+        position_source = PrefetchingPositionSource(MongoPositionSource() if position_source is None else position_source)
+    kwargs['position_source'] = position_source
+    for index, date in enumerate(dates):
+        if index + 1 < len(dates):
+            next_today = text_to_datetime(dates[index + 1])
+            position_source.prefetch(next_today)
+            prefetch_day_quotes(kwargs.get('storage'), from_datetime(next_today), day_cache=kwargs.get('day_cache'), checkpoint=kwargs.get('checkpoint'))
+        create_delta_graphs_and_csv(text_to_datetime(date), **kwargs)
+        print('FINISHED:', date)
 
 graph_difs_before_and_after = True
 
@@ -1077,35 +2755,130 @@ def delta_info_graphs_main(dates):
 
     ran_dif_ceiling=-0.0001
 
-    broker_groups={
-        'NY':['BROKER_NY_A', 'BROKER_NY_B', 'BROKER_NY_C'],
-        'LONDON':[f'BROKER_LONDON{i+1}' for i in range(21) if i != 13]
-        ,'OTHER':['PARIS', 'BERLIN', 'BARCELONA']
-    }
+    broker_groups=BROKER_GROUPS
 
     #time buffer for graphs, how many mins before and after the dif should show on the graph
     time_before_dif = 0.5
     time_after_dif = 2
 
+    # 'rows' for the original delta_finder, 'vectorized' for the numpy engine
+    dif_engine = 'vectorized'
+
+    # read merged raw data in chunks, only the needed columns
+    streaming_ingest = True
+
+    # local cache of cleaned quotes, so reruns of a date don't download and parse the csv again
+    day_cache = DayCache(cache_dir=os.path.expanduser('~/position_grapher_cache'), max_bytes=20 * 1024**3)
+
+    # 'chained' outer merges or 'aligned' union timeline for the wide book
+    merge_mode = 'aligned'
+
+    # 'scan' or 'indexed' matching of positions and failed signals to difs, optionally with a tolerance in ms
+    sync_engine = 'indexed'
+    sync_tolerance_ms = None
+
+    # processes for rendering the position graphs, None to render one by one. with parallel_dates the cores
+    # are divided between the dates that run at once
+    render_processes = os.cpu_count()
+
+    # threads uploading graphs to S3 in the background, None to upload one by one
+    upload_workers = 8
+
+    # point budget of every broker trace in the graphs, None to plot every tick
+    max_trace_points = 2000
+
+    # upload plotly.js once per day instead of inside every graph, gzip the graphs, add a daily index page
+    html_output = 'shared_js'
+    gzip_html = True
+    daily_index = True
+
+    # draw graphs with many points with WebGL instead of svg
+    render_mode = 'auto'
+
+    # rerun a date during the day and process only what is new since the last run
+    # e.g. IntradayCheckpoint(os.path.expanduser('~/position_grapher_checkpoints')), None to run on the whole day
+    checkpoint = None
+
+    # find the deltas of the broker groups at the same time, in time slices of about this many quotes
+    detection_processes = os.cpu_count()
+    detection_slice_rows = 2000000
+
+    # keep the deltas in typed columns instead of a dict per delta
+    delta_table = True
+
+    # time, memory and rows of every stage, saved per date. profile_stages=['detect'] to also profile a stage
+    metrics = StageMetrics(os.path.expanduser('~/position_grapher_metrics'))
+
+    # where merged_raw_data is read and the graphs are saved, and where the positions come from. to rerun a
+    # recorded day offline: LocalDirectoryStorage(dir) and JsonPositionSource(dir), see position_sources.record_day()
+    # a prefetched file is held whole in memory, so only small files are prefetched: the bigger ones are read
+    # in chunks by the streaming ingest
+    storage = PrefetchingStorage(S3Storage(), max_bytes=256 * 1024**2, budget_bytes=512 * 1024**2)
+    # only the fields the pipeline reads, without the raw documents. with a mongo_uri the collections are queried
+    # with a projection in cursor batches, without one the documents come whole from mongo_utils and are cut down after
+    mongo_uri = None
+    mongo_database_name = None
+    mongo_collection_names = None
+    position_source = MongoPositionSource(projected=True, keep_raw=False, mongo_uri=mongo_uri, database_name=mongo_database_name, collection_names=mongo_collection_names)
+
     dif_file_exists = False
-    dif_file,status = read_df_by_full_file_path(f"delta-info-graphs", f'12-09-2022/delta_summary.csv')
+    dif_file,status = read_df_by_full_file_path(f"delta-info-graphs", f'12-09-2022/delta_summary.csv', storage=storage)
 
     graph_difs_before_and_after = True
+
+    # run several dates at once, as many as fit in the memory budget
+    parallel_dates = True
+    memory_budget_bytes = 48 * 1024**3
+    max_date_processes = 4
+    run_summary_path = f'delta_info_graphs_run_{datetime.now().strftime("%Y%m%d_%H%M%S")}.json'
+
+    # fetch a date's positions while its quotes are processed and, when dates run one by one, read the next
+    # date's inputs while the current one is processed (within the storage's budget_bytes)
+    pipelined = True
     #-------------------------------
 
+    date_kwargs = dict(
+        start_hour=start_hour,
+        end_hour=end_hour,
+        broker_groups=broker_groups,
+        dif_threashold=dif_threashold,
+        ran_dif_ceiling=ran_dif_ceiling,
+        time_before_dif=time_before_dif,
+        time_after_dif=time_after_dif,
+        dif_file_exists=dif_file_exists,
+        dif_file=dif_file,
+        graph_other_brokers=graph_other_brokers,
+        dif_engine=dif_engine,
+        streaming_ingest=streaming_ingest,
+        day_cache=day_cache,
+        merge_mode=merge_mode,
+        sync_engine=sync_engine,
+        sync_tolerance_ms=sync_tolerance_ms,
+        render_processes=render_processes,
+        upload_workers=upload_workers,
+        max_trace_points=max_trace_points,
+        html_output=html_output,
+        gzip_html=gzip_html,
+        daily_index=daily_index,
+        render_mode=render_mode,
+        checkpoint=checkpoint,
+        detection_processes=detection_processes,
+        detection_slice_rows=detection_slice_rows,
+        delta_table=delta_table,
+        metrics=metrics,
+        storage=storage,
+        position_source=position_source,
+        pipelined=pipelined)
+
+    if parallel_dates:
+        # a date whose run raised, e.g. because uploads failed, is 'failed' in the summary
+        return run_dates_scheduled(dates, memory_budget_bytes=memory_budget_bytes, max_processes=max_date_processes, summary_path=run_summary_path, **date_kwargs)
+
+    if pipelined:
+        run_dates_pipelined(dates, **date_kwargs)
+        return
+
     for date in dates:
         today = text_to_datetime(date)
-        create_delta_graphs_and_csv(
-            today,
-            start_hour=start_hour,
-            end_hour=end_hour,
-            broker_groups=broker_groups,
-            dif_threashold=dif_threashold,
-            ran_dif_ceiling=ran_dif_ceiling,
-            time_before_dif=time_before_dif,
-            time_after_dif=time_after_dif,
-            dif_file_exists=dif_file_exists,
-            dif_file=dif_file,
-            graph_other_brokers=graph_other_brokers)
+        create_delta_graphs_and_csv(today, **date_kwargs)
         print('FINISHED:', date)
-
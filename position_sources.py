@@ -0,0 +1,311 @@
+import os
+import json
+import time
+import calendar
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import bson
+import bson.errors
+import pymongo
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+import common_utils.mongo_utils as mongo_utils
+
+
+def _working_date(today):
+    # {DD-MM-YYYY}, like from_datetime()
+    return today.strftime('%d-%m-%Y')
+
+
+def _encode(value):
+    # mongo's extended json for dates, anything else (ObjectId, numpy numbers) as its plain value
+    if isinstance(value, datetime):
+        return {'$date': value.isoformat()}
+    if hasattr(value, 'item'):
+        return value.item()
+    return str(value)
+
+
+def _decode(doc):
+    if len(doc) == 1 and '$date' in doc:
+        return datetime.fromisoformat(doc['$date'])
+    return doc
+
+
+# the fields of a position that the sync, the graphs and the daily index read
+POSITION_FIELDS = ['_id', 'dif_bbp_timestamp', 'dif_ids', 'broker_pairs', 'direction', 'signal_difs',
+                   'enter_broker', 'exit_broker', 'initiating_broker',
+                   'enter_order_request_timestamp', 'enter_order_time', 'exit_order_request_timestamp', 'exit_order_time',
+                   'enter_order_requested_price', 'enter_order_executed_price', 'exit_order_requested_price', 'exit_order_executed_price',
+                   'enter_order_executed_size', 'internal_latency', 'revenue', 'revenue_pips', 'enter_trade_id', 'exit_trade_id']
+# the fields of a failed signal that the sync reads
+FAILED_SIGNAL_FIELDS = ['_id', 'dif_bbp_timestamp', 'dif_ids', 'broker_pairs']
+# documents per cursor round trip
+MONGO_BATCH_SIZE = 1000
+
+
+def project_document(doc, fields):
+    '''
+    the doc with only the fields (that it has)
+    '''
+    return {field: doc[field] for field in fields if field in doc}
+
+
+def documents_bytes(docs):
+    '''
+    size of the documents as BSON, what they take on the wire. a document BSON can't encode (e.g. numpy
+    numbers added after the fetch) counts as the length of its repr. it encodes every document, so it is
+    only used when asked for, see MongoPositionSource
+    '''
+    total = 0
+    for doc in docs:
+        try:
+            total += len(bson.encode(doc))
+        except (bson.errors.InvalidDocument, TypeError):
+            total += len(repr(doc))
+    return total
+
+
+def _day_ms_range(today):
+    # the bbp_timestamps of the date, epoch ms in UTC like the quotes
+    day_start = calendar.timegm(today.date().timetuple()) * 1000
+    return day_start, day_start + 24 * 3600 * 1000
+
+
+class MongoPositionSource:
+    '''
+    The positions and failed signals of a date from mongo.
+
+    With projected=True and a mongo_uri, the collections are queried directly: find() on the date's
+    dif_bbp_timestamp with a projection of POSITION_FIELDS or FAILED_SIGNAL_FIELDS, so the other fields never
+    leave mongo, and a cursor of batch_size documents per round trip. The collections hold the documents that
+    mongo_utils.retreive_position_dicts() and retreive_delta_dict_mongo() return, there are no raw documents
+    on that path. The cursor hands out the BSON it received, so the fetched bytes are counted as they come.
+
+    Without a mongo_uri the documents come from mongo_utils whole, with their raw documents. projected=True
+    then cuts them down right after the fetch (which frees their memory, not the transfer), and the raw
+    documents are dropped unless keep_raw. Their bytes are only known by encoding them again, which is done
+    only with measure_bytes.
+
+    Every load() prints which way the documents were fetched (last_fetch['paths']: 'projected_query' or
+    'full_fetch'), the fetch time and the bytes fetched and kept, and keeps them in last_fetch.
+    A date's process makes its own mongo client, the source can be pickled.
+
+    ----------
+    parameters:
+    projected: bool
+        if to get only the fields the pipeline reads
+    keep_raw: bool
+        if to return the raw documents of mongo_utils, else they are empty lists
+    batch_size: int
+        documents per cursor batch of a projected query
+    mongo_uri: str or None
+        the mongo to query, None to fetch through mongo_utils
+    database_name: str
+        database of the collections
+    collection_names: dict
+        {'positions': name, 'failed_signals': name}
+    measure_bytes: bool
+        if to count the bytes of the documents from mongo_utils, by encoding them
+    '''
+    def __init__(self, projected=False, keep_raw=True, batch_size=MONGO_BATCH_SIZE, mongo_uri=None, database_name=None,
+                 collection_names=None, measure_bytes=False):
+        if mongo_uri is not None and (database_name is None or not collection_names):
+            raise ValueError('a mongo_uri needs the database_name and the collection_names to query')
+        self.projected = projected
+        self.keep_raw = keep_raw
+        self.batch_size = batch_size
+        self.mongo_uri = mongo_uri
+        self.database_name = database_name
+        self.collection_names = collection_names
+        self.measure_bytes = measure_bytes
+        self.last_fetch = None
+        self._client = None
+        self.lock = threading.Lock()
+
+    @property
+    def client(self):
+        with self.lock:
+            if self._client is None:
+                self._client = pymongo.MongoClient(self.mongo_uri)
+            return self._client
+
+    def __getstate__(self):
+        # a client can't be pickled, a date's process makes its own
+        return {key: getattr(self, key) for key in ['projected', 'keep_raw', 'batch_size', 'mongo_uri', 'database_name', 'collection_names', 'measure_bytes']}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def collection(self, name):
+        '''
+        the collection of collection_names[name], handing out the documents as the BSON that was received
+        '''
+        collection = self.client[self.database_name][self.collection_names[name]]
+        return collection.with_options(codec_options=CodecOptions(document_class=RawBSONDocument))
+
+    def _query(self, name, today, fields):
+        '''
+        returns (docs, fetched_bytes) of the projected, batched query of the date
+        '''
+        day_start, day_end = _day_ms_range(today)
+        cursor = self.collection(name).find({'dif_bbp_timestamp': {'$gte': day_start, '$lt': day_end}},
+                                            projection={field: 1 for field in fields}, batch_size=self.batch_size)
+        docs = []
+        fetched_bytes = 0
+        for raw_doc in cursor:
+            fetched_bytes += len(raw_doc.raw)
+            doc = bson.decode(raw_doc.raw)
+            # the sync adds the ids of the difs it matches
+            doc.setdefault('dif_ids', [])
+            docs.append(doc)
+        return docs, fetched_bytes
+
+    def _retreive(self, name, retreive_function, today, fields):
+        '''
+        returns (docs, raw_docs, path, fetched_bytes, kept_bytes), the bytes are None when not measured
+        '''
+        if self.projected and self.mongo_uri is not None:
+            docs, fetched_bytes = self._query(name, today, fields)
+            return docs, [], 'projected_query', fetched_bytes, fetched_bytes
+        docs, raw_docs = retreive_function(today)
+        fetched_bytes = documents_bytes(docs) + documents_bytes(raw_docs) if self.measure_bytes else None
+        if self.projected:
+            docs = [project_document(doc, fields) for doc in docs]
+        if not self.keep_raw:
+            raw_docs = []
+        kept_bytes = documents_bytes(docs) + documents_bytes(raw_docs) if self.measure_bytes else None
+        return docs, raw_docs, 'full_fetch', fetched_bytes, kept_bytes
+
+    def load(self, today):
+        '''
+        returns (position_list, signal_no_position, raw_positions, raw_signal_no_position) of the date
+        '''
+        tic = time.perf_counter()
+        position_list,raw_positions,positions_path,positions_bytes,positions_kept = self._retreive('positions', mongo_utils.retreive_position_dicts, today, POSITION_FIELDS)
+        signal_no_position,raw_signal_no_position,signals_path,signals_bytes,signals_kept = self._retreive('failed_signals', mongo_utils.retreive_delta_dict_mongo, today, FAILED_SIGNAL_FIELDS)
+        seconds = time.perf_counter() - tic
+        measured = positions_bytes is not None and signals_bytes is not None
+        self.last_fetch = {
+            'seconds': seconds,
+            'positions': len(position_list),
+            'failed_signals': len(signal_no_position),
+            'paths': {'positions': positions_path, 'failed_signals': signals_path},
+            # what came from mongo, the raw documents included, and what is returned
+            'fetched_bytes': positions_bytes + signals_bytes if measured else None,
+            'kept_bytes': positions_kept + signals_kept if measured else None,
+        }
+        size = f"{self.last_fetch['fetched_bytes'] / 1024:0.1f} KB fetched, {self.last_fetch['kept_bytes'] / 1024:0.1f} KB kept" if measured else 'bytes not measured'
+        print(f"fetched {len(position_list)} positions ({positions_path}) and {len(signal_no_position)} failed signals ({signals_path}) in {seconds:0.2f}s, {size}")
+        return position_list,signal_no_position,raw_positions,raw_signal_no_position
+
+
+class JsonPositionSource:
+    '''
+    The positions and failed signals of a date recorded as json, {positions_dir}/{DD-MM-YYYY}.positions.json,
+    so a day can be rerun without mongo. Dates are saved as {'$date': iso} and read back as datetimes,
+    ObjectIds are saved as strings (the pipeline only uses them as str(_id)).
+
+    ----------
+    parameters:
+    positions_dir: str
+        directory of the recorded dates
+    '''
+    def __init__(self, positions_dir):
+        self.positions_dir = positions_dir
+
+    def path(self, today):
+        return os.path.join(self.positions_dir, f'{_working_date(today)}.positions.json')
+
+    def load(self, today):
+        '''
+        returns (position_list, signal_no_position, raw_positions, raw_signal_no_position) of the date
+        '''
+        with open(self.path(today)) as f:
+            recorded = json.load(f, object_hook=_decode)
+        return recorded['position_list'], recorded['signal_no_position'], recorded['raw_positions'], recorded['raw_signal_no_position']
+
+    def save(self, today, position_list, signal_no_position, raw_positions, raw_signal_no_position):
+        '''
+        records the positions and failed signals of the date, e.g. from MongoPositionSource().load(today)
+        '''
+        os.makedirs(self.positions_dir, exist_ok=True)
+        recorded = {
+            'position_list': position_list,
+            'signal_no_position': signal_no_position,
+            'raw_positions': raw_positions,
+            'raw_signal_no_position': raw_signal_no_position,
+        }
+        tmp_path = self.path(today) + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(recorded, f, default=_encode)
+        os.replace(tmp_path, self.path(today))
+
+
+class PrefetchingPositionSource:
+    '''
+    Wraps a position source so the positions of a date can be fetched ahead, in a background thread:
+    load() of a prefetched date waits for that fetch instead of querying again. A failed prefetch is retried
+    by load(). Used to fetch the next date's positions while a date is processed, see run_dates_pipelined().
+
+    ----------
+    parameters:
+    position_source: MongoPositionSource or JsonPositionSource object
+        where the positions come from
+    '''
+    def __init__(self, position_source):
+        self.position_source = position_source
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.lock = threading.Lock()
+        # DD-MM-YYYY -> future of the load() result
+        self.pending = {}
+
+    def __getstate__(self):
+        return {'position_source': self.position_source}
+
+    def __setstate__(self, state):
+        self.__init__(state['position_source'])
+
+    def prefetch(self, today):
+        '''
+        starts fetching the positions of the date in the background
+        '''
+        with self.lock:
+            if _working_date(today) not in self.pending:
+                self.pending[_working_date(today)] = self.executor.submit(self.position_source.load, today)
+
+    def load(self, today):
+        with self.lock:
+            future = self.pending.pop(_working_date(today), None)
+        if future is None:
+            return self.position_source.load(today)
+        try:
+            return future.result()
+        except Exception as e:
+            print(e)
+            print(f'prefetch of the positions of {_working_date(today)} failed, fetching them again')
+            return self.position_source.load(today)
+
+
+def record_day(today, storage, position_source, target_storage, target_position_source, keys):
+    '''
+    copies a date to local stand-ins, e.g. from S3Storage and MongoPositionSource to LocalDirectoryStorage and
+    JsonPositionSource, so it can be rerun and profiled offline
+
+    ----------
+    parameters:
+    keys: array
+        (bucket_name, key) of the objects to copy, e.g. the date's merged_raw_data
+    '''
+    for bucket_name, key in keys:
+        body, status = storage.open_object(bucket_name, key)
+        try:
+            data = body.read()
+        finally:
+            body.close()
+        working_date, file_name = key.split('/', 1)
+        target_storage.save_bytes_in_bucket(working_date=working_date, data=data, file_name_to_save=file_name, bucket_name=bucket_name, content_type='text/csv')
+        print(f'recorded {bucket_name}/{key}, {len(data)} bytes')
+    target_position_source.save(today, *position_source.load(today))
+    print(f'recorded the positions of {_working_date(today)}')
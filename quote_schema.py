@@ -0,0 +1,81 @@
+import numpy as np
+import pandas as pd
+
+
+# the types of the columns of merged_raw_data once loaded. broker_name and type are categoricals: a quote keeps
+# a small integer code instead of a python string, and the stages filter on the codes (see category_mask()).
+# sizes stay float64 like before: a size is not always round, and float32 would change sizes above 16M
+QUOTE_SCHEMA = {
+    'timestamp': 'int64',
+    'broker_name': 'category',
+    'type': 'category',
+    'rate': 'float64',
+    'size': 'float64',
+    'bbp_timestamp': 'int64',
+    'original_timestamp': 'int64',
+    'level': 'int8',
+}
+# how merged_raw_data marks a quote without a rate
+MISSING_RATE = 'undefined'
+# the options of pd.read_csv that parse merged_raw_data straight into the categoricals and floats of QUOTE_SCHEMA,
+# with MISSING_RATE as NaN. the integer columns are parsed as they come, a missing value there would fail the read
+QUOTE_CSV_OPTIONS = {
+    'dtype': {'broker_name': 'category', 'type': 'category', 'rate': 'float64', 'size': 'float64'},
+    'na_values': {'rate': [MISSING_RATE]},
+}
+
+
+def apply_quote_schema(file):
+    '''
+    returns the quotes with the types of QUOTE_SCHEMA, only the columns that don't have them yet are converted.
+    an integer column with missing values stays float
+    '''
+    casts = {}
+    for col, dtype in QUOTE_SCHEMA.items():
+        if col not in file.columns or file[col].dtype == dtype:
+            continue
+        if dtype.startswith('int') and file[col].isna().any():
+            continue
+        casts[col] = dtype
+    if casts:
+        file = file.astype(casts)
+    return file
+
+
+def concat_quotes(frames):
+    '''
+    pd.concat of quote frames, e.g. the chunks of a read, with the categories of every categorical unioned first:
+    concatenating categoricals with different categories would make them object strings again
+    '''
+    frames = list(frames)
+    if len(frames) > 1:
+        for col in frames[0].columns:
+            if not all(isinstance(frame[col].dtype, pd.CategoricalDtype) for frame in frames):
+                continue
+            categories = list(dict.fromkeys(category for frame in frames for category in frame[col].cat.categories))
+            frames = [frame.assign(**{col: frame[col].cat.set_categories(categories)}) for frame in frames]
+    return pd.concat(frames, ignore_index=True)
+
+
+def category_codes(column, values):
+    '''
+    the index in values of the value of every row, -1 for a value that is not in values (or missing), as a
+    numpy array. on a categorical the values are looked up once per category and the rows only by their codes
+    '''
+    values = list(dict.fromkeys(values))
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        found = column.cat.categories.get_indexer(values)
+        # the last entry is what a missing value, code -1, looks up
+        lookup = np.full(len(column.cat.categories) + 1, -1, dtype=np.int64)
+        lookup[found[found >= 0]] = np.flatnonzero(found >= 0)
+        return lookup[column.cat.codes.to_numpy()]
+    return column.map({value: index for index, value in enumerate(values)}).fillna(-1).to_numpy(dtype=np.int64)
+
+
+def category_mask(column, values):
+    '''
+    column.isin(values) as a numpy array, comparing the integer codes of a categorical instead of its strings
+    '''
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        return category_codes(column, values) >= 0
+    return column.isin(values).to_numpy()
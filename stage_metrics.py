@@ -0,0 +1,244 @@
+import os
+import json
+import time
+import cProfile
+import resource
+from datetime import datetime
+import pandas as pd
+
+
+# the columns of a stage in the metrics files, in order
+STAGE_FIELDS = ['stage', 'calls', 'wall_seconds', 'cpu_seconds', 'children_cpu_seconds', 'peak_rss_bytes', 'rows_in', 'rows_out']
+
+
+def _read_peak_rss():
+    '''
+    the peak resident memory of the process in bytes, since the last _reset_peak_rss()
+    '''
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # ru_maxrss is in KB on linux, and can't be reset
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _reset_peak_rss():
+    '''
+    sets the peak resident memory of the process back to the current one, returns False where linux's
+    /proc/self/clear_refs is not available (the peak is then the peak of the whole process)
+    '''
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+class _Stage:
+    '''
+    one call of a stage, see StageMetrics.stage(). set rows_out before the block ends
+    '''
+    def __init__(self, metrics, name, rows_in):
+        self.metrics = metrics
+        self.name = name
+        self.rows_in = rows_in
+        self.rows_out = None
+        self.peak_rss = 0
+
+    def __enter__(self):
+        metrics = self.metrics
+        # clear_refs goes over every page of the process, a stage that runs once per graph resets at its first call only
+        if self.name not in metrics.reset_stages:
+            metrics.reset_stages.add(self.name)
+            if metrics.running:
+                # the peak so far belongs to the outer stage, the reset below would lose it
+                parent = metrics.running[-1]
+                parent.peak_rss = max(parent.peak_rss, _read_peak_rss())
+            metrics.peak_rss_per_stage = _reset_peak_rss() and metrics.peak_rss_per_stage
+        metrics.running.append(self)
+        self.profile = metrics.profiles.get(self.name)
+        if self.profile is not None:
+            self.profile.enable()
+        self.children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        self.cpu = time.process_time()
+        self.wall = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        wall = time.perf_counter() - self.wall
+        cpu = time.process_time() - self.cpu
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        if self.profile is not None:
+            self.profile.disable()
+        peak_rss = max(self.peak_rss, _read_peak_rss())
+        metrics = self.metrics
+        metrics.running.pop()
+        if metrics.running:
+            metrics.running[-1].peak_rss = max(metrics.running[-1].peak_rss, peak_rss)
+        metrics.add(self.name, wall, cpu, (children.ru_utime + children.ru_stime) - (self.children.ru_utime + self.children.ru_stime), peak_rss, self.rows_in, self.rows_out)
+        return False
+
+
+class _NullStage:
+    '''
+    what measure_stage() returns when metrics are off: a context that does nothing and ignores rows_out
+    '''
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def __setattr__(self, name, value):
+        pass
+
+
+_NULL_STAGE = _NullStage()
+
+
+class StageMetrics:
+    '''
+    Records the wall time, CPU time, peak RSS and rows in and out of every stage of a date's run and saves
+    them per date, as {date}.metrics.json and/or {date}.metrics.csv under metrics_dir.
+
+    A stage that runs several times (e.g. the upload of every graph) is summed into one entry, with the number
+    of calls, the highest peak RSS and the summed rows. Stages may be nested, the time and memory of the inner
+    stage are then part of the outer one too. CPU time is the CPU of this process, children_cpu_seconds the CPU
+    of worker processes that ended during the stage. The peak RSS of a stage is reset at its start on linux,
+    elsewhere it is the peak of the process so far (peak_rss_per_stage is then false in the json). A stage that
+    runs several times is reset at its first call only, its peak may then include the stages run between its calls.
+
+    A stage in profile_stages also runs under cProfile, its stats are saved as {date}.{stage}.prof
+    (open them with pstats or snakeviz). Profile stages that are not nested in each other.
+
+    Use measure_stage() and measure_iter() in the pipeline, they cost nothing when metrics are None.
+
+    ----------
+    parameters:
+    metrics_dir: str
+        directory where the metrics files are saved
+    formats: array
+        'json', 'csv' or both
+    profile_stages: array
+        names of the stages to profile
+    '''
+    def __init__(self, metrics_dir, formats=('json', 'csv'), profile_stages=()):
+        unknown = set(formats) - {'json', 'csv'}
+        if unknown:
+            raise ValueError(f'unknown metrics formats {sorted(unknown)}, choose json or csv')
+        self.metrics_dir = metrics_dir
+        self.formats = list(formats)
+        self.profile_stages = set(profile_stages)
+        os.makedirs(metrics_dir, exist_ok=True)
+        # set by begin(), the profiles are made there too since they can't be pickled to a date's process
+        self.date = None
+        self.started = None
+        self.stages = {}
+        self.running = []
+        # the stages whose peak RSS was reset
+        self.reset_stages = set()
+        self.peak_rss_per_stage = True
+        self.profiles = {}
+
+    def begin(self, date):
+        '''
+        starts the metrics of a date {DD-MM-YYYY}, dropping anything recorded before
+        '''
+        self.date = date
+        self.started = datetime.now().isoformat()
+        self.stages = {}
+        self.running = []
+        self.reset_stages = set()
+        self.peak_rss_per_stage = True
+        self.profiles = {name: cProfile.Profile() for name in self.profile_stages}
+
+    def stage(self, name, rows_in=None):
+        '''
+        a context that measures one call of the stage
+        '''
+        return _Stage(self, name, rows_in)
+
+    def add(self, name, wall_seconds, cpu_seconds, children_cpu_seconds, peak_rss_bytes, rows_in=None, rows_out=None):
+        '''
+        adds one call of a stage that was measured elsewhere
+        '''
+        record = self.stages.get(name)
+        if record is None:
+            record = self.stages[name] = dict.fromkeys(STAGE_FIELDS)
+            record.update(stage=name, calls=0, wall_seconds=0.0, cpu_seconds=0.0, children_cpu_seconds=0.0, peak_rss_bytes=0)
+        record['calls'] += 1
+        record['wall_seconds'] += wall_seconds
+        record['cpu_seconds'] += cpu_seconds
+        record['children_cpu_seconds'] += children_cpu_seconds
+        record['peak_rss_bytes'] = max(record['peak_rss_bytes'], peak_rss_bytes)
+        for key, rows in [('rows_in', rows_in), ('rows_out', rows_out)]:
+            if rows is not None:
+                record[key] = (record[key] or 0) + int(rows)
+
+    def iterate(self, name, iterable):
+        '''
+        yields the items of iterable, measuring the time spent getting each one as a call of the stage.
+        the time the caller spends on an item is not part of it. rows_out is the number of items
+        '''
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name) as stage:
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                stage.rows_out = 1
+            yield item
+
+    def path(self, extension):
+        '''
+        path of the date's metrics file with the extension
+        '''
+        return os.path.join(self.metrics_dir, f'{self.date}.{extension}')
+
+    def save(self):
+        '''
+        writes the date's metrics (and profiles) and returns the stage records, in the order the stages first ran
+        '''
+        records = list(self.stages.values())
+        if 'json' in self.formats:
+            with open(self.path('metrics.json'), 'w') as f:
+                json.dump({'date': self.date, 'started': self.started, 'finished': datetime.now().isoformat(), 'peak_rss_per_stage': self.peak_rss_per_stage, 'stages': records}, f, indent=2)
+        if 'csv' in self.formats:
+            # a stage without rows has None there, Int64 keeps the others integers
+            frame = pd.DataFrame(records, columns=STAGE_FIELDS).astype({'rows_in': 'Int64', 'rows_out': 'Int64'})
+            frame.to_csv(self.path('metrics.csv'), index=False)
+        for name, profile in self.profiles.items():
+            if name in self.stages:
+                profile.dump_stats(self.path(f'{name}.prof'))
+        print(f'saved metrics of {self.date} to {self.metrics_dir}')
+        return records
+
+
+def measure_stage(metrics, name, rows_in=None):
+    '''
+    metrics.stage(name, rows_in), or a context that does nothing if metrics is None:
+
+        with measure_stage(metrics, 'clean', rows_in=len(file)) as stage:
+            file = clean_file(file)
+            stage.rows_out = len(file)
+    '''
+    if metrics is None:
+        return _NULL_STAGE
+    return metrics.stage(name, rows_in)
+
+
+def measure_iter(metrics, name, iterable):
+    '''
+    metrics.iterate(name, iterable), or iterable itself if metrics is None
+    '''
+    if metrics is None:
+        return iterable
+    return metrics.iterate(name, iterable)
@@ -0,0 +1,249 @@
+import io
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import boto3
+from common_utils.aws_tools import AWSHandler
+from background_uploader import LocalDirectoryHandler
+
+
+# A storage reads objects with open_object(bucket_name, key) -> (readable body, http status) and
+# object_size(bucket_name, key) -> bytes, and saves them with the save methods of AWSHandler
+# (save_html_file_in_bucket, save_file_in_bucket) plus save_bytes_in_bucket, under the key {working_date}/{file_name_to_save}.
+# So a storage can also be passed anywhere an aws_handler is expected.
+
+
+class S3Storage:
+    '''
+    The objects on S3. Reads go through one boto3 client, made on first use. Uploads of html and csv go through
+    an AWSHandler, like before, and bytes are put with the client. Upload threads can share one S3Storage,
+    the client and the handler are made once, under a lock.
+
+    ----------
+    parameters:
+    handler_name: str
+        name of the AWSHandler that uploads
+    '''
+    def __init__(self, handler_name='create_daily_delta_info_graphs'):
+        self.handler_name = handler_name
+        self._client = None
+        self._handler = None
+        self.lock = threading.Lock()
+
+    @property
+    def client(self):
+        with self.lock:
+            # making clients of the default session at the same time from several threads is not safe
+            if self._client is None:
+                self._client = boto3.client('s3')
+            return self._client
+
+    @property
+    def handler(self):
+        with self.lock:
+            if self._handler is None:
+                self._handler = AWSHandler(self.handler_name)
+            return self._handler
+
+    def __getstate__(self):
+        # a client can't be pickled, a date's process makes its own
+        return {'handler_name': self.handler_name}
+
+    def __setstate__(self, state):
+        self.__init__(state['handler_name'])
+
+    def open_object(self, bucket_name, key):
+        response = self.client.get_object(Bucket=bucket_name, Key=key)
+        return response.get("Body"), response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+
+    def object_size(self, bucket_name, key):
+        return self.client.head_object(Bucket=bucket_name, Key=key)['ContentLength']
+
+    def save_html_file_in_bucket(self, working_date, html_string, file_name_to_save, bucket_name):
+        self.handler.save_html_file_in_bucket(working_date=working_date, html_string=html_string, file_name_to_save=file_name_to_save, bucket_name=bucket_name)
+
+    def save_file_in_bucket(self, working_date, df_to_save, file_name_to_save, bucket_name):
+        self.handler.save_file_in_bucket(working_date=working_date, df_to_save=df_to_save, file_name_to_save=file_name_to_save, bucket_name=bucket_name)
+
+    def save_bytes_in_bucket(self, working_date, data, file_name_to_save, bucket_name, content_type, content_encoding=None):
+        extra_args = {'ContentType': content_type}
+        if content_encoding is not None:
+            extra_args['ContentEncoding'] = content_encoding
+        self.client.put_object(Bucket=bucket_name, Key=f'{working_date}/{file_name_to_save}', Body=data, **extra_args)
+
+
+class LocalDirectoryStorage(LocalDirectoryHandler):
+    '''
+    The objects as files under a local directory, {root_dir}/{bucket_name}/{key}: a recorded day is read from
+    there and the graphs and csv are saved there, see LocalDirectoryHandler.
+
+    ----------
+    parameters:
+    root_dir: str
+        directory that plays the role of S3
+    '''
+    def open_object(self, bucket_name, key):
+        path = os.path.join(self.root_dir, bucket_name, key)
+        if not os.path.exists(path):
+            raise FileNotFoundError(f'no object {key} in {bucket_name} under {self.root_dir}')
+        return open(path, 'rb'), 200
+
+    def object_size(self, bucket_name, key):
+        return os.path.getsize(os.path.join(self.root_dir, bucket_name, key))
+
+
+class InMemoryStorage:
+    '''
+    The objects as bytes in a dict {(bucket_name, key): bytes}, for tests and benchmarks without any I/O.
+    Safe to share between upload threads, but a date's process (run_dates_scheduled()) gets its own copy.
+
+    ----------
+    parameters:
+    objects: dict or None
+        objects to start with
+    '''
+    def __init__(self, objects=None):
+        self.objects = dict(objects or {})
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        return {'objects': self.objects}
+
+    def __setstate__(self, state):
+        self.__init__(state['objects'])
+
+    def put_object(self, bucket_name, key, data):
+        with self.lock:
+            self.objects[(bucket_name, key)] = bytes(data)
+
+    def open_object(self, bucket_name, key):
+        with self.lock:
+            if (bucket_name, key) not in self.objects:
+                raise FileNotFoundError(f'no object {key} in {bucket_name}')
+            return io.BytesIO(self.objects[(bucket_name, key)]), 200
+
+    def object_size(self, bucket_name, key):
+        with self.lock:
+            return len(self.objects[(bucket_name, key)])
+
+    def save_html_file_in_bucket(self, working_date, html_string, file_name_to_save, bucket_name):
+        self.put_object(bucket_name, f'{working_date}/{file_name_to_save}', html_string.encode())
+
+    def save_file_in_bucket(self, working_date, df_to_save, file_name_to_save, bucket_name):
+        self.put_object(bucket_name, f'{working_date}/{file_name_to_save}', df_to_save.to_csv(index=False).encode())
+
+    def save_bytes_in_bucket(self, working_date, data, file_name_to_save, bucket_name, content_type, content_encoding=None):
+        self.put_object(bucket_name, f'{working_date}/{file_name_to_save}', data)
+
+
+class PrefetchingStorage:
+    '''
+    Wraps a storage so an object can be read ahead: prefetch() starts downloading it into memory in a
+    background thread, and the open_object() of the same object later waits for that download instead of
+    starting its own. Used to read the day's quotes while the positions are fetched from mongo, and the next
+    date's quotes while a date is processed (see run_dates_pipelined()).
+    Objects bigger than max_bytes are not prefetched, they are read when opened. The prefetched objects that
+    were not opened yet hold at most budget_bytes together, a prefetch that doesn't fit is skipped. A failed
+    prefetch is retried by open_object(). Everything else goes to the wrapped storage.
+
+    ----------
+    parameters:
+    storage: S3Storage, LocalDirectoryStorage or InMemoryStorage object
+        where the objects are
+    workers: int
+        how many objects can be downloaded at once
+    max_bytes: int or None
+        biggest object to prefetch, None for no limit
+    budget_bytes: int or None
+        memory all the prefetched objects may take until they are opened, None for no limit
+    '''
+    def __init__(self, storage, workers=2, max_bytes=None, budget_bytes=None):
+        self.storage = storage
+        self.workers = workers
+        self.max_bytes = max_bytes
+        self.budget_bytes = budget_bytes
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.lock = threading.Lock()
+        # (bucket_name, key) -> future of (bytes, status)
+        self.pending = {}
+        # (bucket_name, key) -> size of the pending objects, counted against budget_bytes
+        self.reserved = {}
+
+    def __getstate__(self):
+        # prefetched objects stay in the process that prefetched them
+        return {'storage': self.storage, 'workers': self.workers, 'max_bytes': self.max_bytes, 'budget_bytes': self.budget_bytes}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def _read(self, bucket_name, key):
+        body, status = self.storage.open_object(bucket_name, key)
+        try:
+            return body.read(), status
+        finally:
+            body.close()
+
+    def prefetch(self, bucket_name, key):
+        '''
+        starts reading the object in the background, returns False if it is too big to prefetch, doesn't fit
+        in the budget or can't be found
+        '''
+        with self.lock:
+            if (bucket_name, key) in self.pending:
+                return True
+        size = 0
+        if self.max_bytes is not None or self.budget_bytes is not None:
+            try:
+                size = self.storage.object_size(bucket_name, key)
+            except Exception as e:
+                print(e)
+                print(f'failed to get the size of {key}, not prefetching it')
+                return False
+            if self.max_bytes is not None and size > self.max_bytes:
+                return False
+        with self.lock:
+            if (bucket_name, key) in self.pending:
+                return True
+            if self.budget_bytes is not None and sum(self.reserved.values()) + size > self.budget_bytes:
+                print(f'not prefetching {key}, {size} bytes would go over the prefetch budget')
+                return False
+            self.reserved[(bucket_name, key)] = size
+            self.pending[(bucket_name, key)] = self.executor.submit(self._read, bucket_name, key)
+        return True
+
+    def open_object(self, bucket_name, key):
+        with self.lock:
+            future = self.pending.pop((bucket_name, key), None)
+            # from here the bytes belong to the caller
+            self.reserved.pop((bucket_name, key), None)
+        if future is None:
+            return self.storage.open_object(bucket_name, key)
+        try:
+            data, status = future.result()
+        except Exception as e:
+            print(e)
+            print(f'prefetch of {key} failed, reading it again')
+            return self.storage.open_object(bucket_name, key)
+        return io.BytesIO(data), status
+
+    def discard(self, bucket_name, key):
+        '''
+        drops a prefetched object that won't be opened, freeing its memory
+        '''
+        with self.lock:
+            future = self.pending.pop((bucket_name, key), None)
+            self.reserved.pop((bucket_name, key), None)
+        if future is not None:
+            future.cancel()
+
+    def object_size(self, bucket_name, key):
+        return self.storage.object_size(bucket_name, key)
+
+    def save_html_file_in_bucket(self, working_date, html_string, file_name_to_save, bucket_name):
+        self.storage.save_html_file_in_bucket(working_date=working_date, html_string=html_string, file_name_to_save=file_name_to_save, bucket_name=bucket_name)
+
+    def save_file_in_bucket(self, working_date, df_to_save, file_name_to_save, bucket_name):
+        self.storage.save_file_in_bucket(working_date=working_date, df_to_save=df_to_save, file_name_to_save=file_name_to_save, bucket_name=bucket_name)
+
+    def save_bytes_in_bucket(self, working_date, data, file_name_to_save, bucket_name, content_type, content_encoding=None):
+        self.storage.save_bytes_in_bucket(working_date=working_date, data=data, file_name_to_save=file_name_to_save, bucket_name=bucket_name, content_type=content_type, content_encoding=content_encoding)
@@ -0,0 +1,215 @@
+import bisect
+import numpy as np
+
+
+# a quote of the other broker older than this (ms, since its last change) can't make a delta
+STALE_QUOTE_MS = 40000
+
+# the price index is searched this much past the threshold, every candidate is then checked exactly
+INDEX_SLACK = 1e-9
+
+
+def new_broker_book():
+    '''
+    the book of a broker before its first quote
+    '''
+    broker_book = {}
+    broker_book["bid"] = 0
+    broker_book["bid_size"] = 0
+
+    broker_book["offer"] = 0
+    broker_book["offer_size"] = 0
+
+    broker_book["bbp_timestamp"] = 0
+    broker_book["original_timestamp"] = 0
+
+    broker_book["offer_bbp_timestamp_last_change"] = 0
+    broker_book["bid_bbp_timestamp_last_change"] = 0
+    return broker_book
+
+
+class StreamingDeltaFinder:
+    '''
+    Finds deltas quote by quote, with the same rules and the same records as delta_finder(), so it can replay
+    recorded feeds or run next to the rate collector.
+
+    The quotes must come in bbp_timestamp order. Like delta_finder(), all quotes of a bbp_timestamp update
+    the book before any of them is checked, so the deltas of a bbp_timestamp are returned when the first
+    quote of the next one arrives, or by flush(). Memory is the book, the price index and the quotes of one
+    bbp_timestamp.
+
+    The current bids and offers of all brokers are kept sorted, so a quote is checked with a binary search
+    that returns only the brokers whose price crosses it, instead of a loop over all the other brokers.
+
+    ----------
+    parameters:
+    delta_brokers: array
+        the list of relevant brokers
+    delta_threshold: float
+        any delta between offer and bid lower than this value is considered dif
+    brokers_book: dict or None
+        the book to start from, e.g. from a checkpoint. it is updated in place, like in delta_finder()
+    '''
+    def __init__(self, delta_brokers, delta_threshold, brokers_book=None):
+        self.delta_brokers = list(dict.fromkeys(delta_brokers))
+        self.broker_order = {broker_name: index for index, broker_name in enumerate(self.delta_brokers)}
+        self.delta_threshold = delta_threshold
+        self.brokers_book = {} if brokers_book is None else brokers_book
+        for broker_name in self.delta_brokers:
+            if broker_name not in self.brokers_book:
+                self.brokers_book[broker_name] = new_broker_book()
+        # sorted (rate, broker order) of every broker with a non zero rate, per side
+        self.index = {"bid": [], "offer": []}
+        for broker_name in self.delta_brokers:
+            for side in ["bid", "offer"]:
+                self._index_add(side, broker_name)
+        self.pending = []
+        self.pending_bbp_timestamp = None
+
+    def _index_add(self, side, broker_name):
+        rate = self.brokers_book[broker_name][side]
+        # a broker at 0 never makes a delta and NaN can't be ordered (nor make a delta)
+        if rate != 0 and rate == rate:
+            bisect.insort(self.index[side], (rate, self.broker_order[broker_name]))
+
+    def _index_remove(self, side, broker_name):
+        rate = self.brokers_book[broker_name][side]
+        if rate != 0 and rate == rate:
+            entries = self.index[side]
+            del entries[bisect.bisect_left(entries, (rate, self.broker_order[broker_name]))]
+
+    def feed(self, quote):
+        '''
+        adds one quote, a dict (or a row) with broker_name, type, rate, size, bbp_timestamp, original_timestamp
+        and level. returns the deltas of the previous bbp_timestamp if this quote starts a new one, else []
+        '''
+        if quote["level"] != 0 or quote["broker_name"] not in self.broker_order:
+            return []
+        bbp_timestamp = quote["bbp_timestamp"]
+        if bbp_timestamp != bbp_timestamp:
+            return []
+        found = []
+        if bbp_timestamp != self.pending_bbp_timestamp:
+            if self.pending_bbp_timestamp is not None and bbp_timestamp < self.pending_bbp_timestamp:
+                raise ValueError(f'quote at {bbp_timestamp} after {self.pending_bbp_timestamp}, quotes must come in bbp_timestamp order')
+            found = self.flush()
+            self.pending_bbp_timestamp = bbp_timestamp
+        self.pending.append(quote)
+        return found
+
+    def flush(self):
+        '''
+        returns the deltas of the quotes fed so far. call it at the end of the feed
+        '''
+        if len(self.pending) == 0:
+            return []
+        bbp_timestamp = self.pending_bbp_timestamp
+        group = self.pending
+        self.pending = []
+
+        for quote in group:
+            quote_type = quote["type"]
+            if quote_type not in ("bid", "offer"):
+                continue
+            broker_name = quote["broker_name"]
+            broker_book = self.brokers_book[broker_name]
+            if not (broker_book[quote_type] == quote["rate"] and broker_book[f"{quote_type}_size"] == quote["size"]):
+                broker_book[f"{quote_type}_bbp_timestamp_last_change"] = bbp_timestamp
+            self._index_remove(quote_type, broker_name)
+            broker_book[quote_type] = quote["rate"]
+            self._index_add(quote_type, broker_name)
+            broker_book["bbp_timestamp"] = bbp_timestamp
+            broker_book["original_timestamp"] = quote["original_timestamp"]
+            broker_book[f"{quote_type}_size"] = quote["size"]
+
+        found = []
+        for quote in group:
+            quote_type = quote["type"]
+            if quote_type == "bid":
+                found += self._cross_bid(quote["broker_name"], bbp_timestamp)
+            elif quote_type == "offer":
+                found += self._cross_offer(quote["broker_name"], bbp_timestamp)
+        return found
+
+    def _cross_bid(self, broker_name, bbp_timestamp):
+        # offers at or below the bid + threshold
+        bid = self.brokers_book[broker_name]["bid"]
+        if bid != bid:
+            return []
+        offers = self.index["offer"]
+        end = bisect.bisect_right(offers, (bid + self.delta_threshold + INDEX_SLACK, len(self.delta_brokers)))
+        found = []
+        for offer, other_order in sorted(offers[:end], key=lambda entry: entry[1]):
+            other_broker_name = self.delta_brokers[other_order]
+            if other_broker_name == broker_name:
+                continue
+            other_book = self.brokers_book[other_broker_name]
+            if bbp_timestamp - other_book["offer_bbp_timestamp_last_change"] < STALE_QUOTE_MS and offer - bid <= self.delta_threshold:
+                found.append(self._delta(other_broker_name, broker_name, bbp_timestamp, "buy"))
+        return found
+
+    def _cross_offer(self, broker_name, bbp_timestamp):
+        # bids at or above the offer - threshold
+        offer = self.brokers_book[broker_name]["offer"]
+        if offer != offer:
+            return []
+        bids = self.index["bid"]
+        start = bisect.bisect_left(bids, (offer - self.delta_threshold - INDEX_SLACK, -1))
+        found = []
+        for bid, other_order in sorted(bids[start:], key=lambda entry: entry[1]):
+            other_broker_name = self.delta_brokers[other_order]
+            if other_broker_name == broker_name:
+                continue
+            other_book = self.brokers_book[other_broker_name]
+            if bbp_timestamp - other_book["bid_bbp_timestamp_last_change"] < STALE_QUOTE_MS and offer - bid <= self.delta_threshold:
+                found.append(self._delta(broker_name, other_broker_name, bbp_timestamp, "sell"))
+        return found
+
+    def _delta(self, offer_broker_name, bid_broker_name, bbp_timestamp, direction):
+        '''
+        the delta record, the same as delta_finder() creates. direction is "buy" if a bid made the delta
+        and "sell" if an offer did, it is kept only if the quoting side is the newer one
+        '''
+        offer_book = self.brokers_book[offer_broker_name]
+        bid_book = self.brokers_book[bid_broker_name]
+        temp = {}
+        temp["dif_name"] = f"{offer_broker_name}-{bid_broker_name}"
+        temp["dif_value"] = np.round(offer_book["offer"] - bid_book["bid"],7)
+
+        temp["offer_bbp_timestamp"] = offer_book["bbp_timestamp"]
+        temp["bid_bbp_timestamp"] = bid_book["bbp_timestamp"]
+
+        temp["offer_original_timestamp"] = offer_book["original_timestamp"]
+        temp["bid_original_timestamp"] = bid_book["original_timestamp"]
+
+        temp["offer_rate"] = offer_book["offer"]
+        temp["bid_rate"] = bid_book["bid"]
+
+        temp["dif_bbp_timestamp"] = bbp_timestamp
+        temp["id"] = f'{temp["dif_name"]}'
+
+        if direction == "buy":
+            older = temp["offer_bbp_timestamp"] < temp["bid_bbp_timestamp"] and temp["offer_original_timestamp"] < temp["bid_original_timestamp"]
+        else:
+            older = temp["offer_bbp_timestamp"] > temp["bid_bbp_timestamp"] and temp["offer_original_timestamp"] > temp["bid_original_timestamp"]
+        temp["direction_research"] = direction if older else "none"
+        return temp
+
+    def process(self, quotes):
+        '''
+        feeds an iterable of quotes and yields the deltas as they are found, flushing at the end
+        '''
+        for quote in quotes:
+            yield from self.feed(quote)
+        yield from self.flush()
+
+
+def iter_quotes(raw_df):
+    '''
+    yields the rows of a merged_raw_data dataframe as quote dicts, in bbp_timestamp order
+    (the rows of a bbp_timestamp keep their order, like groupby)
+    '''
+    columns = ["broker_name", "type", "rate", "size", "bbp_timestamp", "original_timestamp", "level"]
+    raw_df = raw_df.sort_values(by="bbp_timestamp", kind="mergesort")
+    for values in zip(*(raw_df[col].to_numpy() for col in columns)):
+        yield dict(zip(columns, values))
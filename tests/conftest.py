@@ -0,0 +1,100 @@
+import os
+import sys
+import copy
+import pytest
+
+# the modules are at the root of the repo, not in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common_utils.constant import MERGED_RAW_DATA_FILE_NAME, AWS_S3_BUCKET_NAME
+from pipeline_benchmark import BENCHMARK_DATE, benchmark_broker_groups, generate_quotes, generate_position_docs, quotes_csv
+from position_grapher import clean_file, find_deltas, from_datetime
+from quote_schema import category_mask
+from storage_backends import InMemoryStorage
+
+
+# a quarter of an hour of the NY group and two London brokers, small enough for the rows engine
+SEED = 7
+BROKER_COUNT = 5
+HOURS = 0.25
+START_HOUR = 7
+DELTA_THRESHOLD = -0.00001
+
+
+class StaticPositionSource:
+    '''
+    a position source with fixed documents, every load() gets its own copy since the sync adds to them
+    '''
+    def __init__(self, position_list, signal_no_position):
+        self.position_list = position_list
+        self.signal_no_position = signal_no_position
+
+    def load(self, today):
+        return copy.deepcopy(self.position_list), copy.deepcopy(self.signal_no_position), [], []
+
+
+class FailingStorage(InMemoryStorage):
+    '''
+    an InMemoryStorage whose saves of file names containing fail_on always raise
+    '''
+    def __init__(self, fail_on):
+        super().__init__()
+        self.fail_on = fail_on
+
+    def save_html_file_in_bucket(self, working_date, html_string, file_name_to_save, bucket_name):
+        if self.fail_on in file_name_to_save:
+            raise OSError(f'injected failure of {file_name_to_save}')
+        super().save_html_file_in_bucket(working_date, html_string, file_name_to_save, bucket_name)
+
+    def save_file_in_bucket(self, working_date, df_to_save, file_name_to_save, bucket_name):
+        if self.fail_on in file_name_to_save:
+            raise OSError(f'injected failure of {file_name_to_save}')
+        super().save_file_in_bucket(working_date, df_to_save, file_name_to_save, bucket_name)
+
+
+@pytest.fixture(scope='session')
+def broker_groups():
+    return benchmark_broker_groups(BROKER_COUNT)
+
+
+@pytest.fixture(scope='session')
+def quotes(broker_groups):
+    '''
+    the cleaned quotes of the synthetic day
+    '''
+    return clean_file(generate_quotes(broker_groups, hours=HOURS, seed=SEED, start_hour=START_HOUR))
+
+
+@pytest.fixture(scope='session')
+def baseline_difs(broker_groups, quotes):
+    '''
+    the difs of every group found by the original delta_finder, {group: dif_list}
+    '''
+    return {key: find_deltas(brokers, quotes[category_mask(quotes['broker_name'], brokers)], DELTA_THRESHOLD, engine='rows') for key, brokers in broker_groups.items()}
+
+
+@pytest.fixture
+def day_storage(broker_groups):
+    '''
+    an InMemoryStorage with the synthetic day's merged_raw_data
+    '''
+    storage = InMemoryStorage()
+    raw = generate_quotes(broker_groups, hours=HOURS, seed=SEED, start_hour=START_HOUR)
+    storage.put_object(AWS_S3_BUCKET_NAME, f'{from_datetime(BENCHMARK_DATE)}/{MERGED_RAW_DATA_FILE_NAME}', quotes_csv(raw))
+    return storage
+
+
+@pytest.fixture(scope='session')
+def position_source(baseline_difs):
+    difs = [dif for dif_list in baseline_difs.values() for dif in dif_list]
+    return StaticPositionSource(*generate_position_docs(difs, seed=SEED, positions=4, failed_signals=4))
+
+
+@pytest.fixture(scope='session')
+def pipeline_args(broker_groups):
+    '''
+    the arguments of create_delta_graphs_and_csv() for the synthetic day, except storage and position_source
+    '''
+    return dict(start_hour=START_HOUR, end_hour=START_HOUR + 1, broker_groups=broker_groups, dif_threashold=DELTA_THRESHOLD,
+                ran_dif_ceiling=-0.0001, dif_file_exists=False, dif_file=None, graph_other_brokers=False,
+                time_before_dif=0.5, time_after_dif=2, dif_engine='vectorized')
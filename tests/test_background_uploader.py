@@ -0,0 +1,76 @@
+import gzip
+import pickle
+import pytest
+from pipeline_benchmark import BENCHMARK_DATE
+from background_uploader import BackgroundUploader, LocalDirectoryHandler
+from position_grapher import create_delta_graphs_and_csv, from_datetime
+from storage_backends import InMemoryStorage, S3Storage
+from conftest import FailingStorage
+
+
+def test_uploader_reports_failed_uploads(tmp_path):
+    handler = LocalDirectoryHandler(str(tmp_path))
+    failing = FailingStorage('bad')
+    uploader = BackgroundUploader(failing, workers=2, retries=1, retry_wait=0)
+    uploader.save_html_file_in_bucket('12-09-2022', '<html></html>', 'good.html', 'graphs')
+    uploader.save_html_file_in_bucket('12-09-2022', '<html></html>', 'bad.html', 'graphs')
+    summary = uploader.close()
+    assert summary['uploaded'] == 1
+    assert summary['failed'] == ['graphs/12-09-2022/bad.html']
+    assert ('graphs', '12-09-2022/good.html') in failing.objects
+    assert not any(thread.is_alive() for thread in uploader.threads)
+
+    uploader = BackgroundUploader(handler, workers=2)
+    uploader.save_html_file_in_bucket('12-09-2022', '<html></html>', 'good.html', 'graphs')
+    assert uploader.close()['failed'] == []
+    assert (tmp_path / 'graphs' / '12-09-2022' / 'good.html').read_text() == '<html></html>'
+
+
+class HtmlOnlyHandler:
+    '''
+    saves html and csv like AWSHandler, without save_bytes_in_bucket
+    '''
+    def save_html_file_in_bucket(self, working_date, html_string, file_name_to_save, bucket_name):
+        pass
+
+    def save_file_in_bucket(self, working_date, df_to_save, file_name_to_save, bucket_name):
+        pass
+
+
+def test_bytes_need_a_handler_that_saves_bytes():
+    uploader = BackgroundUploader(HtmlOnlyHandler(), workers=1)
+    with pytest.raises(TypeError):
+        uploader.save_bytes_in_bucket('12-09-2022', b'<html></html>', 'page.html', 'graphs', content_type='text/html')
+    assert uploader.close()['failed'] == []
+
+
+def test_local_gzip_pages_open_in_a_browser(tmp_path):
+    uploader = BackgroundUploader(LocalDirectoryHandler(str(tmp_path)), workers=1)
+    uploader.save_bytes_in_bucket('12-09-2022', gzip.compress(b'<html></html>'), 'page.html', 'graphs', content_type='text/html', content_encoding='gzip')
+    uploader.close()
+    assert (tmp_path / 'graphs' / '12-09-2022' / 'page.html').read_bytes() == b'<html></html>'
+
+
+def test_s3_storage_pickles_without_its_client():
+    storage = pickle.loads(pickle.dumps(S3Storage('handler')))
+    assert storage.handler_name == 'handler'
+    assert storage._client is None
+    with storage.lock:
+        pass
+
+
+def test_failed_upload_fails_the_date(day_storage, position_source, pipeline_args):
+    failing = FailingStorage('delta_summary')
+    with pytest.raises(RuntimeError, match='delta_summary'):
+        create_delta_graphs_and_csv(BENCHMARK_DATE, storage=day_storage, aws_handler=failing, position_source=position_source, upload_workers=2, **pipeline_args)
+    # the rest of the uploads landed before the run failed
+    working_date = from_datetime(BENCHMARK_DATE)
+    assert any(key.startswith(f'{working_date}/positions/') for bucket_name, key in failing.objects)
+
+
+def test_uploads_without_failures(day_storage, position_source, pipeline_args):
+    target = InMemoryStorage()
+    run_summary = create_delta_graphs_and_csv(BENCHMARK_DATE, storage=day_storage, aws_handler=target, position_source=position_source, upload_workers=2, **pipeline_args)
+    assert run_summary['failed_renders'] == []
+    assert run_summary['uploads']['failed'] == []
+    assert run_summary['uploads']['uploaded'] == len(target.objects)
@@ -0,0 +1,26 @@
+import numpy as np
+import pandas as pd
+from day_cache import DayCache
+
+
+DATE = '12-09-2022'
+
+
+def test_quotes_round_trip(tmp_path, quotes):
+    cache = DayCache(str(tmp_path), max_bytes=10**9)
+    cache.put(DATE, quotes)
+    pd.testing.assert_frame_equal(cache.get(DATE), quotes.reset_index(drop=True))
+
+
+def test_missing_values_of_object_columns(tmp_path):
+    cache = DayCache(str(tmp_path), max_bytes=10**9)
+    file = pd.DataFrame({'bbp_timestamp': np.arange(4, dtype=np.int64) * 1000,
+                         'venue': ['a', np.nan, 'b', None],
+                         'note': ['x', 'nan', 'y', 'z']})
+    cache.put(DATE, file)
+    cached = cache.get(DATE)
+    assert cached['venue'].isna().tolist() == [False, True, False, True]
+    assert cached['venue'].dropna().tolist() == ['a', 'b']
+    # a string 'nan' is not a missing value
+    assert cached['note'].tolist() == ['x', 'nan', 'y', 'z']
+    assert cache.get(DATE, time_range=(1000, 3000))['venue'].isna().tolist() == [True, False]
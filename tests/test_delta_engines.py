@@ -0,0 +1,75 @@
+import json
+import pytest
+from position_grapher import DETECTION_WARMUP_MS, find_deltas, find_deltas_parallel
+from quote_schema import category_mask
+from conftest import DELTA_THRESHOLD
+
+
+def _as_json(value):
+    return json.loads(json.dumps(value, default=lambda v: v.item()))
+
+
+def _group_difs(quotes, broker_groups, threshold, engine):
+    return {key: _as_json(find_deltas(brokers, quotes[category_mask(quotes['broker_name'], brokers)], threshold, engine=engine))
+            for key, brokers in broker_groups.items()}
+
+
+@pytest.fixture(scope='module')
+def duplicate_timestamp_quotes(quotes):
+    '''
+    the quotes with bbp_timestamp cut to half seconds, many quotes of different brokers share a bbp_timestamp
+    '''
+    quotes = quotes.copy()
+    quotes['bbp_timestamp'] = quotes['bbp_timestamp'] // 500 * 500
+    assert quotes['bbp_timestamp'].duplicated().sum() > len(quotes) // 2
+    return quotes
+
+
+def test_vectorized_finds_the_baseline_difs(quotes, broker_groups, baseline_difs):
+    assert all(baseline_difs.values())
+    assert _group_difs(quotes, broker_groups, DELTA_THRESHOLD, 'vectorized') == {key: _as_json(difs) for key, difs in baseline_difs.items()}
+
+
+@pytest.mark.parametrize('threshold', [-0.00003, 0.0])
+def test_vectorized_across_thresholds(quotes, broker_groups, threshold):
+    assert _group_difs(quotes, broker_groups, threshold, 'vectorized') == _group_difs(quotes, broker_groups, threshold, 'rows')
+
+
+def test_vectorized_with_duplicate_timestamps(duplicate_timestamp_quotes, broker_groups):
+    baseline = _group_difs(duplicate_timestamp_quotes, broker_groups, DELTA_THRESHOLD, 'rows')
+    assert any(baseline.values())
+    assert _group_difs(duplicate_timestamp_quotes, broker_groups, DELTA_THRESHOLD, 'vectorized') == baseline
+
+
+def test_streaming_finds_the_baseline_difs(quotes, broker_groups, baseline_difs):
+    assert _group_difs(quotes, broker_groups, DELTA_THRESHOLD, 'streaming') == {key: _as_json(difs) for key, difs in baseline_difs.items()}
+
+
+@pytest.mark.parametrize('threshold', [-0.00003, 0.0])
+def test_streaming_across_thresholds(quotes, broker_groups, threshold):
+    assert _group_difs(quotes, broker_groups, threshold, 'streaming') == _group_difs(quotes, broker_groups, threshold, 'rows')
+
+
+def test_streaming_with_duplicate_timestamps(duplicate_timestamp_quotes, broker_groups):
+    assert _group_difs(duplicate_timestamp_quotes, broker_groups, DELTA_THRESHOLD, 'streaming') == _group_difs(duplicate_timestamp_quotes, broker_groups, DELTA_THRESHOLD, 'rows')
+
+
+# a few thousand quotes per slice, every group is cut into several slices
+SLICE_ROWS = 2000
+
+
+@pytest.mark.parametrize('engine', ['vectorized', 'rows'])
+def test_parallel_slices_find_the_baseline_difs(quotes, broker_groups, baseline_difs, engine):
+    dif_list = find_deltas_parallel(quotes, broker_groups, DELTA_THRESHOLD, processes=2, engine=engine, slice_rows=SLICE_ROWS)
+    assert _as_json(dif_list) == _as_json([dif for key in broker_groups for dif in baseline_difs[key]])
+
+
+def test_parallel_slices_with_duplicate_timestamps(duplicate_timestamp_quotes, broker_groups):
+    baseline = _group_difs(duplicate_timestamp_quotes, broker_groups, DELTA_THRESHOLD, 'rows')
+    dif_list = find_deltas_parallel(duplicate_timestamp_quotes, broker_groups, DELTA_THRESHOLD, processes=2, slice_rows=SLICE_ROWS)
+    assert _as_json(dif_list) == [dif for key in broker_groups for dif in baseline[key]]
+
+
+def test_parallel_warmup_shorter_than_the_staleness_horizon(quotes, broker_groups):
+    with pytest.raises(ValueError):
+        find_deltas_parallel(quotes, broker_groups, DELTA_THRESHOLD, processes=2, warmup_ms=DETECTION_WARMUP_MS - 1)
@@ -0,0 +1,32 @@
+import numpy as np
+import pandas as pd
+import pytest
+from delta_table import DeltaTable, dif_list_nbytes
+
+
+@pytest.fixture
+def table(baseline_difs):
+    return DeltaTable.from_records(baseline_difs['NY'])
+
+
+def test_table_is_the_dif_list(table, baseline_difs):
+    assert [dict(dif) for dif in table] == baseline_difs['NY']
+    pd.testing.assert_frame_equal(table.to_dataframe(), pd.DataFrame(baseline_difs['NY']), check_dtype=False, check_categorical=False)
+
+
+def test_table_is_smaller_than_the_dicts(table, baseline_difs):
+    assert 0 < table.nbytes < dif_list_nbytes(baseline_difs['NY'])
+
+
+def test_float_timestamps_are_not_truncated(table):
+    table[0]['offer_bbp_timestamp'] = 2.0
+    assert table.columns['offer_bbp_timestamp'].dtype == np.int64
+    assert table[0]['offer_bbp_timestamp'] == 2
+
+    table[1]['offer_bbp_timestamp'] = 1662966000000.5
+    assert table.columns['offer_bbp_timestamp'].dtype == np.float64
+    assert table[1]['offer_bbp_timestamp'] == 1662966000000.5
+    assert table[0]['offer_bbp_timestamp'] == 2
+
+    table[2]['dif_bbp_timestamp'] = np.nan
+    assert np.isnan(table[2]['dif_bbp_timestamp'])
@@ -0,0 +1,94 @@
+import json
+import shutil
+import pytest
+from pipeline_benchmark import BENCHMARK_DATE
+from intraday_checkpoint import IntradayCheckpoint
+from position_grapher import create_delta_graphs_and_csv, find_deltas_incremental, from_datetime
+from storage_backends import InMemoryStorage
+from conftest import DELTA_THRESHOLD, FailingStorage
+
+
+DATE = '12-09-2022'
+
+
+def _as_json(value):
+    return json.loads(json.dumps(value, default=lambda v: v.item()))
+
+
+def _day_in_parts(quotes, broker_groups, parts):
+    '''
+    runs find_deltas_incremental() on a growing day, cut in parts by bbp_timestamp, and returns the states after every part
+    '''
+    cuts = quotes['bbp_timestamp'].quantile([part / parts for part in range(1, parts)]).tolist() + [quotes['bbp_timestamp'].max()]
+    state = None
+    states = []
+    for cut in cuts:
+        dif_list, state = find_deltas_incremental(quotes[quotes['bbp_timestamp'] <= cut], broker_groups, DELTA_THRESHOLD, state, engine='vectorized')
+        states.append(_as_json(state))
+    return dif_list, states
+
+
+def test_incremental_parts_find_the_difs_of_the_whole_day(quotes, broker_groups, baseline_difs):
+    dif_list, states = _day_in_parts(quotes, broker_groups, 3)
+    assert _as_json(dif_list) == _as_json([dif for key in broker_groups for dif in baseline_difs[key]])
+
+
+def test_checkpoint_round_trip(tmp_path, quotes, broker_groups, baseline_difs):
+    checkpoint = IntradayCheckpoint(str(tmp_path))
+    assert checkpoint.load(DATE) is None
+    _, states = _day_in_parts(quotes, broker_groups, 3)
+    for state in states:
+        checkpoint.save(DATE, state)
+        assert checkpoint.load(DATE) == state
+
+    # every run appended only its new difs
+    with open(checkpoint.difs_path(DATE)) as f:
+        assert sum(1 for line in f) == sum(len(baseline_difs[key]) for key in broker_groups)
+    # the json has no difs
+    with open(checkpoint.path(DATE)) as f:
+        assert all('dif_list' not in group_index for group_index in json.load(f)['groups'].values())
+
+    # the rest of the day from the loaded checkpoint finds the same difs as the whole day at once
+    shutil.rmtree(tmp_path)
+    checkpoint = IntradayCheckpoint(str(tmp_path))
+    cut = quotes['bbp_timestamp'].median()
+    dif_list, state = find_deltas_incremental(quotes[quotes['bbp_timestamp'] <= cut], broker_groups, DELTA_THRESHOLD, None, engine='vectorized')
+    checkpoint.save(DATE, state)
+    dif_list, state = find_deltas_incremental(quotes, broker_groups, DELTA_THRESHOLD, checkpoint.load(DATE), engine='vectorized')
+    assert _as_json(dif_list) == _as_json([dif for key in broker_groups for dif in baseline_difs[key]])
+
+
+def test_difs_of_a_run_without_checkpoint_are_dropped(tmp_path, quotes, broker_groups):
+    checkpoint = IntradayCheckpoint(str(tmp_path))
+    _, states = _day_in_parts(quotes, broker_groups, 3)
+    checkpoint.save(DATE, states[0])
+    with open(checkpoint.path(DATE)) as f:
+        first_index = f.read()
+    # a run that appended its difs but failed before its checkpoint json was replaced
+    checkpoint.save(DATE, states[1])
+    with open(checkpoint.path(DATE), 'w') as f:
+        f.write(first_index)
+    assert checkpoint.load(DATE) == states[0]
+
+    checkpoint.save(DATE, states[2])
+    assert checkpoint.load(DATE) == states[2]
+    with open(checkpoint.difs_path(DATE)) as f:
+        assert sum(1 for line in f) == sum(len(group_state['dif_list']) for group_state in states[2]['groups'].values())
+
+
+def test_failed_graph_uploads_are_not_checkpointed(tmp_path, day_storage, position_source, pipeline_args):
+    checkpoint = IntradayCheckpoint(str(tmp_path))
+    working_date = from_datetime(BENCHMARK_DATE)
+    graphed = [f'{pos["_id"]}' for pos in position_source.load(BENCHMARK_DATE)[0]]
+    failing = FailingStorage(graphed[0])
+    with pytest.raises(RuntimeError, match=graphed[0]):
+        create_delta_graphs_and_csv(BENCHMARK_DATE, storage=day_storage, aws_handler=failing, position_source=position_source, upload_workers=2, checkpoint=checkpoint, **pipeline_args)
+    graphed_position_ids = checkpoint.load(working_date)['graphed_position_ids']
+    assert graphed_position_ids
+    assert graphed[0] not in graphed_position_ids
+
+    # the next run renders only the graph that failed
+    target = InMemoryStorage()
+    create_delta_graphs_and_csv(BENCHMARK_DATE, storage=day_storage, aws_handler=target, position_source=position_source, upload_workers=2, checkpoint=checkpoint, **pipeline_args)
+    assert sorted(key for bucket_name, key in target.objects if '/positions/' in key) == [f'{working_date}/positions/{graphed[0]}.html']
+    assert graphed[0] in checkpoint.load(working_date)['graphed_position_ids']
@@ -0,0 +1,61 @@
+import re
+import numpy as np
+import pytest
+from position_grapher import (BookWindowIndex, create_flat_broker_dict, merge_broker_dict, position_plots, delta_plots,
+                              sync_positions_and_difs_indexed)
+
+
+@pytest.fixture(scope='module')
+def book(quotes):
+    brokers = np.asarray(quotes.broker_name.unique())
+    brokers_dict = create_flat_broker_dict(file=quotes, brokers=brokers)
+    merged = merge_broker_dict(brokers_dict)
+    return brokers, brokers_dict, merged, BookWindowIndex(brokers_dict, merged)
+
+
+@pytest.fixture(scope='module')
+def ny_position(broker_groups, baseline_difs, position_source):
+    '''
+    a synced position between NY brokers, its graph doesn't draw the London brokers unless graph_other_brokers
+    '''
+    position_list = position_source.load(None)[0]
+    sync_positions_and_difs_indexed(position_list, [dict(dif) for dif_list in baseline_difs.values() for dif in dif_list], 0.5, 2, broker_groups)
+    return next(pos for pos in position_list if pos['dif_ids'] and pos['enter_broker'] in broker_groups['NY'] and pos['exit_broker'] in broker_groups['NY'])
+
+
+def _points(window_index, brokers, lower, upper):
+    # bid, offer and their sizes
+    return sum(4 * len(window_index.broker_window(broker_name, lower, upper)) for broker_name in brokers)
+
+
+def test_auto_render_mode_counts_the_drawn_brokers(book, broker_groups, ny_position):
+    brokers, brokers_dict, merged, window_index = book
+    lower = ny_position['dif_bbp_timestamp'] - 60000 * 0.5
+    upper = ny_position['dif_bbp_timestamp'] + 60000 * 2
+    drawn_points = _points(window_index, broker_groups['NY'], lower, upper)
+    assert _points(window_index, brokers, lower, upper) > drawn_points
+
+    def trace_type(graph_other_brokers):
+        price_plot, size_plot = position_plots(difs=ny_position['dif_ids'], position=ny_position, brokers=brokers, brokers_dict=brokers_dict, merged=merged, broker_groups=broker_groups,
+                                               time_before_dif=0.5, time_after_dif=2, graph_other_brokers=graph_other_brokers, window_index=window_index, render_mode='auto', webgl_threshold=drawn_points)
+        return price_plot.data[0].type
+
+    assert trace_type(graph_other_brokers=False) == 'scatter'
+    assert trace_type(graph_other_brokers=True) == 'scattergl'
+
+
+def test_delta_plots_reduce_traces(book, baseline_difs, capsys):
+    brokers, brokers_dict, merged, window_index = book
+    dif = baseline_difs['NY'][len(baseline_difs['NY']) // 2]
+    full_plot, full_size_plot = delta_plots(dif, brokers, brokers_dict, merged, time_buffer=2, window_index=window_index)
+    capsys.readouterr()
+    reduced_plot, reduced_size_plot = delta_plots(dif, brokers, brokers_dict, merged, time_buffer=2, window_index=window_index, max_trace_points=10)
+    removed, total = map(int, re.search(r'removed (\d+) of (\d+) points', capsys.readouterr().out).groups())
+    broker_traces = [index for index, trace in enumerate(full_plot.data) if trace.name.endswith(('_bid', '_offer'))]
+    assert max(len(full_plot.data[index].x) for index in broker_traces) > 14
+    # the budget, plus the first and last points and the two around the dif
+    assert all(len(reduced_plot.data[index].x) <= 14 for index in broker_traces)
+    traced = [trace for trace in full_plot.data + full_size_plot.data if trace.name.endswith(('_bid', '_offer', '_size'))]
+    reduced = [trace for trace in reduced_plot.data + reduced_size_plot.data if trace.name.endswith(('_bid', '_offer', '_size'))]
+    assert total == sum(len(trace.x) for trace in traced)
+    assert removed == total - sum(len(trace.x) for trace in reduced) > 0
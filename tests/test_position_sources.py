@@ -0,0 +1,108 @@
+import pickle
+from datetime import datetime
+
+import bson
+import pytest
+import common_utils.mongo_utils as mongo_utils
+from bson.raw_bson import RawBSONDocument
+from position_sources import MongoPositionSource, POSITION_FIELDS, FAILED_SIGNAL_FIELDS, MONGO_BATCH_SIZE
+
+
+TODAY = datetime(2024, 1, 2)
+DAY_START = 1704153600000
+
+
+def _position(index):
+    return {'_id': index, 'dif_bbp_timestamp': DAY_START + 1000 * index, 'dif_ids': [], 'broker_pairs': [['a', 'b']],
+            'comment1': 'x' * 200, 'ticket': {'notes': 'y' * 200}}
+
+
+def _full_fetch(date):
+    return [_position(index) for index in range(3)], [{'raw': 'z' * 100}]
+
+
+class FakeCollection:
+    '''
+    the find() of a pymongo collection with RawBSONDocument documents, recording the queries
+    '''
+    def __init__(self, docs):
+        self.docs = docs
+        self.queries = []
+        self.sent_bytes = 0
+
+    def find(self, filter, projection, batch_size):
+        self.queries.append((filter, projection, batch_size))
+        bounds = filter['dif_bbp_timestamp']
+        for doc in self.docs:
+            if bounds['$gte'] <= doc['dif_bbp_timestamp'] < bounds['$lt']:
+                raw = bson.encode({field: value for field, value in doc.items() if field in projection})
+                self.sent_bytes += len(raw)
+                yield RawBSONDocument(raw)
+
+
+class FakeCollectionSource(MongoPositionSource):
+    def __init__(self, collections, **kwargs):
+        super().__init__(**kwargs)
+        self.collections = collections
+
+    def collection(self, name):
+        return self.collections[name]
+
+
+@pytest.fixture
+def mongo_utils_fetch(monkeypatch):
+    monkeypatch.setattr(mongo_utils, 'retreive_position_dicts', _full_fetch, raising=False)
+    monkeypatch.setattr(mongo_utils, 'retreive_delta_dict_mongo', _full_fetch, raising=False)
+
+
+def test_projected_query(monkeypatch):
+    def full_fetch(date):
+        raise AssertionError('the full documents should not be fetched')
+
+    monkeypatch.setattr(mongo_utils, 'retreive_position_dicts', full_fetch, raising=False)
+    monkeypatch.setattr(mongo_utils, 'retreive_delta_dict_mongo', full_fetch, raising=False)
+    # the last one is on the next day
+    docs = [_position(index) for index in range(3)] + [dict(_position(3), dif_bbp_timestamp=DAY_START + 24 * 3600 * 1000)]
+    for doc in docs:
+        del doc['dif_ids']
+    collections = {'positions': FakeCollection(docs), 'failed_signals': FakeCollection(docs)}
+    source = FakeCollectionSource(collections, projected=True, keep_raw=False, mongo_uri='mongodb://localhost', database_name='db',
+                                  collection_names={'positions': 'positions', 'failed_signals': 'failed_signals'})
+    position_list, signal_no_position, raw_positions, raw_signal_no_position = source.load(TODAY)
+    assert [pos['_id'] for pos in position_list] == [0, 1, 2]
+    assert all('comment1' not in pos and pos['dif_ids'] == [] for pos in position_list + signal_no_position)
+    assert raw_positions == [] and raw_signal_no_position == []
+    (filter, projection, batch_size), = collections['positions'].queries
+    assert filter == {'dif_bbp_timestamp': {'$gte': DAY_START, '$lt': DAY_START + 24 * 3600 * 1000}}
+    assert set(projection) == set(POSITION_FIELDS) and batch_size == MONGO_BATCH_SIZE
+    assert set(collections['failed_signals'].queries[0][1]) == set(FAILED_SIGNAL_FIELDS)
+    assert source.last_fetch['paths'] == {'positions': 'projected_query', 'failed_signals': 'projected_query'}
+    assert source.last_fetch['fetched_bytes'] == source.last_fetch['kept_bytes'] == sum(collection.sent_bytes for collection in collections.values())
+
+
+def test_full_fetch_is_projected_after(mongo_utils_fetch):
+    source = MongoPositionSource(projected=True, keep_raw=False, measure_bytes=True)
+    position_list, signal_no_position, raw_positions, raw_signal_no_position = source.load(TODAY)
+    assert all('comment1' not in pos for pos in position_list + signal_no_position)
+    assert raw_positions == [] and raw_signal_no_position == []
+    assert source.last_fetch['paths'] == {'positions': 'full_fetch', 'failed_signals': 'full_fetch'}
+    assert source.last_fetch['fetched_bytes'] > 2 * source.last_fetch['kept_bytes']
+
+
+def test_full_fetch_bytes_are_only_measured_when_asked(mongo_utils_fetch, monkeypatch):
+    def no_encoding(docs):
+        raise AssertionError('the documents should not be encoded')
+
+    monkeypatch.setattr('position_sources.documents_bytes', no_encoding)
+    source = MongoPositionSource()
+    position_list, _, raw_positions, _ = source.load(TODAY)
+    assert position_list == _full_fetch(TODAY)[0] and raw_positions == _full_fetch(TODAY)[1]
+    assert source.last_fetch['fetched_bytes'] is None
+
+
+def test_source_is_pickled_without_its_client():
+    source = MongoPositionSource(projected=True, mongo_uri='mongodb://localhost', database_name='db', collection_names={'positions': 'p', 'failed_signals': 'f'})
+    copy = pickle.loads(pickle.dumps(source))
+    assert copy.mongo_uri == source.mongo_uri and copy.collection_names == source.collection_names and copy._client is None
+    with pytest.raises(ValueError):
+        MongoPositionSource(mongo_uri='mongodb://localhost')
@@ -0,0 +1,25 @@
+import io
+import numpy as np
+import pandas as pd
+from pipeline_benchmark import quotes_csv
+from position_grapher import create_flat_broker_dict
+from quote_schema import QUOTE_CSV_OPTIONS, apply_quote_schema
+
+
+# not round and above 2**24, float32 would change it
+ODD_SIZE = 16777217.5
+
+
+def test_sizes_are_kept_exactly(quotes):
+    quotes = quotes.copy()
+    quotes.loc[quotes.index[0], 'size'] = ODD_SIZE
+    assert apply_quote_schema(quotes)['size'].iloc[0] == ODD_SIZE
+    read = pd.read_csv(io.BytesIO(quotes_csv(quotes)), **QUOTE_CSV_OPTIONS)
+    assert read['size'].iloc[0] == ODD_SIZE
+
+
+def test_flat_broker_dict_sizes_are_float64(quotes):
+    brokers_dict = create_flat_broker_dict(file=quotes, brokers=np.asarray(quotes.broker_name.unique()))
+    for broker_name, flat in brokers_dict.items():
+        assert flat[f'{broker_name}_bid_size'].dtype == np.float64
+        assert flat[f'{broker_name}_offer_size'].dtype == np.float64
@@ -0,0 +1,91 @@
+import json
+import threading
+from datetime import timedelta
+import pytest
+import position_grapher
+from common_utils.constant import MERGED_RAW_DATA_FILE_NAME, AWS_S3_BUCKET_NAME
+from pipeline_benchmark import BENCHMARK_DATE, generate_quotes, quotes_csv
+from position_grapher import create_delta_graphs_and_csv, divide_cores, run_dates_scheduled, estimate_day_footprint, from_datetime, DAY_MEMORY_PER_FILE_BYTE, WORKER_BASE_BYTES
+from stage_metrics import StageMetrics
+from storage_backends import InMemoryStorage, PrefetchingStorage
+from conftest import HOURS, SEED, START_HOUR
+
+
+def test_prefetched_file_is_in_the_footprint(day_storage):
+    working_date = from_datetime(BENCHMARK_DATE)
+    size = day_storage.object_size(AWS_S3_BUCKET_NAME, f'{working_date}/{MERGED_RAW_DATA_FILE_NAME}')
+    assert estimate_day_footprint(working_date, storage=day_storage) == size * DAY_MEMORY_PER_FILE_BYTE
+    assert estimate_day_footprint(working_date, storage=PrefetchingStorage(day_storage)) == size * (DAY_MEMORY_PER_FILE_BYTE + 1)
+    # too big to be prefetched, it is streamed
+    assert estimate_day_footprint(working_date, storage=PrefetchingStorage(day_storage, max_bytes=size - 1)) == size * DAY_MEMORY_PER_FILE_BYTE
+
+
+class UnreachableStorage(InMemoryStorage):
+    def open_object(self, bucket_name, key):
+        raise OSError(f'injected failure of {key}')
+
+
+def test_failed_date_stops_the_positions_thread(position_source, pipeline_args):
+    def fetch_threads():
+        return [thread for thread in threading.enumerate() if thread.name.startswith('ThreadPoolExecutor')]
+
+    before = fetch_threads()
+    # the read error is printed and the run fails on the missing quotes
+    with pytest.raises(Exception):
+        create_delta_graphs_and_csv(BENCHMARK_DATE, storage=UnreachableStorage(), streaming_ingest=True, position_source=position_source, pipelined=True, **pipeline_args)
+    assert fetch_threads() == before
+
+
+def test_cores_are_divided_between_the_dates():
+    kwargs = {'render_processes': 16, 'detection_processes': 16, 'upload_workers': 8}
+    assert divide_cores(kwargs, 4, cores=16) == {'render_processes': 4, 'detection_processes': 4, 'upload_workers': 8}
+    assert divide_cores(kwargs, 1, cores=8) == {'render_processes': 8, 'detection_processes': 8, 'upload_workers': 8}
+    # every date keeps at least one process
+    assert divide_cores(kwargs, 4, cores=2)['render_processes'] == 1
+    assert divide_cores({'render_processes': None}, 4, cores=16) == {'render_processes': None}
+
+
+def test_worker_processes_are_in_the_footprint(day_storage):
+    working_date = from_datetime(BENCHMARK_DATE)
+    alone = estimate_day_footprint(working_date, storage=day_storage)
+    # one process makes no pool
+    assert estimate_day_footprint(working_date, storage=day_storage, render_processes=1, detection_processes=1) == alone
+    with_render = estimate_day_footprint(working_date, storage=day_storage, render_processes=4)
+    assert with_render >= alone + 4 * WORKER_BASE_BYTES
+    # the pools don't run at the same time
+    assert estimate_day_footprint(working_date, storage=day_storage, render_processes=4, detection_processes=2) == with_render
+
+
+@pytest.mark.parametrize('pipelined', [False, True])
+def test_metrics_of_a_run(tmp_path, day_storage, position_source, pipeline_args, pipelined):
+    metrics = StageMetrics(str(tmp_path), formats=('json',))
+    create_delta_graphs_and_csv(BENCHMARK_DATE, storage=day_storage, position_source=position_source, pipelined=pipelined, metrics=metrics, **pipeline_args)
+    with open(metrics.path('metrics.json')) as f:
+        stages = {record['stage']: record for record in json.load(f)['stages']}
+    assert stages['fetch_mongo']['calls'] == 1
+    assert stages['fetch_mongo']['rows_out'] == 8
+    assert ('wait_mongo' in stages) == pipelined
+
+
+@pytest.mark.parametrize('pipelined', [False, True])
+def test_failed_read_is_raised_with_metrics(tmp_path, day_storage, position_source, pipeline_args, monkeypatch, pipelined):
+    def failed_read(*args, **kwargs):
+        raise OSError('injected failure of the quotes')
+
+    monkeypatch.setattr(position_grapher, 'load_day_quotes', failed_read)
+    with pytest.raises(OSError, match='injected failure of the quotes'):
+        create_delta_graphs_and_csv(BENCHMARK_DATE, storage=day_storage, position_source=position_source, pipelined=pipelined,
+                                    metrics=StageMetrics(str(tmp_path), formats=('json',)), **pipeline_args)
+
+
+def test_scheduled_dates_run_their_own_pools(tmp_path, day_storage, broker_groups, position_source, pipeline_args):
+    # each date runs in a worker process that starts render and detection pools of its own
+    working_date = from_datetime(BENCHMARK_DATE)
+    next_day = BENCHMARK_DATE + timedelta(days=1)
+    next_date = from_datetime(next_day)
+    raw = generate_quotes(broker_groups, hours=HOURS, seed=SEED, start_hour=START_HOUR, day=next_day)
+    day_storage.put_object(AWS_S3_BUCKET_NAME, f'{next_date}/{MERGED_RAW_DATA_FILE_NAME}', quotes_csv(raw))
+    summary = run_dates_scheduled([working_date, next_date], 10**12, 2, str(tmp_path / 'summary.json'), cores=4, storage=day_storage,
+                                  position_source=position_source, render_processes=8, detection_processes=8, detection_slice_rows=2000, **pipeline_args)
+    assert summary['render_processes'] == summary['detection_processes'] == 2
+    assert {date: record['status'] for date, record in summary['dates'].items()} == {working_date: 'done', next_date: 'done'}
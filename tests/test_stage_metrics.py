@@ -0,0 +1,24 @@
+import stage_metrics
+from stage_metrics import StageMetrics, measure_iter, measure_stage
+
+
+def test_repeated_stages_reset_the_peak_once(tmp_path, monkeypatch):
+    resets = []
+
+    def reset_peak_rss():
+        resets.append(1)
+        return True
+
+    monkeypatch.setattr(stage_metrics, '_reset_peak_rss', reset_peak_rss)
+    metrics = StageMetrics(str(tmp_path), formats=('json',))
+    for date in ['01-01-2024', '02-01-2024']:
+        metrics.begin(date)
+        with measure_stage(metrics, 'sync'):
+            pass
+        for _ in measure_iter(metrics, 'render', range(5)):
+            with measure_stage(metrics, 'upload', rows_in=1):
+                pass
+        records = {record['stage']: record for record in metrics.save()}
+        assert records['render']['calls'] == 6 and records['upload']['calls'] == 5
+    # sync, render and upload of each date
+    assert len(resets) == 6